@@ -0,0 +1,285 @@
+'''Offline batch scoring: reports in from files, scores out to a file,
+no database needed -- for re-scoring a corpus on a compute node, or
+trying out rule changes on a laptop.
+
+    python batch.py [--extractors mayo,rutgeerts,ses_cd,combined]
+                    [--format jsonl|csv|parquet|snap] [--rpt-column notes]
+                    [--workers 4] [--tokenizer fast] [--metrics prefix]
+                    [--engine modules|rules]
+                    [--max-chars N] [--max-tokens N] [--max-anchors N]
+                    -o scores.jsonl input ...
+
+Input rows are shaped like the rows the drivers query: report text in
+rpt (or --rpt-column) for Mayo, Rutgeerts and combined, impression and
+findings for SES-CD, plus whatever ID columns (empi, proc_date, ...)
+the file has. The format is taken from each file's extension (.jsonl,
+.csv, .parquet, .snap) unless --format is given; Parquet needs pyarrow,
+and .snap is a snapshot.py snapshot.
+
+Each extractor only scores rows its SQL prefilter (PERTINENT_QY) would
+have selected, checked with common.mentions_any, so results match its
+own driver's. A row that no selected extractor applies to isn't
+written. Written rows carry the input's non-text columns plus one
+column per applicable score (SCORE_COLUMN), as JSONL or CSV (by the
+output's extension; '-' is JSONL on stdout).
+
+With --engine rules, all the extractors are run by one
+rules.RuleEngine compiled from their rules (one anchor scan and
+tokenization per text, shared), with the same results.
+
+--max-chars, --max-tokens and --max-anchors set a per-report work
+budget (see common.Budget): a report that would take more is scored
+BUDGET EXCEEDED rather than stall its worker.
+
+Input is read, scored and written as a stream, so memory stays bounded
+however large the input.
+'''
+import argparse
+import csv
+import functools
+import importlib
+import json
+import sys
+import rules
+from common import *
+from parallel import *
+from instrument import *
+
+EXTRACTORS = {'mayo': 'endoscopy_mayo',
+              'rutgeerts': 'endoscopy_rutgeerts',
+              'ses_cd': 'endoscopy_ses_cd',
+              'combined': 'endoscopy_combined'}
+
+# Run by default; combined is mayo + rutgeerts in one pass.
+DEFAULT_EXTRACTORS = ('mayo', 'rutgeerts', 'ses_cd')
+
+# Rows per Parquet record batch read.
+PARQUET_BATCH = 10000
+
+#-----------------------------------------------------------------------------
+# input
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_csv(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        yield from csv.DictReader(f)
+
+def read_parquet(path, batch_size=PARQUET_BATCH):
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('reading %s needs pyarrow' % path)
+    pf = pyarrow.parquet.ParquetFile(path)
+    for batch in pf.iter_batches(batch_size):
+        yield from batch.to_pylist()
+
+def read_snap(path):
+    import snapshot
+    return snapshot.read_snapshot(path)
+
+READERS = {'jsonl': read_jsonl, 'csv': read_csv, 'parquet': read_parquet,
+           'snap': read_snap}
+
+def file_format(path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    if ext == 'json':
+        return 'jsonl'
+    if ext == 'pq':
+        return 'parquet'
+    if ext not in READERS:
+        raise ValueError('unknown input format: %s' % path)
+    return ext
+
+def read_rows(paths, fmt=None, rpt_column='rpt'):
+    '''Generator; rows (dicts) from each of paths in turn. The column
+    rpt_column, if not rpt, is renamed rpt.'''
+    for path in paths:
+        for row in READERS[fmt or file_format(path)](path):
+            if rpt_column != 'rpt' and rpt_column in row:
+                row['rpt'] = row.pop(rpt_column)
+            yield row
+
+#-----------------------------------------------------------------------------
+# scoring
+
+def text_columns(x):
+    '''Columns extractor module x's score_row reads (and drops).'''
+    return getattr(x, 'TEXT_COLUMNS', ['rpt'])
+
+def prefilter_words(x):
+    if hasattr(x, 'PREFILTERS'):
+        return x.PREFILTERS
+    return [w for e in x.EXTRACTORS for w in e.PREFILTERS]
+
+def score_columns(x):
+    if hasattr(x, 'SCORE_COLUMN'):
+        return [x.SCORE_COLUMN]
+    return [e.SCORE_COLUMN for e in x.EXTRACTORS]
+
+def prefilter(x, row):
+    '''True if x's PERTINENT_QY would have selected row: any of its
+    text columns mentions any of its prefilter words.'''
+    words = prefilter_words(x)
+    return any(mentions_any(row[c], words) for c in text_columns(x)
+               if row.get(c))
+
+_extractor_cache = {}
+
+def load_extractors(names):
+    '''Extractor modules for names (a tuple of keys of EXTRACTORS).'''
+    xs = _extractor_cache.get(names)
+    if xs is None:
+        xs = _extractor_cache[names] = [
+            importlib.import_module(EXTRACTORS[n]) for n in names]
+    return xs
+
+def score_file_row(names, row):
+    '''Run each extractor in names that row passes the prefilter of.
+    Returns a row of the input's non-text columns plus the scores, or
+    None if no extractor applied. Module-level (with names bound by
+    functools.partial) so it can run in a worker pool.'''
+    xs = load_extractors(names)
+    drop = set(c for x in xs for c in text_columns(x))
+    out = dict((k, v) for k, v in row.items() if k not in drop)
+    found = False
+    for x in xs:
+        if not prefilter(x, row):
+            continue
+        cols = text_columns(x)
+        # A missing (NULL) section is scored as empty, as no score.
+        scored = x.score_row(dict((c, row.get(c) or '') for c in cols))
+        for c in score_columns(x):
+            if c in scored:
+                out[c] = scored[c]
+                found = True
+    return out if found else None
+
+_engine_cache = {}
+
+def rule_engine(names):
+    '''One rules.RuleEngine for the extractors in names (combined
+    standing for its own).'''
+    e = _engine_cache.get(names)
+    if e is None:
+        xs = [y for x in load_extractors(names)
+              for y in getattr(x, 'EXTRACTORS', [x])]
+        e = _engine_cache[names] = rules.compile_rules(xs)
+    return e
+
+def score_file_row_rules(names, row):
+    '''score_file_row, with the extractors run by rule_engine(names).'''
+    e = rule_engine(names)
+    base = set(row).difference(e.columns)
+    out = e.score_row(row)
+    return out if any(k not in base for k in out) else None
+
+def _warmup(names, text):
+    for x in load_extractors(names):
+        (getattr(x, 'find_score', None) or x.find_scores)(text)
+
+def score_rows(names, rows, workers=1, engine='modules'):
+    '''Generator; scored rows (see score_file_row) for rows, in order,
+    skipping those no extractor applied to. engine: 'modules' or
+    'rules' (see score_file_row_rules).'''
+    names = tuple(names)
+    fn = functools.partial(score_file_row_rules if engine == 'rules'
+                           else score_file_row, names)
+    if workers > 1:
+        out = pool_imap(fn, rows, workers,
+                        warmup=functools.partial(_warmup, names))
+    else:
+        out = map(fn, rows)
+    for row in METRICS.timed('score', out):
+        if row is not None:
+            METRICS.inc('rows.batch')
+            yield row
+
+#-----------------------------------------------------------------------------
+# output
+
+def write_jsonl(rows, f):
+    n = 0
+    for row in rows:
+        f.write(json.dumps(row, default=str) + '\n')
+        n += 1
+    return n
+
+def write_csv(rows, f, score_cols):
+    '''CSV with the first row's non-score columns, then score_cols
+    (blank where a score didn't apply).'''
+    w = None
+    n = 0
+    for row in rows:
+        if w is None:
+            cols = [k for k in row if k not in score_cols] + list(score_cols)
+            w = csv.DictWriter(f, cols, extrasaction='ignore')
+            w.writeheader()
+        w.writerow(row)
+        n += 1
+    return n
+
+def run_batch(paths, output, names=DEFAULT_EXTRACTORS, fmt=None,
+              rpt_column='rpt', workers=1, engine='modules'):
+    '''Score every row of the files in paths with the extractors in
+    names and write the results to output (a path, or '-' for stdout).
+    Returns number of rows written.'''
+    names = tuple(names)
+    xs = load_extractors(names)
+    score_cols = []
+    for x in xs:
+        score_cols.extend(c for c in score_columns(x) if c not in score_cols)
+    rows = METRICS.timed('read', read_rows(paths, fmt, rpt_column))
+    scored = score_rows(names, rows, workers, engine)
+    f = (sys.stdout if output == '-'
+         else open(output, 'w', encoding='utf-8', newline=''))
+    try:
+        with METRICS.timer('write'):
+            if output.endswith('.csv'):
+                return write_csv(scored, f, score_cols)
+            return write_jsonl(scored, f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('input', nargs='+')
+    ap.add_argument('-o', '--output', default='-')
+    ap.add_argument('--extractors', default=','.join(DEFAULT_EXTRACTORS))
+    ap.add_argument('--format', choices=sorted(READERS))
+    ap.add_argument('--rpt-column', default='rpt',
+                    help='input column holding the report text')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--tokenizer', choices=['nltk', 'fast'])
+    ap.add_argument('--metrics', help='path prefix for run metrics')
+    ap.add_argument('--engine', choices=['modules', 'rules'],
+                    default='modules')
+    ap.add_argument('--max-chars', type=int,
+                    help='work budget: most chars per report')
+    ap.add_argument('--max-tokens', type=int,
+                    help='work budget: most tokens read per report')
+    ap.add_argument('--max-anchors', type=int,
+                    help='work budget: most anchor matches per report')
+    args = ap.parse_args(argv)
+    names = args.extractors.split(',')
+    for n in names:
+        if n not in EXTRACTORS:
+            ap.error('unknown extractor: %s' % n)
+    import common
+    if args.tokenizer:
+        common.TOKENIZER = args.tokenizer
+    common.MAX_REPORT_CHARS = args.max_chars
+    common.MAX_REPORT_TOKENS = args.max_tokens
+    common.MAX_ANCHOR_STARTS = args.max_anchors
+    with collecting(args.metrics):
+        n = run_batch(args.input, args.output, names, args.format,
+                      args.rpt_column, args.workers, args.engine)
+    print('%d rows written' % n, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
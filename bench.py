@@ -0,0 +1,219 @@
+'''Benchmarks for the extractors, over a synthetic corpus (synth.py) or a
+JSONL one.
+
+    python bench.py [-n 2000] [--seed 0] [--corpus corpus.jsonl]
+                    [--extractors mayo,rutgeerts,ses_cd,combined]
+                    [--engines nltk,fast] [--workers 1,4]
+                    [--save results.json]
+                    [--compare baseline.json [--threshold 0.10]]
+    python bench.py --imports [--import-budget-ms 100]
+
+For each extractor x tokenizer engine x worker count, scores every row
+with the extractor's score_row and reports docs/sec, p50/p99 per-report
+latency (serial runs only) and peak RSS. Each case runs in a fresh
+child process, so its peak RSS is its own.
+
+With --compare, exit status is 1 if any case's docs/sec fell more than
+--threshold (a fraction) below the baseline's, so this can gate changes.
+
+With --imports, instead times a cold import of each extractor module (in
+a fresh interpreter) and checks it pulls in none of HEAVY_MODULES;
+exit status is 1 if one does or takes longer than --import-budget-ms.
+'''
+import argparse
+import importlib
+import json
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+import synth
+from common import *
+from parallel import *
+
+EXTRACTORS = {'mayo': 'endoscopy_mayo',
+              'rutgeerts': 'endoscopy_rutgeerts',
+              'ses_cd': 'endoscopy_ses_cd',
+              'combined': 'endoscopy_combined'}
+
+# Default regression threshold for --compare: fractional drop in docs/sec.
+THRESHOLD = 0.10
+
+# Mustn't be loaded just by importing an extractor (see common).
+HEAVY_MODULES = ['nltk', 'db3', 'ks3', 'pyodbc', 'sqlite3', 'multiprocessing']
+IMPORT_BUDGET_MS = 100
+
+_IMPORT_PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import %s
+ms = (time.perf_counter() - t) * 1000
+print(json.dumps([ms, [m for m in %r if m in sys.modules]]))
+'''
+
+def import_cost(module, repeat=3):
+    '''(best of repeat) ms to import module in a fresh interpreter, and
+    which of HEAVY_MODULES that loaded.'''
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c',
+                              _IMPORT_PROBE % (module, HEAVY_MODULES)],
+                             capture_output=True, text=True, check=True)
+        ms, heavy = json.loads(out.stdout.strip().splitlines()[-1])
+        best = ms if best is None else min(best, ms)
+    return round(best, 1), heavy
+
+def check_imports(budget_ms=IMPORT_BUDGET_MS):
+    '''Print import cost of each extractor module; returns list of
+    failures (over budget, or heavy modules loaded).'''
+    bad = []
+    for module in EXTRACTORS.values():
+        ms, heavy = import_cost(module)
+        print('%s\t%.1f ms\t%s' % (module, ms, ','.join(heavy) or '-'))
+        if heavy or ms > budget_ms:
+            bad.append((module, ms, heavy))
+    return bad
+
+def percentile(xs, p):
+    '''p-th percentile (0-100) of sorted list xs, nearest rank.'''
+    if not xs:
+        return None
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs))) - 1))]
+
+def peak_rss_mb():
+    '''Peak RSS of this process and (separately) its largest reaped
+    child, in MB, whichever is bigger. ru_maxrss is KB on Linux.'''
+    kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return kb / 1024
+
+def run_case(rows, extractor, engine, workers):
+    '''Score rows (dicts; copied, not mutated). Returns result dict.'''
+    import common
+    common.TOKENIZER = engine
+    x = importlib.import_module(EXTRACTORS[extractor])
+    warmup = getattr(x, 'find_score', None) or x.find_scores
+    warmup(WARMUP_TEXT)
+    lat = []
+    t0 = time.perf_counter()
+    if workers > 1:
+        for _ in pool_imap(x.score_row, (dict(r) for r in rows), workers,
+                           warmup=warmup):
+            pass
+    else:
+        for r in rows:
+            r = dict(r)
+            t = time.perf_counter()
+            x.score_row(r)
+            lat.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - t0
+    lat.sort()
+    ms = lambda s: None if s is None else round(s * 1000, 4)
+    return {'extractor': extractor, 'engine': engine, 'workers': workers,
+            'docs': len(rows), 'secs': round(elapsed, 4),
+            'docs_per_sec': round(len(rows) / elapsed, 1) if elapsed else None,
+            'p50_ms': ms(percentile(lat, 50)),
+            'p99_ms': ms(percentile(lat, 99)),
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+def _child(conn, rows, extractor, engine, workers):
+    try:
+        conn.send(run_case(rows, extractor, engine, workers))
+    except Exception as ex:
+        conn.send({'extractor': extractor, 'engine': engine,
+                   'workers': workers, 'error': repr(ex)})
+    conn.close()
+
+def run_isolated(rows, extractor, engine, workers):
+    '''run_case in a child process (so peak RSS is per case).'''
+    ctx = multiprocessing.get_context('fork')
+    a, b = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(b, rows, extractor, engine, workers))
+    p.start()
+    b.close()
+    result = a.recv()
+    p.join()
+    return result
+
+def case_key(r):
+    return '%s/%s/w%d' % (r['extractor'], r['engine'], r['workers'])
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''Returns list of (case, base docs/sec, docs/sec, change) for cases
+    that regressed by more than threshold.'''
+    base = dict((case_key(r), r) for r in baseline if 'docs_per_sec' in r)
+    bad = []
+    for r in results:
+        b = base.get(case_key(r))
+        if not b or not r.get('docs_per_sec') or not b['docs_per_sec']:
+            continue
+        change = r['docs_per_sec'] / b['docs_per_sec'] - 1
+        if change < -threshold:
+            bad.append((case_key(r), b['docs_per_sec'], r['docs_per_sec'],
+                        change))
+    return bad
+
+def format_table(results):
+    cols = ['extractor', 'engine', 'workers', 'docs', 'docs_per_sec',
+            'p50_ms', 'p99_ms', 'peak_rss_mb']
+    lines = ['\t'.join(cols)]
+    for r in results:
+        if 'error' in r:
+            lines.append('%s\t%s\t%s\tERROR %s' % (
+                r['extractor'], r['engine'], r['workers'], r['error']))
+        else:
+            lines.append('\t'.join(str(r[c]) for c in cols))
+    return '\n'.join(lines)
+
+def load_rows(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('-n', type=int, default=2000)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--words', type=int, default=synth.WORDS)
+    ap.add_argument('--corpus', help='JSONL rows instead of synth output')
+    ap.add_argument('--extractors', default=','.join(EXTRACTORS))
+    ap.add_argument('--engines', default='nltk,fast')
+    ap.add_argument('--workers', default='1,%d' % WORKERS)
+    ap.add_argument('--save')
+    ap.add_argument('--compare')
+    ap.add_argument('--threshold', type=float, default=THRESHOLD)
+    ap.add_argument('--imports', action='store_true')
+    ap.add_argument('--import-budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    args = ap.parse_args(argv)
+    if args.imports:
+        bad = check_imports(args.import_budget_ms)
+        for module, ms, heavy in bad:
+            print('IMPORT REGRESSION %s: %.1f ms, loads %s'
+                  % (module, ms, ','.join(heavy) or 'nothing heavy'))
+        sys.exit(1 if bad else 0)
+    if args.corpus:
+        rows = load_rows(args.corpus)
+    else:
+        rows = list(synth.corpus(args.n, args.seed, args.words))
+    results = []
+    for extractor in args.extractors.split(','):
+        for engine in args.engines.split(','):
+            for workers in map(int, args.workers.split(',')):
+                r = run_isolated(rows, extractor, engine, workers)
+                results.append(r)
+                print(format_table([r]).split('\n')[1], file=sys.stderr)
+    print(format_table(results))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            bad = compare(results, json.load(f), args.threshold)
+        for case, b, r, change in bad:
+            print('REGRESSION %s: %.1f -> %.1f docs/sec (%+.1f%%)'
+                  % (case, b, r, 100 * change))
+        if bad:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+'''Bulk writes to destination tables.
+
+Rows go in as parameter arrays, batch_size at a time (pyodbc's
+fast_executemany on SQL Server), over one connection for the whole
+load, with optional progress reporting. By default they're staged --
+in a staging table next to the destination, or spooled to a temp file
+-- and only swapped into the destination, in one transaction, once the
+whole load has been written; so readers of the destination see either
+the old rows or the new ones, never an empty or half-written table.
+
+Works against SQLite as well (db_spec with a 'sqlite' path; see
+dbio.db_connect), for testing.
+'''
+import pickle
+import sys
+from dbio import *
+
+# Rows per executemany call.
+BATCH_SIZE = 5000
+
+# Default staging: 'table' (staging table, then delete + insert-select in
+# one transaction), 'file' (spool to a temp file, then delete + insert in
+# one transaction), or None (empty the table, then insert straight into
+# it, committing every batch; not atomic).
+BULK_STAGE = 'table'
+
+# Default for progress (see BulkLoader).
+BULK_PROGRESS = False
+
+def stage_table_name(table):
+    '''Staging table for table, e.g.
+    [dm_cadc].[ibd].[tmp_x] --> [dm_cadc].[ibd].[tmp_x__stage]'''
+    if table.endswith(']'):
+        return table[:-1] + '__stage]'
+    return table + '__stage'
+
+def db_table_exists(db_spec, table):
+    conn = db_connect(db_spec)
+    try:
+        conn.cursor().execute('select * from %s where 1 = 0' % table)
+        return True
+    except Exception:
+        return False
+    finally:
+        conn.close()
+
+def print_progress(table, out=sys.stderr):
+    '''A progress callback for BulkLoader that prints running totals.'''
+    def progress(n):
+        print('%s: %d rows' % (table, n), file=out)
+    return progress
+
+class BulkLoader:
+    '''Loads rows (dicts, all with the same keys, which must be columns of
+    table) into table. Use as a context manager: the load is committed
+    (swapped in, if staged) on normal exit and abandoned on an
+    exception, leaving table as it was.
+        with BulkLoader(db_spec, DEST_TABLE) as b:
+            b.write(rows)
+    o stage: see BULK_STAGE.
+    o progress: False, True (print_progress), or callable(rows_written),
+      called after each batch.
+    o create: callable(db_spec) to call first if table doesn't exist.'''
+
+    def __init__(self, db_spec, table, batch_size=BATCH_SIZE,
+                 stage=BULK_STAGE, progress=BULK_PROGRESS, create=None):
+        if stage not in ('table', 'file', None):
+            raise ValueError('stage must be table, file or None')
+        self.db_spec = db_spec
+        self.table = table
+        self.batch_size = batch_size
+        self.stage = stage
+        self.progress = (print_progress(table) if progress is True
+                         else progress)
+        self.create = create
+        self.n = 0
+        self._cols = None
+        self._spool = None
+        self._conn = None
+
+    def __enter__(self):
+        if self.create and not db_table_exists(self.db_spec, self.table):
+            self.create(self.db_spec)
+        self._conn = db_connect(self.db_spec)
+        if self.stage == 'table':
+            st = stage_table_name(self.table)
+            cur = self._conn.cursor()
+            cur.execute('drop table if exists %s' % st)
+            if is_sqlite(self.db_spec):
+                cur.execute('create table %s as select * from %s where 0'
+                            % (st, self.table))
+            else:
+                cur.execute('select * into %s from %s where 1 = 0'
+                            % (st, self.table))
+            self._conn.commit()
+        elif self.stage == 'file':
+            import tempfile
+            self._spool = tempfile.TemporaryFile()
+        else:
+            self._conn.cursor().execute('delete from %s' % self.table)
+            self._conn.commit()
+        return self
+
+    def __exit__(self, typ, val, tb):
+        try:
+            if typ is None:
+                self.commit()
+            else:
+                self._conn.rollback()
+                self._drop_stage()
+        finally:
+            if self._spool is not None:
+                self._spool.close()
+            self._conn.close()
+        return False
+
+    def _insert_sql(self, table):
+        return ('insert into %s (%s) values (%s)'
+                % (table, ', '.join(self._cols),
+                   ', '.join('?' * len(self._cols))))
+
+    def _cursor(self):
+        cur = self._conn.cursor()
+        if not is_sqlite(self.db_spec):
+            cur.fast_executemany = True
+        return cur
+
+    def _params(self, rows):
+        '''Lists of up to batch_size parameter tuples for rows.'''
+        if isinstance(rows, RecordBatch):
+            if self._cols is None and len(rows):
+                self._cols = list(rows.columns)
+            return chunked(rows.tuples(self._cols), self.batch_size)
+        return self._dict_params(rows)
+
+    def _dict_params(self, rows):
+        for batch in chunked(rows, self.batch_size):
+            if self._cols is None:
+                self._cols = list(batch[0])
+            yield [tuple(r[c] for c in self._cols) for r in batch]
+
+    def write(self, rows):
+        '''Write rows (any iterable of dicts, or a records.RecordBatch),
+        batch_size at a time. Returns number of rows written so far.'''
+        for params in self._params(rows):
+            with METRICS.timer('db_insert'):
+                if self.stage == 'file':
+                    pickle.dump(params, self._spool, pickle.HIGHEST_PROTOCOL)
+                else:
+                    target = (stage_table_name(self.table)
+                              if self.stage == 'table' else self.table)
+                    self._cursor().executemany(self._insert_sql(target),
+                                               params)
+                    self._conn.commit()
+            self.n += len(params)
+            if self.progress:
+                self.progress(self.n)
+        return self.n
+
+    def commit(self):
+        '''Swap staged rows into table, in one transaction.'''
+        if self.stage is None:
+            return self.n
+        with METRICS.timer('db_insert'):
+            return self._swap()
+
+    def _swap(self):
+        cur = self._cursor()
+        cur.execute('delete from %s' % self.table)
+        if self.stage == 'table':
+            if self._cols:
+                cols = ', '.join(self._cols)
+                cur.execute('insert into %s (%s) select %s from %s'
+                            % (self.table, cols, cols,
+                               stage_table_name(self.table)))
+            cur.execute('drop table %s' % stage_table_name(self.table))
+        elif self._cols:
+            self._spool.seek(0)
+            sql = self._insert_sql(self.table)
+            while True:
+                try:
+                    params = pickle.load(self._spool)
+                except EOFError:
+                    break
+                cur.executemany(sql, params)
+        self._conn.commit()
+        return self.n
+
+    def _drop_stage(self):
+        if self.stage == 'table':
+            cur = self._conn.cursor()
+            cur.execute('drop table if exists %s'
+                        % stage_table_name(self.table))
+            self._conn.commit()
+
+def bulk_replace(db_spec, table, rows, batch_size=BATCH_SIZE,
+                 stage=BULK_STAGE, progress=BULK_PROGRESS, create=None):
+    '''Replace the contents of table with rows; see BulkLoader.
+    Returns number of rows written.'''
+    with BulkLoader(db_spec, table, batch_size, stage, progress,
+                    create) as b:
+        b.write(rows)
+    return b.n
@@ -1,19 +1,67 @@
 import collections
+import collections.abc
+import itertools
 import re
 import string
 import sys
-from nltk.tokenize import word_tokenize
-from db3 import *
-from ks3 import *
 
-p06 = None
-try: p06 = slurpj("enclave/p06.json")
-except: pass
+# Nothing heavy is imported here, or by the modules that star-import this
+# one: NLTK, db3/ks3 and the DB config are all loaded on first use (see
+# word_tokenize, dbio, default_db_spec), so scoring alone -- e.g. in a
+# pool worker -- pays for none of them.
+
+# Which tokenizer engine into_word_tokens uses when not told otherwise:
+# 'nltk' (word_tokenize), or 'fast' (single-pass regex engine below; see
+# tokparity.py for checking the two agree on a corpus).
+TOKENIZER = 'nltk'
+
+#-----------------------------------------------------------------------------
+# config
+
+DB_SPEC_PATH = 'enclave/p06.json'
+_db_spec = None
+
+def slurp(path):
+    from ks3 import slurp as f
+    return f(path)
+
+def slurpj(path):
+    from ks3 import slurpj as f
+    return f(path)
+
+def default_db_spec():
+    '''The DB spec at DB_SPEC_PATH, read the first time it's needed.'''
+    global _db_spec
+    if _db_spec is None:
+        _db_spec = slurpj(DB_SPEC_PATH)
+    return _db_spec
+
+def resolve_db_spec(db_spec):
+    '''db_spec, or the default one if None.'''
+    return default_db_spec() if db_spec is None else db_spec
+
+def __getattr__(name):
+    # common.p06 used to be loaded at import (None if unavailable).
+    if name == 'p06':
+        try:
+            return default_db_spec()
+        except Exception:
+            return None
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+#-----------------------------------------------------------------------------
 
 def funcname():
     return sys._getframe(1).f_code.co_name
 
 def is_integer(x):
+    if isinstance(x, str):
+        return token_int(x) is not NOT_INT
+    return _is_integer(x)
+
+def _is_integer(x):
+    if isinstance(x, int):
+        return True
     if x and x[len(x)-1] == '.':
         # Removing trailing period; causes int() to return false 
         # for an otherwise good integer.
@@ -32,36 +80,236 @@ def to_integer(x):
         x = x[:len(x)-1]
     return int(x)
 
-def get_anchor_indices(s, anchors, found=None):
-    '''Specifically, 'trailing' anchor indcies.
-    For each anchor string, get index immediately after its end;
-    return all these indices as a list of ints.
-    NOTE: if anchor occurs mult times, will only find the first
-    one.'''
-    if not found:
-        found = []
-        # if-clause helps to avoid doing below more than once.
-        s = s.lower()
-        anchors = list(map(lambda x: x.lower(), anchors))
-    if len(s) == 0 or len(anchors) == 0:
-        return found
-    anchor = anchors.pop(0)
-    x = s.find(anchor)
-    #print(anchor)
-    #print(x)
-    if x != -1:
-        found.append(x + len(anchor))
-    # Recursive call to process remaining anchor strings.
-    return get_anchor_indices(s, anchors, found)
-
-def into_word_tokens(s, to_lower=True):
+#-----------------------------------------------------------------------------
+# token classes
+# Both FSMs ask of nearly every token whether it's an integer (and which),
+# or one of their keywords. The vocabulary of these reports is small and
+# repeats heavily, so the answers are memoized per token string, making
+# each a single dict lookup; in particular a word no longer costs
+# is_integer an exception.
+
+# Entries a memo may hold; when full, it's cleared and starts over.
+TOKEN_MEMO_MAX = 200000
+
+# token_int results for a token that isn't an integer, and for one that
+# is_integer accepts but int() doesn't (e.g. '2.').
+NOT_INT = 'NOT_INT'
+BAD_INT = 'BAD_INT'
+
+_HAS_DIGIT = re.compile(r'\d').search
+_int_memo = {}
+
+def _token_int(t):
+    if not _HAS_DIGIT(t):
+        return NOT_INT  # int() would raise anyway; skip the exception.
+    if not _is_integer(t):
+        return NOT_INT
+    try:
+        return int(t)
+    except ValueError:
+        return BAD_INT
+
+def token_int(t):
+    '''is_integer(t) and int(t) of token (a str) in one memoized lookup:
+    int(t), or NOT_INT if not is_integer(t), or BAD_INT if int(t) raises
+    even so.'''
+    v = _int_memo.get(t)
+    if v is None:
+        v = _token_int(t)
+        if len(_int_memo) >= TOKEN_MEMO_MAX:
+            _int_memo.clear()
+        _int_memo[t] = v
+    return v
+
+class TokenClasses:
+    '''Memoized token -> class, for one FSM's classes: keywords (a dict
+    of word -> class) first, then classify(token) for any other token.
+    Hot loops use the memo dict directly, falling back to miss():
+
+        cls = memo.get(t)
+        if cls is None:
+            cls = classes.miss(t)
+
+    Call reset() with the new keywords after changing a word list.'''
+
+    def __init__(self, classify, keywords=None, max_size=TOKEN_MEMO_MAX):
+        self.classify = classify
+        self.max_size = max_size
+        self.keywords = {}
+        self.memo = {}
+        self.reset(keywords or {})
+
+    def reset(self, keywords):
+        self.keywords = dict(keywords)
+        self.memo.clear()
+        self.memo.update(self.keywords)
+
+    def miss(self, t):
+        cls = self.classify(t)
+        if len(self.memo) >= self.max_size:
+            self.memo.clear()
+            self.memo.update(self.keywords)
+        self.memo[t] = cls
+        return cls
+
+    def get(self, t):
+        cls = self.memo.get(t)
+        return self.miss(t) if cls is None else cls
+
+#-----------------------------------------------------------------------------
+# work budgets
+# A few notes are huge (pasted pathology, a template repeated many times,
+# an anchor word hundreds of times) and would tie up a worker for
+# seconds. With a budget set, a report that would take more than it is
+# given up on, and scored BUDGET_EXCEEDED instead, to be looked at
+# later. None means no limit; with all three None (the default) scores
+# are exactly as without budgets.
+
+# Most chars of text a report may have.
+MAX_REPORT_CHARS = None
+# Most tokens the FSMs may read, over all of a report's windows.
+MAX_REPORT_TOKENS = None
+# Most anchor matches (places a window starts) a report may have.
+MAX_ANCHOR_STARTS = None
+
+# Score of a report that went over budget.
+BUDGET_EXCEEDED = 'BUDGET EXCEEDED'
+
+class BudgetExceeded(Exception):
+    pass
+
+def work_budget():
+    '''The current limits, for the drivers' rules_version (a budget
+    changes which reports get scores).'''
+    return (MAX_REPORT_CHARS, MAX_REPORT_TOKENS, MAX_ANCHOR_STARTS)
+
+def over_char_budget(text):
+    return (MAX_REPORT_CHARS is not None and isinstance(text, str)
+            and len(text) > MAX_REPORT_CHARS)
+
+class Budget:
+    '''One report's budget, made before any work is done on it (raises
+    BudgetExceeded if text is already too long). Then:
+    o anchors(spans): spans, unless there are too many of them.
+    o wrap(tokens): tokens, counted against the report's token budget as
+      the FSM reads them; raises BudgetExceeded once it's spent.'''
+    __slots__ = ('tokens_left',)
+
+    def __init__(self, text):
+        if over_char_budget(text):
+            raise BudgetExceeded('chars')
+        self.tokens_left = MAX_REPORT_TOKENS
+
+    def anchors(self, spans):
+        if MAX_ANCHOR_STARTS is not None and len(spans) > MAX_ANCHOR_STARTS:
+            raise BudgetExceeded('anchors')
+        return spans
+
+    def wrap(self, tokens):
+        if self.tokens_left is None:
+            return tokens
+        return self._metered(tokens)
+
+    def _metered(self, tokens):
+        for t in tokens:
+            if self.tokens_left <= 0:
+                raise BudgetExceeded('tokens')
+            self.tokens_left -= 1
+            yield t
+
+def token_tail(tokens, i, n=None):
+    '''Iterator over tokens[i:] (tokens[i:i+n] if n is given), without
+    copying the list as the slice would.'''
+    stop = len(tokens) if n is None else min(len(tokens), i + n)
+    return map(tokens.__getitem__, range(i, stop))
+
+#-----------------------------------------------------------------------------
+# anchors
+
+class AnchorMatcher:
+    '''Finds every occurrence of every anchor string in one linear,
+    case-insensitive pass over the raw text. Anchors are grouped under
+    tags (e.g. one tag per score), compiled into a single alternation of
+    named groups, so the regex engine does the multi-pattern scan in C.
+    Longer anchors win where two would match at the same place; matches
+    don't overlap.'''
+
+    def __init__(self, groups):
+        '''groups: dict of tag -> list of anchor strings; tags must be
+        valid identifiers.'''
+        self.groups = dict((k, list(v)) for k, v in groups.items())
+        alts = []
+        for tag, anchors in self.groups.items():
+            pats = sorted(set(a.lower() for a in anchors), key=len,
+                          reverse=True)
+            if pats:
+                alts.append('(?P<%s>%s)' % (tag, '|'.join(map(re.escape, pats))))
+        self._re = re.compile('|'.join(alts) or '(?!)', re.IGNORECASE)
+
+    def finditer(self, text):
+        '''Yields (tag, start, end) for each occurrence, in text order.'''
+        for m in self._re.finditer(text):
+            yield (m.lastgroup, m.start(), m.end())
+
+    def index(self, text):
+        '''Returns dict of tag -> list of (start, end), for the tags
+        found in text only.'''
+        out = {}
+        for tag, b, e in self.finditer(text):
+            out.setdefault(tag, []).append((b, e))
+        return out
+
+# Anchors of every extractor, registered at import, so one pass over a
+# report finds all of them (see anchor_index).
+_anchor_groups = {}
+_shared_matcher = None
+
+def register_anchors(tag, anchors):
+    global _shared_matcher
+    _anchor_groups[tag] = list(anchors)
+    _shared_matcher = None
+
+def anchor_index(text):
+    '''Every registered anchor in text, via one shared AnchorMatcher.
+    Returns dict of tag -> list of (start, end).'''
+    global _shared_matcher
+    if _shared_matcher is None:
+        _shared_matcher = AnchorMatcher(_anchor_groups)
+    return _shared_matcher.index(text)
+
+_matcher_cache = {}
+
+def get_anchor_indices(s, anchors):
+    '''Specifically, 'trailing' anchor indices.
+    For every occurrence of every anchor string (case-insensitive), get
+    the index immediately after its end; return all these indices, in
+    text order, as a list of ints.'''
+    key = tuple(anchors)
+    if key not in _matcher_cache:
+        _matcher_cache[key] = AnchorMatcher({'a': key})
+    return [e for tag, b, e in _matcher_cache[key].finditer(s)]
+
+_nltk_word_tokenize = None
+
+def word_tokenize(s):
+    '''nltk's word_tokenize, imported on first use.'''
+    global _nltk_word_tokenize
+    if _nltk_word_tokenize is None:
+        from nltk.tokenize import word_tokenize as f
+        _nltk_word_tokenize = f
+    return _nltk_word_tokenize(s)
+
+def into_word_tokens(s, to_lower=True, engine=None):
     '''
     Tokenize s to list of words with punctuation removed.
     (And convert to lowercase when is_lower is True.)
+    o engine: 'nltk' or 'fast'; defaults to TOKENIZER.
     Returns list of strings.
     '''
     if not isinstance(s, str):
         raise TypeError('s needs to be a string')
+    if (engine or TOKENIZER) == 'fast':
+        return fast_word_tokens(s, None, to_lower)
     tokens = word_tokenize(s)
     if to_lower:
         tokens = map(lambda x: x.lower(), tokens)
@@ -76,7 +324,7 @@ def into_word_tokens(s, to_lower=True):
     return list(filter(lambda x: x not in string.punctuation,
                        tokens))
 
-def into_word_tokens_with_splitters(s, splitters, to_lower=True):
+def into_word_tokens_with_splitters(s, splitters, to_lower=True, engine=None):
     '''Calls into_word_tokens (above), and then goes through the 
     results and splits words again whenever they contain a char
     found in the splitters list.
@@ -93,28 +341,251 @@ def into_word_tokens_with_splitters(s, splitters, to_lower=True):
             they contain more than one of the elements found
             in splitters, e.g.,
                 'foo-bar:1' --> 'foo', 'bar', '1'
+    o engine: as for into_word_tokens.
     Returns list of strings.
     '''
-    if not isinstance(splitters, collections.Sequence):
+    if not isinstance(splitters, collections.abc.Sequence):
         raise TypeError
-    tokens = into_word_tokens(s, to_lower)
-    def replace_insert_mult(list_a, list_a_index, list_b):
-        '''Replace item at list_a_index from list_a, with
-        one or more items.'''
-        list_a[list_a_index:list_a_index + 1] = list_b
+    if (engine or TOKENIZER) == 'fast':
+        if not isinstance(s, str):
+            raise TypeError('s needs to be a string')
+        return fast_word_tokens(s, splitters, to_lower)
+    tokens = into_word_tokens(s, to_lower, 'nltk')
+    if not splitters:
+        return tokens
+    # One pass, building a new list; splicing pieces back into tokens
+    # in place is quadratic on long reports.
+    spl = _splitter_search(splitters)
+    out = []
+    for t in tokens:
+        if spl(t):
+            out.extend(split_on_splitters(t, splitters))
+        else:
+            out.append(t)
+    return out
+
+def iter_word_tokens(s, pos=0, splitters=None, to_lower=True,
+                     engine=None, endpos=None):
+    '''Returns an iterator over the tokens of s[pos:endpos], produced
+    on demand (with splitters applied if given), so a caller that stops
+    early doesn't pay to tokenize the rest of s. Lazy only with the fast engine; the
+    NLTK engine has to tokenize the whole span up front.
+    Quotes at pos are judged by the char before them in s, which only
+    matters if pos isn't at a whitespace boundary.'''
+    if not isinstance(s, str):
+        raise TypeError('s needs to be a string')
+    if (engine or TOKENIZER) == 'fast':
+        return iter_fast_word_tokens(s, splitters, to_lower, pos, endpos)
+    s = s[pos:endpos]
+    if splitters:
+        return iter(into_word_tokens_with_splitters(s, splitters, to_lower,
+                                                    'nltk'))
+    return iter(into_word_tokens(s, to_lower, 'nltk'))
+
+def tokenizer_engine(engine=None):
+    '''The engine iter_word_tokens etc. will actually use.'''
+    return engine or TOKENIZER
+
+def is_lazy_engine(engine=None):
+    '''True when iter_word_tokens is actually lazy for engine.'''
+    return (engine or TOKENIZER) == 'fast'
+
+def split_on_splitters(t, splitters):
+    '''Split t on each of splitters in turn (same result as the
+    original splice-per-splitter loop). Returns list of strings.'''
+    pieces = [t]
     for sp in splitters:
-        # Identify replacements first; after all found, we'll walk 
-        # backwards from end of tokens to front. (Beginning to end
-        # would modify indexing before we have a chance to replace
-        # everything.)
-        to_replace = []
-        for i, t in enumerate(tokens):
-            if sp in t:
-                to_replace.append( (i, t.split(sp)) )
-        for tup in reversed(to_replace):
-            replace_insert_mult(tokens, tup[0], tup[1])
-    return tokens
+        pieces = [q for p in pieces for q in p.split(sp)]
+    return pieces
+
+_splitter_cache = {}
+
+def _splitter_search(splitters):
+    '''Compiled test for "token contains any of splitters".'''
+    key = tuple(splitters)
+    if key not in _splitter_cache:
+        _splitter_cache[key] = re.compile(
+            '|'.join(map(re.escape, key))).search
+    return _splitter_cache[key]
+
+#-----------------------------------------------------------------------------
+# fast tokenizer engine
+# A single regex sweep emulating what word_tokenize + the post-processing
+# in into_word_tokens produce, without Punkt sentence splitting or the
+# ~20 regex substitutions word_tokenize makes over each sentence.
+# Lowercasing, period chomping, punctuation filtering, and splitting on
+# splitters are all done per token in the same loop.
+
+# Chars word_tokenize always splits off as tokens of their own.
+_SPLIT_CHARS = (r';@#$%&?!*()\[\]{}<>"'
+                '\u00ab\u201c\u2018\u201e\u00bb\u201d\u2019'
+                '\u2012-\u2015')
+
+_FAST_TOKEN_RE = re.compile(
+    r'--'                  # double dash
+    r'|\.{2,}'             # ellipsis
+    r'|`+'                 # backtick quotes
+    r"|''"                 # same as a double quote
+    r'|[' + _SPLIT_CHARS + r']'
+    r'|(?P<pairs>(?:[:,][:,])+)'   # see iter_fast_word_tokens
+    r'|[:,](?!\d)'         # colon/comma, except before a digit
+    r'|(?P<word>(?:[^\s' + _SPLIT_CHARS + r"`:,.\-']+"
+    r'|[:,](?=\d)|\.(?!\.)|-(?!-)|\'(?!\'))+)')
+
+# word_tokenize's rules for single quotes, applied only to the (rare)
+# words containing one: quote off the front of a word unless it looks
+# like a clitic, quote off the end, and clitics off the end.
+_QUOTE_RULES = [
+    (re.compile(r"(?i)(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)"), r"\1 "),
+    (re.compile(r"([^'])' "), r"\1 ' "),
+    (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+    (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 "),
+]
+
+# Whole words word_tokenize splits in two; value is where.
+_WORD_SPLITS = {'cannot': 3, "d'ye": 1, 'gimme': 3, 'gonna': 3,
+                'gotta': 3, 'lemme': 3, "more'n": 4, 'wanna': 3,
+                "'tis": 2, "'twas": 2}
+
+# Preceding chars that make a double quote an opening quote.
+_OPEN_QUOTE_AFTER = ' ([{<`\u00ab\u201c\u2018\u201e'
+
+def fast_word_tokens(s, splitters=None, to_lower=True):
+    '''Fast engine behind into_word_tokens / into_word_tokens_with_splitters
+    (pass splitters=None for the former). Returns list of strings.'''
+    return list(iter_fast_word_tokens(s, splitters, to_lower))
+
+def iter_fast_word_tokens(s, splitters=None, to_lower=True,
+                          pos=0, endpos=None):
+    '''Generator form of fast_word_tokens over s[pos:endpos]; see
+    iter_word_tokens.'''
+    if endpos is None:
+        endpos = len(s)
+    spl = _splitter_search(splitters) if splitters else None
+    punct = string.punctuation
+    carry = None
+    for m in _FAST_TOKEN_RE.finditer(s, pos, endpos):
+        t = m.group()
+        if to_lower:
+            t = t.lower()
+        if carry:
+            # word_tokenize splits a colon/comma off together with the char
+            # after it, so in a run of them every second one escapes being
+            # split and sticks to the word that follows.
+            if m.lastgroup == 'word' and m.start() == carry[1]:
+                t = carry[0] + t
+            carry = None
+        if m.lastgroup == 'pairs':
+            carry = (t[-1], m.end())
+            continue
+        if t == '"' or t == "''":
+            i = m.start()
+            if (i == 0 and t == '"') or (i and s[i-1] in _OPEN_QUOTE_AFTER):
+                t = '``'
+            else:
+                t = "''"
+        if "'" in t and len(t) > 1 and t != "''":
+            words = _split_quotes(t)
+        else:
+            words = (t,)
+        for w in words:
+            if w[-1] == '.':
+                w = w[:-1]
+            if w in punct:
+                continue
+            if w.lower() in _WORD_SPLITS:
+                k = _WORD_SPLITS[w.lower()]
+                pieces = (w[:k], w[k:])
+            else:
+                pieces = (w,)
+            for p in pieces:
+                if spl and spl(p):
+                    yield from split_on_splitters(p, splitters)
+                else:
+                    yield p
+
+def _split_quotes(t):
+    t = _QUOTE_RULES[0][0].sub(_QUOTE_RULES[0][1], t)
+    t = ' ' + t + ' '
+    for rx, sub in _QUOTE_RULES[1:]:
+        t = rx.sub(sub, t)
+    return t.split()
 
 def indices_for(tokens, t_of_interest):
     return [i for i, t in enumerate(tokens) if t == t_of_interest] 
 
+_CHUNK_END_RE = re.compile(r'\S*')
+
+def anchor_token_windows(text, spans, words, splitters=None):
+    '''Generator; for each token of text that is one of words, in order,
+    yields a lazy token stream that starts at it and runs to the end of
+    text -- the same tokens as tokens[i:] for each such i in the whole
+    text's tokens. Only the whitespace-delimited chunks around spans
+    (char offsets of the words, e.g. from anchor_index) are tokenized up
+    front; the rest only as far as the stream is read.'''
+    last = None
+    for start, end in spans:
+        b = start
+        while b > 0 and not text[b-1].isspace():
+            b -= 1
+        if b == last:
+            # chunk has more than one of words in it; already done.
+            continue
+        last = b
+        e = _CHUNK_END_RE.match(text, start).end()
+        chunk = list(iter_word_tokens(text, b, splitters, endpos=e))
+        for j, t in enumerate(chunk):
+            if t in words:
+                yield itertools.chain(chunk[j:],
+                                      iter_word_tokens(text, e, splitters))
+
+
+def chunked(iterable, size):
+    '''Yield lists of up to size items from iterable, without
+    materializing the whole iterable.'''
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def like_any(column, words):
+    '''SQL predicate that's true when column contains any of words,
+    e.g. like_any('notes', ['a', 'b']) -->
+        "notes like '%a%' or notes like '%b%'"'''
+    return ' or '.join("%s like '%%%s%%'" % (column, w) for w in words)
+
+def mentions_any(text, words):
+    '''Python equivalent of like_any (case-insensitive, as the LIKE
+    is under our database collation).'''
+    s = text.lower()
+    return any(w in s for w in words)
+
+class Report:
+    '''Report text plus memoized tokenizations and anchor index, so that
+    several extractors can share a single pass over one report.'''
+    __slots__ = ('text', '_tokens', '_anchors')
+
+    def __init__(self, text):
+        self.text = text
+        self._tokens = {}
+        self._anchors = None
+
+    def anchors(self, tag):
+        '''List of (start, end) for tag's anchors; see anchor_index.'''
+        if self._anchors is None:
+            self._anchors = anchor_index(self.text)
+        return self._anchors.get(tag, [])
+
+    def tokens(self, splitters=()):
+        key = tuple(splitters)
+        if key not in self._tokens:
+            if key:
+                self._tokens[key] = into_word_tokens_with_splitters(
+                    self.text, list(key))
+            else:
+                self._tokens[key] = into_word_tokens(self.text)
+        return self._tokens[key]
@@ -0,0 +1,552 @@
+'''DB helpers for things db3 doesn't give us directly: streaming
+reads through a server-side (forward-only) cursor, chunked writes, and
+a connection pool.'''
+import contextlib
+import datetime
+import decimal
+import os
+import re
+import threading
+import time
+from common import *
+from instrument import *
+from records import *
+
+# Rows pulled from the server per round trip when streaming.
+FETCH_SIZE = 5000
+
+# Rows handed to db_insert_many per call when writing in chunks.
+CHUNK_SIZE = 5000
+
+#-----------------------------------------------------------------------------
+# db3
+# db3 is only imported when first used, so modules that just score never
+# load it. A db_spec of None means the default one (common.default_db_spec)
+# here and in everything below; a ConnectionPool (see below) may be given
+# instead of a db_spec anywhere, and then no db3 is involved at all.
+# db3 opens a connection per call and hands none out, so what needs a
+# connection of its own (streaming reads, bulk loads, upserts, pools)
+# opens one from the db_spec itself; see db_connect.
+
+def _db3():
+    import db3
+    return db3
+
+def db_qy(db_spec, *args, **kw):
+    if isinstance(db_spec, ConnectionPool):
+        return db_spec.qy(*args, **kw)
+    return _db3().db_qy(resolve_db_spec(db_spec), *args, **kw)
+
+def db_stmt(db_spec, *args, **kw):
+    if isinstance(db_spec, ConnectionPool):
+        return db_spec.stmt(*args, **kw)
+    return _db3().db_stmt(resolve_db_spec(db_spec), *args, **kw)
+
+def db_insert_many(db_spec, *args, **kw):
+    if isinstance(db_spec, ConnectionPool):
+        return db_spec.insert_many(*args, **kw)
+    return _db3().db_insert_many(resolve_db_spec(db_spec), *args, **kw)
+
+def db_trunc_table(db_spec, *args, **kw):
+    if isinstance(db_spec, ConnectionPool):
+        return db_spec.trunc_table(*args, **kw)
+    return _db3().db_trunc_table(resolve_db_spec(db_spec), *args, **kw)
+
+def db_drop_table(db_spec, *args, **kw):
+    if isinstance(db_spec, ConnectionPool):
+        return db_spec.drop_table(*args, **kw)
+    return _db3().db_drop_table(resolve_db_spec(db_spec), *args, **kw)
+
+def db_table_from_fqtn(*args, **kw):
+    return _db3().db_table_from_fqtn(*args, **kw)
+
+#-----------------------------------------------------------------------------
+# connections
+
+# Keys a db_spec needs (besides whatever db3 reads) for db_connect to
+# open a connection from it: 'sqlite' (path of a local stand-in), or
+# 'conn_str' (an ODBC connection string), or all of these (plus,
+# optionally, 'driver'; default ODBC Driver 17 for SQL Server).
+ODBC_KEYS = ('host', 'db', 'user', 'password')
+
+def can_connect(db_spec):
+    '''True if db_connect can open connections for db_spec.'''
+    if isinstance(db_spec, ConnectionPool):
+        return True
+    db_spec = resolve_db_spec(db_spec)
+    return ('sqlite' in db_spec or 'conn_str' in db_spec
+            or all(k in db_spec for k in ODBC_KEYS))
+
+def check_db_spec(db_spec):
+    '''Raise ValueError unless db_connect can open connections for
+    db_spec.'''
+    if not can_connect(db_spec):
+        missing = [k for k in ODBC_KEYS if k not in resolve_db_spec(db_spec)]
+        raise ValueError(
+            'db_spec has no connection details, which streaming,'
+            ' incremental, bulk, pooled and sharded runs need: give it'
+            ' conn_str (an ODBC connection string), or %s (missing: %s),'
+            ' or sqlite (a path)' % ('/'.join(ODBC_KEYS), ', '.join(missing)))
+
+def db_connect(db_spec):
+    '''Open a new DB-API connection for db_spec (see ODBC_KEYS; checked
+    first, see check_db_spec). If db_spec has a 'conn_str' it is used
+    as-is; otherwise the ODBC connection string is built from
+    driver/host/db/user/password.
+    A db_spec with a 'sqlite' path instead opens that SQLite database,
+    as a local stand-in (see SqliteConnection).
+    Given a ConnectionPool, returns one of its connections instead;
+    closing that hands it back.'''
+    if isinstance(db_spec, ConnectionPool):
+        return db_spec.connect()
+    db_spec = resolve_db_spec(db_spec)
+    check_db_spec(db_spec)
+    if is_sqlite(db_spec):
+        return SqliteConnection(db_spec['sqlite'])
+    import pyodbc
+    if 'conn_str' in db_spec:
+        return pyodbc.connect(db_spec['conn_str'])
+    return pyodbc.connect(
+        driver=db_spec.get('driver', '{ODBC Driver 17 for SQL Server}'),
+        server=db_spec['host'],
+        database=db_spec['db'],
+        uid=db_spec['user'],
+        pwd=db_spec['password'])
+
+def is_sqlite(db_spec):
+    if isinstance(db_spec, ConnectionPool):
+        db_spec = db_spec.db_spec
+    return 'sqlite' in resolve_db_spec(db_spec)
+
+# db.schema.table, optionally [bracketed]; SQLite has no such names.
+_FQTN_RE = re.compile(r'(?:\[?\w+\]?\.){2}(\[?\w+\]?)')
+
+class SqliteConnection:
+    '''sqlite3 connection whose cursors rewrite three-part table names
+    (dm_cadc.ibd.x) to bare ones (x), so the SQL we send SQL Server runs
+    unchanged against a local SQLite stand-in for tests.'''
+
+    def __init__(self, path):
+        import sqlite3
+        # Any thread may use it (one at a time), as pooled connections are.
+        self.conn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False)
+        # Stand-in for SQL Server's checksum() (see shards); a different
+        # hash, but just as stable.
+        self.conn.create_function('checksum', 1, _checksum,
+                                  deterministic=True)
+
+    def cursor(self):
+        return _SqliteCursor(self.conn.cursor())
+
+    def executescript(self, sql):
+        self.conn.executescript(_FQTN_RE.sub(r'\1', sql))
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+def _checksum(v):
+    import zlib
+    return zlib.crc32(str(v).encode('utf-8')) - 0x80000000
+
+class _SqliteCursor:
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, sql, params=()):
+        return self.cur.execute(_FQTN_RE.sub(r'\1', sql), params)
+
+    def executemany(self, sql, params):
+        return self.cur.executemany(_FQTN_RE.sub(r'\1', sql), params)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+#-----------------------------------------------------------------------------
+# connection pool
+
+# Most connections a pool has open at once; a caller wanting one more
+# waits up to POOL_TIMEOUT seconds for one to be handed back.
+POOL_MAX_SIZE = 8
+POOL_TIMEOUT = 60
+
+# An idle connection unused this long is checked (select 1) before it's
+# handed out again, and replaced if dead.
+POOL_CHECK_AFTER = 30
+
+class ConnectionPool:
+    '''Connections to one database, opened on demand and reused, so a
+    run authenticates a fixed number of times rather than once per
+    operation. Pass a pool wherever a db_spec goes (every helper here,
+    bulkload, the drivers); db_connect(pool) hands out a connection that
+    goes back to the pool when closed.
+    o A connection is only ever used by one caller at a time, so the
+      threads of a pipelined run each get their own.
+    o In a forked worker process the pool starts over empty, so each
+      worker has its own connections rather than its parent's.
+    o max_size bounds the connections open at once (see POOL_MAX_SIZE);
+      idle ones are health-checked (see POOL_CHECK_AFTER).
+    Use as a context manager, or call close() when done.'''
+
+    def __init__(self, db_spec=None, max_size=POOL_MAX_SIZE,
+                 check_after=POOL_CHECK_AFTER, timeout=POOL_TIMEOUT):
+        self.db_spec = resolve_db_spec(db_spec)
+        check_db_spec(self.db_spec)
+        self.max_size = max_size
+        self.check_after = check_after
+        self.timeout = timeout
+        self.opened = 0
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._idle = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+        return False
+
+    def _open(self):
+        conn = db_connect(self.db_spec)
+        self.opened += 1
+        if METRICS.on:
+            METRICS.inc('db.connections')
+        return conn
+
+    def _healthy(self, conn):
+        try:
+            cur = conn.cursor()
+            cur.execute('select 1')
+            cur.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        '''A raw connection, for exclusive use until release(conn).'''
+        if os.getpid() != self._pid:
+            # Forked: the parent's connections aren't ours to use.
+            self._reset()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError('no connection free in %g seconds (pool of %d)'
+                               % (self.timeout, self.max_size))
+        try:
+            with self._lock:
+                conn, last = self._idle.pop() if self._idle else (None, None)
+            if conn is not None and time.time() - last > self.check_after:
+                if not self._healthy(conn):
+                    self._close_quietly(conn)
+                    conn = None
+            return conn if conn is not None else self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        '''Hand conn back; anything it left uncommitted is rolled back.'''
+        try:
+            conn.rollback()
+        except Exception:
+            # Broken; drop it rather than hand it out again.
+            self._close_quietly(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        self._slots.release()
+
+    def connect(self):
+        '''A connection whose close() hands it back (see db_connect).'''
+        return PooledConnection(self, self.acquire())
+
+    def close(self):
+        '''Close the idle connections. Ones in use are closed when
+        they're handed back.'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    #-------------------------------------------------------------------------
+    # db3 equivalents (see the db3 wrappers above)
+
+    def qy(self, qy, params=()):
+        '''List of dicts, one per row.'''
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(qy, params)
+            cols = [d[0] for d in cur.description]
+            return [dict(zip(cols, rec)) for rec in cur.fetchall()]
+        finally:
+            conn.close()
+
+    def stmt(self, sql):
+        conn = self.connect()
+        try:
+            if is_sqlite(self.db_spec):
+                conn.executescript(sql)
+            else:
+                conn.cursor().execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def insert_many(self, table, rows):
+        '''Insert rows (list of dicts, all with the same keys).'''
+        if not rows:
+            return
+        cols = list(rows[0])
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            if not is_sqlite(self.db_spec):
+                cur.fast_executemany = True
+            cur.executemany('insert into %s (%s) values (%s)'
+                            % (table, ', '.join(cols),
+                               ', '.join('?' * len(cols))),
+                            [tuple(r[c] for c in cols) for r in rows])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def trunc_table(self, table):
+        if is_sqlite(self.db_spec):
+            self.stmt('delete from %s' % table)
+        else:
+            self.stmt('truncate table %s' % table)
+
+    def drop_table(self, schema, table):
+        if is_sqlite(self.db_spec):
+            self.stmt('drop table if exists %s' % table)
+        else:
+            self.stmt('drop table if exists %s.%s' % (schema, table))
+
+class PooledConnection:
+    '''A pool's connection; close() hands it back to the pool.'''
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+@contextlib.contextmanager
+def pooled(db_spec, connections=False):
+    '''Context manager for a driver run: yields db_spec if it's already
+    a ConnectionPool (left open), else a new pool for it, closed on exit.
+    A db_spec db_connect can't open connections for (see ODBC_KEYS) is
+    yielded as it is, for db3 to use -- unless the run needs connections
+    (streaming, incremental, bulk), in which case it's an error, raised
+    here, before the run starts.'''
+    if isinstance(db_spec, ConnectionPool):
+        yield db_spec
+        return
+    db_spec = resolve_db_spec(db_spec)
+    if not can_connect(db_spec):
+        if connections:
+            check_db_spec(db_spec)
+        yield db_spec
+        return
+    pool = ConnectionPool(db_spec)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+#-----------------------------------------------------------------------------
+# streaming reads, chunked writes
+
+def db_qy_stream(db_spec, qy, fetch_size=FETCH_SIZE, params=()):
+    '''Like db_qy, but a generator: yields one dict per row, pulling
+    fetch_size rows at a time through a forward-only cursor, so only
+    one batch is held client-side at any time.
+    o params: values for any ? placeholders in qy.'''
+    conn = db_connect(db_spec)
+    try:
+        cur = conn.cursor()
+        with METRICS.timer('db_qy'):
+            cur.execute(qy, params)
+        cols = [d[0] for d in cur.description]
+        while True:
+            with METRICS.timer('db_qy'):
+                batch = cur.fetchmany(fetch_size)
+            if not batch:
+                break
+            for rec in batch:
+                yield dict(zip(cols, rec))
+        cur.close()
+    finally:
+        conn.close()
+
+def db_insert_chunked(db_spec, table, rows, chunk_size=CHUNK_SIZE):
+    '''Consume rows (any iterable of dicts, or a records.RecordBatch)
+    and write them to table chunk_size at a time via db_insert_many.
+    Returns number of rows written.'''
+    if isinstance(rows, RecordBatch):
+        # Only chunk_size rows at a time are turned back into dicts.
+        chunks = (rows.dicts(i, i + chunk_size)
+                  for i in range(0, len(rows), chunk_size))
+    else:
+        chunks = chunked(rows, chunk_size)
+    n = 0
+    for chunk in chunks:
+        with METRICS.timer('db_insert'):
+            db_insert_many(db_spec, table, chunk)
+        n += len(chunk)
+    return n
+
+def db_upsert_many(db_spec, table, key_cols, rows):
+    '''Replace rows (list of dicts, all with the same keys) in table:
+    delete any existing rows with the same key_cols values, then insert
+    rows -- on one connection, in one transaction, so a failure in
+    between loses nothing and readers never see the rows missing.'''
+    if not rows:
+        return
+    cols = list(rows[0])
+    where = ' and '.join('%s = ?' % k for k in key_cols)
+    conn = db_connect(db_spec)
+    try:
+        cur = conn.cursor()
+        if not is_sqlite(db_spec):
+            cur.fast_executemany = True
+        cur.executemany('delete from %s where %s' % (table, where),
+                        [tuple(r[k] for k in key_cols) for r in rows])
+        cur.executemany('insert into %s (%s) values (%s)'
+                        % (table, ', '.join(cols), ', '.join('?' * len(cols))),
+                        [tuple(r[c] for c in cols) for r in rows])
+        conn.commit()
+    finally:
+        conn.close()
+
+def db_upsert_chunked(db_spec, table, key_cols, rows, chunk_size=CHUNK_SIZE):
+    '''Like db_insert_chunked, but each chunk replaces any existing rows
+    with the same key_cols (see db_upsert_many), so re-scored rows
+    replace their old scores. Returns number of rows written.'''
+    n = 0
+    for chunk in chunked(rows, chunk_size):
+        with METRICS.timer('db_insert'):
+            db_upsert_many(db_spec, table, key_cols, chunk)
+        n += len(chunk)
+    return n
+
+#-----------------------------------------------------------------------------
+# watermarks
+# Per-extractor high-water mark (on its WATERMARK_COLUMN) of the source
+# rows already scored, for incremental runs.
+
+WATERMARK_TABLE = 'dm_cadc.ibd.endoscopy_extract_watermarks'
+
+def slurp_ddl(db_spec, path):
+    '''The DDL in path (sql/x.sql), or in sql/sqlite/x.sql if db_spec is
+    a SQLite stand-in (see db_connect) and there is one. The SQLite DDL
+    ships with the repo, so it's read directly, not through ks3.'''
+    if is_sqlite(db_spec):
+        alt = os.path.join(os.path.dirname(path), 'sqlite',
+                           os.path.basename(path))
+        if os.path.exists(alt):
+            with open(alt) as f:
+                return f.read()
+    return slurp(path)
+
+def make_watermark_table(db_spec):
+    '''Create WATERMARK_TABLE if it doesn't exist. Once per run, before
+    any db_get_watermark or db_set_watermark.'''
+    db_stmt(db_spec, slurp_ddl(db_spec,
+                               'sql/make-endoscopy-watermarks-table.sql'))
+
+# Watermarks are stored as text, tagged with their type (e.g.
+# 'date:2020-01-02'), so they come back as what was stored and compare
+# with the column's values. An int, or an integral Decimal (pyodbc's
+# type for NUMERIC columns), is stored bare. Untagged text from before
+# the tags is read back as an int if it looks like one, else as a str.
+_WATERMARK_TYPES = [('datetime', datetime.datetime,
+                     datetime.datetime.isoformat,
+                     datetime.datetime.fromisoformat),
+                    ('date', datetime.date, datetime.date.isoformat,
+                     datetime.date.fromisoformat),
+                    ('decimal', decimal.Decimal, str, decimal.Decimal),
+                    ('float', float, repr, float),
+                    ('str', str, str, str)]
+
+def encode_watermark(value):
+    if isinstance(value, decimal.Decimal) and value.is_finite() \
+       and value == value.to_integral_value():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    for tag, typ, fmt, parse in _WATERMARK_TYPES:
+        if isinstance(value, typ):
+            return tag + ':' + fmt(value)
+    raise TypeError('unsupported watermark type: %s' % type(value).__name__)
+
+def decode_watermark(text):
+    tag, sep, rest = text.partition(':')
+    if sep:
+        for t, typ, fmt, parse in _WATERMARK_TYPES:
+            if t == tag:
+                return parse(rest)
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+def db_get_watermark(db_spec, extractor):
+    '''Returns extractor's watermark (see encode_watermark), or None if
+    it has none yet.'''
+    conn = db_connect(db_spec)
+    try:
+        cur = conn.cursor()
+        cur.execute('select watermark from %s where extractor = ?'
+                    % WATERMARK_TABLE, (extractor,))
+        rec = cur.fetchone()
+    finally:
+        conn.close()
+    if rec is None:
+        return None
+    return decode_watermark(rec[0])
+
+def db_set_watermark(db_spec, extractor, value):
+    conn = db_connect(db_spec)
+    try:
+        cur = conn.cursor()
+        cur.execute('delete from %s where extractor = ?' % WATERMARK_TABLE,
+                    (extractor,))
+        cur.execute('insert into %s (extractor, watermark) values (?, ?)'
+                    % WATERMARK_TABLE, (extractor, encode_watermark(value)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def track_max(rows, col, box):
+    '''Pass rows through unchanged, keeping the max non-null value of
+    col seen so far in box[0]. Start box off as [None]: only values
+    fetched this run are compared, never the stored watermark.'''
+    for row in rows:
+        v = row[col]
+        if v is not None and (box[0] is None or v > box[0]):
+            box[0] = v
+        yield row
@@ -0,0 +1,186 @@
+'''Single pass over dm_cadc.ibd.endoscopy_unfinished for every score that
+is extracted from its notes: one query (the OR of all the extractors'
+prefilters), one tokenization per report shared by all extractors, and
+one write per destination table.
+
+To add a score here, give its module PREFILTERS, SCORE_COLUMN,
+DEST_TABLE, reset_dest_table(db_spec) and score_report(report), and
+list it in EXTRACTORS.
+
+With ENGINE = 'rules', reports are scored by one rules.RuleEngine
+compiled from the extractors' rules instead of by each extractor in
+turn; the results are the same.
+'''
+import contextlib
+import sys
+from common import *
+from etl import *
+import endoscopy_mayo
+import endoscopy_rutgeerts
+import rules
+
+EXTRACTORS = [endoscopy_mayo, endoscopy_rutgeerts]
+
+# Carried through from the source row to every destination table.
+ID_COLUMNS = ['empi', 'proc_date', 'proc_code', 'order_proc_id']
+
+def pertinent_qy(extractors=EXTRACTORS):
+    words = [w for x in extractors for w in x.PREFILTERS]
+    return ("select empi, [Procedure Date] as proc_date, "
+            " [Procedure Code] as proc_code, order_proc_id,"
+            " notes as rpt"
+            " from dm_cadc.ibd.endoscopy_unfinished"
+            " where " + like_any('notes', words))
+
+# How find_scores scores a report: 'modules' (each extractor's
+# score_report) or 'rules' (see compile_rule_engine).
+ENGINE = 'modules'
+_rule_engine = None
+
+def compile_rule_engine():
+    '''Compile EXTRACTORS' rules (see rules.rule_for) into the engine
+    find_scores uses when ENGINE is 'rules'. Done on first use; call
+    again after changing any of their tunables.'''
+    global _rule_engine
+    _rule_engine = rules.compile_rules(EXTRACTORS)
+    return _rule_engine
+
+def find_scores(text):
+    '''Run every extractor whose prefilter text passes (so results match
+    running that extractor's own driver) over a single shared Report.
+    Their anchors (which are their prefilter words) are all found in one
+    scan of the text. Returns dict of SCORE_COLUMN -> score.'''
+    if ENGINE == 'rules':
+        return (_rule_engine or compile_rule_engine()).find_scores(text)
+    report = Report(text)
+    out = {}
+    for x in EXTRACTORS:
+        if report.anchors(x.SCORE_COLUMN):
+            out[x.SCORE_COLUMN] = x.score_report(report)
+    return out
+
+def score_row(row):
+    '''Replaces the report text in row with one entry per applicable
+    score. Returns the (mutated) row.'''
+    scores = find_scores(row.pop('rpt'))
+    row.update(scores)
+    return row
+
+def write_split(db_spec, rows, chunk_size=CHUNK_SIZE, upsert=False,
+                bulk=False):
+    '''Route each scored row to the destination table of every score it
+    carries, writing each table chunk_size rows at a time (replacing
+    rows with the same KEY_COLUMNS first, if upsert). If bulk, each
+    table's rows are staged and swapped in at the end instead (see
+    bulkload.BulkLoader); one table after the other, not jointly.
+    Returns dict of SCORE_COLUMN -> rows written.'''
+    bufs = dict((x.SCORE_COLUMN, []) for x in EXTRACTORS)
+    counts = dict((x.SCORE_COLUMN, 0) for x in EXTRACTORS)
+    with contextlib.ExitStack() as stack:
+        loaders = {}
+        if bulk:
+            for x in EXTRACTORS:
+                loaders[x.SCORE_COLUMN] = stack.enter_context(
+                    BulkLoader(db_spec, x.DEST_TABLE, chunk_size,
+                               create=x.reset_dest_table))
+        def flush(x):
+            buf = bufs[x.SCORE_COLUMN]
+            if buf:
+                if bulk:
+                    loaders[x.SCORE_COLUMN].write(buf)
+                else:
+                    with METRICS.timer('db_insert'):
+                        if upsert:
+                            db_upsert_many(db_spec, x.DEST_TABLE,
+                                           x.KEY_COLUMNS, buf)
+                        else:
+                            db_insert_many(db_spec, x.DEST_TABLE, buf)
+                counts[x.SCORE_COLUMN] += len(buf)
+                bufs[x.SCORE_COLUMN] = []
+        for row in rows:
+            for x in EXTRACTORS:
+                col = x.SCORE_COLUMN
+                if col in row:
+                    rec = dict((k, row[k]) for k in ID_COLUMNS)
+                    rec[col] = row[col]
+                    bufs[col].append(rec)
+                    if len(bufs[col]) >= chunk_size:
+                        flush(x)
+        for x in EXTRACTORS:
+            flush(x)
+    return counts
+
+def reset_dest_tables(db_spec):
+    for x in EXTRACTORS:
+        x.reset_dest_table(db_spec)
+
+def run_incremental(db_spec, fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE,
+                    workers=1, full_rebuild=False, cache=None,
+                    pipelined=False):
+    '''Combined counterpart of etl.run_incremental: one fetch from the
+    lowest of the extractors' watermarks (all extractors here read the
+    same source, so share a WATERMARK_COLUMN); every extractor's
+    watermark is then advanced to the highest value seen. As there,
+    reports edited in place aren't picked up.
+    Returns dict of SCORE_COLUMN -> rows written.'''
+    qy = pertinent_qy()
+    col = EXTRACTORS[0].WATERMARK_COLUMN
+    make_watermark_table(db_spec)
+    wms = [None if full_rebuild else db_get_watermark(db_spec, x.SCORE_COLUMN)
+           for x in EXTRACTORS]
+    wm = None if None in wms else min(wms)
+    high = [None]
+    def source():
+        if wm is None:
+            rows = db_qy_stream(db_spec, qy, fetch_size)
+        else:
+            rows = db_qy_stream(db_spec, incremental_qy(qy, col), fetch_size,
+                                (wm,))
+        return track_max(rows, col, high)
+    if wm is None:
+        reset_dest_tables(db_spec)
+    counts = run_stages(
+        source,
+        lambda rows: score_all(score_row, rows, workers, find_scores, cache),
+        lambda scored: write_split(db_spec, scored, chunk_size,
+                                   upsert=wm is not None),
+        pipelined)
+    if high[0] is not None:
+        for x in EXTRACTORS:
+            db_set_watermark(db_spec, x.SCORE_COLUMN, high[0])
+    return counts
+
+def rules_version():
+    return fingerprint([x.rules_version() for x in EXTRACTORS])
+
+def doall(db_spec=None, stream=False,
+          fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE, workers=1,
+          incremental=False, full_rebuild=False, cache=None, bulk=False,
+          metrics=None, pipelined=False):
+    '''Same options as the single-score drivers.
+    Returns dict of SCORE_COLUMN -> rows written.'''
+    with collecting(metrics), \
+         pooled(db_spec, stream or incremental or bulk) as db_spec, \
+         open_cache(sys.modules[__name__], cache) as c:
+        if incremental:
+            return run_incremental(db_spec, fetch_size, chunk_size, workers,
+                                   full_rebuild, c, pipelined)
+        qy = pertinent_qy()
+        if stream:
+            if not bulk:
+                reset_dest_tables(db_spec)
+            return run_stages(
+                lambda: db_qy_stream(db_spec, qy, fetch_size),
+                lambda rows: score_all(score_row, rows, workers,
+                                       find_scores, c),
+                lambda scored: write_split(db_spec, scored, chunk_size,
+                                           bulk=bulk),
+                pipelined)
+        with METRICS.timer('db_qy'):
+            data = db_qy(db_spec, qy)
+        out = RecordBatch(score_all(score_row, consume(data), workers,
+                                    find_scores, c))
+        if not bulk:
+            with METRICS.timer('db_insert'):
+                reset_dest_tables(db_spec)
+        return write_split(db_spec, out, chunk_size, bulk=bulk)
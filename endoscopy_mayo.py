@@ -1,17 +1,24 @@
 from enum import Enum, auto
-import traceback
-from db3 import *
-from ks3 import *
+import re
+import sys
 from common import *
+from etl import *
+from instrument import *
+from fsmtrace import *
 
-p06 = None
-try: p06 = slurpj("enclave/p06.json")
-except: pass
+DEST_TABLE = '[dm_cadc].[ibd].[tmp_endoscopy_mayo]'
+SCORE_COLUMN = 'mayo'
 
-# trace flag
-TRC = False
+# Report must mention one of these (SQL LIKE) to be considered at all.
+PREFILTERS = ['mayo']
 
-DEST_TABLE = '[dm_cadc].[ibd].[tmp_endoscopy_mayo]'
+# For incremental runs (see etl.run_incremental): source column whose
+# high-water mark we keep, and the columns identifying a row in
+# DEST_TABLE. The mark only moves as reports are added, so edited
+# reports aren't rescored; that would take a row-version/modified-date
+# column, which PERTINENT_QY doesn't select.
+WATERMARK_COLUMN = 'order_proc_id'
+KEY_COLUMNS = ['order_proc_id']
 
 #-----------------------------------------------------------------------------
 # tunable parameters
@@ -34,16 +41,25 @@ TOTAL = 'total'
 
 #-----------------------------------------------------------------------------
 
+def score_int(score):
+    '''int(score) if is_integer(score), else None; raises as int() does
+    for e.g. '2.'. Tokens are looked up in the shared token_int memo.'''
+    if not isinstance(score, str):
+        return int(score) if is_integer(score) else None
+    v = token_int(score)
+    if v is NOT_INT:
+        return None
+    if v is BAD_INT:
+        return int(score)
+    return v
+
 def is_valid_subscore(score):
-    return (
-        is_integer(score)
-        and int(score) in (0, 1, 2, 3))
+    v = score_int(score)
+    return v is not None and v in (0, 1, 2, 3)
 
 def is_valid_total_score(score):
-    return (
-        is_integer(score)
-        and int(score) >= 0
-        and int(score) <= 12)
+    v = score_int(score)
+    return v is not None and 0 <= v <= 12
 
 def save_sf_score(cache, score):
     cache['sf'] = int(score)
@@ -221,66 +237,349 @@ def fsm(tokens):
         else:
             return not_found
     for t in tokens:
-        if TRC: print('token: ' + t)
         try:
             curr_state, cache = curr_state(t, cache)
+            if isinstance(curr_state, EndState) and METRICS.on:
+                METRICS.observe('fsm_end.' + SCORE_COLUMN, curr_state.name)
             if curr_state == EndState.TOO_MANY_SKIPS:
                 return f_resolve_score(cache)
             elif curr_state == EndState.AT_STOP_WORD:
                 return f_resolve_score(cache)
             elif curr_state == EndState.AT_STANDALONE_SCORE:
                 return t
-        except Exception as ex:
-            if TRC: print('fsm got ex: ' + str(ex) + '\n' + traceback.format_exc())
+        except Exception:
+            if METRICS.on: METRICS.observe('fsm_end.' + SCORE_COLUMN, 'ERROR')
             return 'ERROR'
     # If we get here, ran out of tokens but 'promising' tokens
     # were seen near end of report.
+    if METRICS.on: METRICS.observe('fsm_end.' + SCORE_COLUMN, 'END_OF_TOKENS')
     return f_resolve_score(cache)
 
+#-----------------------------------------------------------------------------
+# compiled fsm
+# Same machine as fsm() above, compiled into a transition table:
+# (state, token class) -> action. Each token is classified with one
+# (memoized) dict lookup, and the skip count and MA subscore are plain
+# locals. Call compile_fsm() after changing any of the word lists.
+
+# States.
+S_ENTRY, S_READY, S_SF, S_RB, S_MA, S_MD, S_TOTAL = range(7)
+
+# Token classes.
+(C_STOP, C_SF, C_RB, C_MA, C_MD, C_TOTAL,
+ C_SUBSCORE,     # integer 0-3
+ C_TOTAL_ONLY,   # integer 4-12
+ C_INT,          # any other integer
+ C_BAD_INT,      # is_integer() but int() raises, e.g. '2.'
+ C_OTHER) = range(11)
+
+# Actions; a non-negative action is the state to move to (resetting skips).
+A_SKIP = -1
+A_CAPTURE = -2
+A_END_STOP = -3
+A_STANDALONE = -4
+A_ERROR = -5
+
+_table = []
+
+def compile_fsm():
+    global _table
+    kw = {}
+    # Reverse order of get_next_state's checks, so earlier lists win.
+    for words, cls in ((MD_WORDS, C_MD), (MA_WORDS, C_MA), (RB_WORDS, C_RB),
+                       (SF_WORDS, C_SF), (STOP_WORDS, C_STOP)):
+        for w in words:
+            kw[w] = cls
+    kw.setdefault(TOTAL, C_TOTAL)
+    transitions = {C_STOP: A_END_STOP, C_SF: S_SF, C_RB: S_RB, C_MA: S_MA,
+                   C_MD: S_MD, C_TOTAL: S_TOTAL}
+    table = []
+    for state in range(7):
+        row = [A_SKIP] * 11
+        for cls, act in transitions.items():
+            row[cls] = act
+        if state == S_ENTRY:
+            row[C_SUBSCORE] = A_STANDALONE
+            row[C_BAD_INT] = A_ERROR
+        elif state in (S_SF, S_RB, S_MA, S_MD):
+            row[C_SUBSCORE] = A_CAPTURE
+            row[C_BAD_INT] = A_ERROR
+        elif state == S_TOTAL:
+            row[C_SUBSCORE] = A_CAPTURE
+            row[C_TOTAL_ONLY] = A_CAPTURE
+            row[C_BAD_INT] = A_ERROR
+        table.append(row)
+    _table = table
+    _classes.reset(kw)
+
+def numeric_class(t):
+    '''Token class of a non-keyword token, with the same outcome as
+    is_integer / is_valid_subscore / is_valid_total_score.'''
+    v = token_int(t)
+    if v is NOT_INT:
+        return C_OTHER
+    if v is BAD_INT:
+        return C_BAD_INT
+    if 0 <= v <= 3:
+        return C_SUBSCORE
+    if 0 <= v <= 12:
+        return C_TOTAL_ONLY
+    return C_INT
+
+def fsm_table(tokens):
+    '''Drop-in replacement for fsm(tokens); same results.'''
+    ma, end = run_table(tokens)
+    if METRICS.on:
+        METRICS.observe('fsm_end.' + SCORE_COLUMN, end)
+    return ma
+
+# The table-driven fsm loop: run_table(tokens) for fsm_table, and
+# run_table_traced(tokens, w) for fsm_traced (see fsmtrace.define_fsms).
+# Each returns (result, how it ended).
+define_fsms('''
+def run_table(tokens):                                                  #P
+def run_table_traced(tokens, w):                                        #T
+    read = w['tokens']                                                  #T
+    steps = w['steps']                                                  #T
+    memo = _classes.memo
+    table = _table
+    max_skips = MAX_SKIPS
+    state = S_ENTRY
+    # fsm's very first skip is always allowed (no count in its cache yet),
+    # which only matters if MAX_SKIPS < 1.
+    skips = min(0, max_skips - 1)
+    ma = 'NOT FOUND'
+    end = 'END_OF_TOKENS'
+    for t in tokens:
+        read.append(t)                                                  #T
+        cls = memo.get(t)
+        if cls is None:
+            cls = _classes.miss(t)
+        act = table[state][cls]
+        if act >= 0:
+            steps.append((len(read) - 1, S_NAMES[state], S_NAMES[act])) #T
+            state = act
+            skips = 0
+        elif act == A_SKIP:
+            if skips >= max_skips:
+                end = 'TOO_MANY_SKIPS'
+                break
+            skips += 1
+        elif act == A_CAPTURE:
+            if state == S_MA:
+                ma = int(t)
+            steps.append((len(read) - 1, S_NAMES[state],            #T
+                          S_NAMES[S_READY]))                            #T
+            state = S_READY
+            skips = 0
+        elif act == A_END_STOP:
+            end = 'AT_STOP_WORD'
+            break
+        elif act == A_STANDALONE:
+            end = 'AT_STANDALONE_SCORE'
+            ma = t
+            break
+        else:
+            end = 'ERROR'
+            ma = 'ERROR'
+            break
+    return ma, end
+''', globals())
+
+# Token -> class (see common.TokenClasses); keywords set by compile_fsm.
+_classes = TokenClasses(numeric_class)
+
+compile_fsm()
+
+# Which fsm the drivers run: 'table' (fsm_table) or 'classic' (fsm).
+# Traced reports always run fsm_traced.
+FSM_ENGINE = 'table'
+
+def run_fsm(tokens):
+    if FSM_ENGINE == 'table':
+        return fsm_table(tokens)
+    return fsm(tokens)
+
+S_NAMES = ['ENTRY', 'READY', 'SF', 'RB', 'MA', 'MD', 'TOTAL']
+
+def fsm_traced(tokens, w):
+    '''fsm_table, recording into trace window w (see fsmtrace) the tokens
+    read, each change of state and how it ended. The same loop as
+    run_table, so the same results.'''
+    ma, w['end'] = run_table_traced(tokens, w)
+    return ma
+
 #-----------------------------------------------------------------------------
 # drivers
 
 MAYO = 'mayo'
+register_anchors(SCORE_COLUMN, [MAYO])
 
 def find_score(text):
-    tokens = into_word_tokens_with_splitters(text, SPLITTERS)
+    return score_report(Report(text))
+
+def score_report(report):
+    '''Like find_score, but takes a common.Report so the anchor scan and
+    tokenization can be shared with other extractors. Reports with no
+    'mayo' anywhere are rejected before any tokenization. A report over
+    its work budget (see common.Budget) scores BUDGET_EXCEEDED.'''
+    rec = TRACE.begin(SCORE_COLUMN, report.text) if TRACE.on else None
+    try:
+        budget = Budget(report.text)
+        spans = budget.anchors(report.anchors(SCORE_COLUMN))
+        if not spans:
+            score = 'NOT FOUND'
+        elif rec is not None:
+            score = score_report_traced(report, spans, rec, budget)
+        elif is_lazy_engine():
+            windows = map(budget.wrap, mayo_windows(report.text, spans))
+            if METRICS.on:
+                windows = [Tally(w) for w in windows]
+            with METRICS.timer('fsm'):
+                score = best_score(run_fsm(toks) for toks in windows)
+            if METRICS.on:
+                METRICS.report_tokens(SCORE_COLUMN, sum(w.n for w in windows))
+        else:
+            with METRICS.timer('tokenize'):
+                tokens = report.tokens(SPLITTERS)
+            with METRICS.timer('fsm'):
+                score = find_score_tokens(tokens, budget)
+            if METRICS.on:
+                METRICS.report_tokens(SCORE_COLUMN, len(tokens))
+    except BudgetExceeded:
+        score = BUDGET_EXCEEDED
+    if METRICS.on:
+        METRICS.observe('result.' + SCORE_COLUMN, outcome(score))
+    if rec is not None:
+        TRACE.end(rec, score)
+    return score
+
+def score_report_traced(report, spans, rec, budget=None):
+    '''score_report's traced path: same windows, run through
+    fsm_traced, one trace window each.'''
+    if is_lazy_engine():
+        windows = mayo_windows(report.text, spans)
+    else:
+        tokens = report.tokens(SPLITTERS)
+        windows = (token_tail(tokens, i) for i in indices_for(tokens, MAYO))
+    if budget is not None:
+        windows = map(budget.wrap, windows)
+    return best_score(fsm_traced(toks, rec.window(n))
+                      for n, toks in enumerate(windows))
+
+def find_score_tokens(tokens, budget=None):
+    '''find_score, given the report already tokenized per SPLITTERS.
+    Each start's window is read in place (token_tail), not copied.'''
     starts = indices_for(tokens, MAYO)
-    captured_scores = []
-    found_any = False
+    results = []
     for i in starts:
-        if TRC: print('----------------')
-        if TRC: print('start i: ' + str(i))
-        toks = tokens[i:]
-        result = fsm(toks)
-        if is_integer(result):
-            found_any = True
-            captured_scores.append(result)
-    if found_any:
-        max_score = max(list(map(lambda x: int(x), captured_scores)))
-        return max_score
+        toks = token_tail(tokens, i)
+        if budget is not None:
+            toks = budget.wrap(toks)
+        results.append(run_fsm(toks))
+    return best_score(results)
+
+def best_score(results):
+    '''Given fsm results (one per start), return max integer score
+    or 'NOT FOUND'.'''
+    captured_scores = [x for x in results if is_integer(x)]
+    if captured_scores:
+        return max(map(lambda x: int(x), captured_scores))
     else:
         return 'NOT FOUND'
 
-def db_get_pertinent_reports(db_spec=p06):
-    qy = ("select empi, [Procedure Date] as proc_date, "
-          " [Procedure Code] as proc_code, order_proc_id,"
-          " notes as rpt"
-          " from dm_cadc.ibd.endoscopy_unfinished"
-          " where notes like '%mayo%' ")
-    rslt = db_qy(db_spec, qy)
+def mayo_windows(text, spans=None):
+    '''Generator; for each 'mayo' token in text, in order, yields a lazy
+    token stream that starts at it and runs to the end of text -- the
+    same tokens as tokens[i:] in find_score_tokens. Only the
+    whitespace-delimited chunks containing 'mayo' are tokenized up front;
+    the rest is tokenized only as far as the fsm reads it.
+    o spans: char offsets of 'mayo' in text, from anchor_index, if
+      already known.'''
+    if spans is None:
+        spans = anchor_index(text).get(SCORE_COLUMN, [])
+    return anchor_token_windows(text, spans, [MAYO], SPLITTERS)
+
+PERTINENT_QY = ("select empi, [Procedure Date] as proc_date, "
+                " [Procedure Code] as proc_code, order_proc_id,"
+                " notes as rpt"
+                " from dm_cadc.ibd.endoscopy_unfinished"
+                " where " + like_any('notes', PREFILTERS))
+
+def db_get_pertinent_reports(db_spec=None):
+    rslt = db_qy(db_spec, PERTINENT_QY)
     return rslt
 
-def do_all(db_spec=p06):
-    out = []
-    dat = db_get_pertinent_reports(db_spec)
-    for row in dat:
-        score = find_score(row['rpt'])
-        if TRC: print('Score was: ' + str(score))
-        row['mayo'] = score
-        del row['rpt']
-        out.append(row)
+def rules_version():
+    '''Fingerprint of the tunables find_score's result depends on; see
+    score_cache.'''
+    return fingerprint(MAX_SKIPS, SPLITTERS, STOP_WORDS, SF_WORDS, RB_WORDS,
+                       MA_WORDS, MD_WORDS, TOTAL, MAYO, tokenizer_engine(),
+                       work_budget())
+
+def score_row(row):
+    '''Score a single report row; replaces the report text with the score.
+    Returns the (mutated) row.'''
+    score = find_score(row.pop('rpt'))
+    row[SCORE_COLUMN] = score
+    return row
+
+def reset_dest_table(db_spec):
+    db_trunc_table(db_spec, DEST_TABLE)
+
+def do_all(db_spec=None, stream=False,
+           fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE, workers=1,
+           incremental=False, full_rebuild=False, cache=None,
+           bulk=False, metrics=None,
+           pipelined=False):
+    '''When stream is True, rows are read through a server-side cursor
+    fetch_size at a time and written chunk_size at a time; returns the
+    number of rows written instead of the data.
+    When workers > 1, reports are scored in a pool of that many processes.
+    When incremental is True, only rows at or past the stored watermark
+    are scored (streamed) and upserted, unless full_rebuild is True or
+    there's no watermark yet; returns number of rows written.
+    When cache is given (True, or a path; see score_cache.open_cache),
+    reports already scored under the current rules aren't rescored.
+    When bulk is True, results are written through bulkload (batched,
+    staged, then swapped in), so DEST_TABLE is never seen empty.
+    When metrics is given (a path prefix), stage timings and counters
+    are collected and written there; see instrument.collecting.
+    When pipelined is True (with stream or incremental), fetching,
+    scoring and writing run concurrently; see pipeline.
+    All DB access goes through one dbio.ConnectionPool: db_spec, if it
+    is one (e.g. shared with other drivers), else one made for the run
+    -- if db_spec has connection details (see dbio.ODBC_KEYS). If not,
+    a plain run goes through db3, and any other fails up front.
+    Without stream or incremental, returns the scored rows as a
+    records.RecordBatch, not a list: iterating or indexing it gives the
+    rows as dicts (new ones each time, so changing one doesn't change
+    the batch), and list(out) gives a list of them. The fetched rows are
+    consumed (see records.consume) as they're scored.'''
     t = DEST_TABLE
-    db_trunc_table(db_spec, t)
-    db_insert_many(db_spec, t, out)
-    return dat
-
+    with collecting(metrics), \
+         pooled(db_spec, stream or incremental or bulk) as db_spec, \
+         open_cache(sys.modules[__name__], cache) as c:
+        if incremental:
+            return run_incremental(sys.modules[__name__], db_spec,
+                                   fetch_size, chunk_size, workers,
+                                   full_rebuild, c, pipelined)
+        if stream:
+            if not bulk:
+                reset_dest_table(db_spec)
+            return run_streaming(db_spec, PERTINENT_QY, score_row, t,
+                                 fetch_size, chunk_size, workers, find_score,
+                                 c, bulk, reset_dest_table,
+                                 pipelined)
+        with METRICS.timer('db_qy'):
+            dat = db_get_pertinent_reports(db_spec)
+        out = RecordBatch(score_all(score_row, consume(dat), workers,
+                                    find_score, c))
+        if bulk:
+            bulk_replace(db_spec, t, out, chunk_size,
+                         create=reset_dest_table)
+        else:
+            with METRICS.timer('db_insert'):
+                reset_dest_table(db_spec)
+                db_insert_chunked(db_spec, t, out, chunk_size)
+        return out
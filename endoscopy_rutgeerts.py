@@ -1,17 +1,26 @@
 import re
+import sys
 import traceback
-from db3 import *
-from ks3 import *
 from common import *
-
-p06 = None
-try: p06 = slurpj("enclave/p06.json")
-except: pass
-
-TRC = False
+from etl import *
+from instrument import *
+from fsmtrace import *
 
 SCHEMA = 'ibd'
 DEST_TABLE = '[dm_cadc].[ibd].[tmp_endoscopy_rutgeerts]'
+SCORE_COLUMN = 'rutgeerts'
+
+# Report must mention one of these (SQL LIKE) to be considered at all.
+PREFILTERS = ['rutgeert', 'rutgers']
+
+# For incremental runs (see etl.run_incremental): source column whose
+# high-water mark we keep, and the columns identifying a row in
+# DEST_TABLE. The mark only moves as reports are added, so edited
+# reports aren't rescored; that would take a row-version/modified-date
+# column, which PERTINENT_QY doesn't select.
+WATERMARK_COLUMN = 'order_proc_id'
+KEY_COLUMNS = ['order_proc_id']
+register_anchors(SCORE_COLUMN, PREFILTERS)
 
 #-----------------------------------------------------------------------------
 # db
@@ -22,12 +31,19 @@ def make_tmp_table(db_spec):
     ddl = slurp('sql/make-tmp-endoscopy-rutgeerts-table.sql')
     db_stmt(db_spec, ddl)
 
+def reset_dest_table(db_spec):
+    make_tmp_table(db_spec)
+
 #-----------------------------------------------------------------------------
 # regex
 
 reg = r'(rutgeerts|rutgeert|rutgers)\s*(score\s*|was\s*|is\s*|of\s*){0,4}(i?[0-4])'
 reg_obj = re.compile(reg, flags=re.IGNORECASE|re.DOTALL)
 
+# Every match of reg starts with this, in some case; find_score_batch
+# only tries reg where it occurs. Keep in step with reg.
+REG_ANCHOR = 'rutge'
+
 #-----------------------------------------------------------------------------
 
 def _get_max_score(rut_scores):
@@ -43,41 +59,172 @@ def find_score(text):
     score. This assumption is based on the RTM recommendation to 
     extract from 'anywhere' in the report, which suggests that 
     historical scores are notable, the most severe being the most notable.
+    Of the work budgets (see common.Budget) only MAX_REPORT_CHARS
+    applies: the regex scan is linear, with no token windows.
     '''
     score = None
-    rslt = reg_obj.findall(text)
+    rslt = None
+    if over_char_budget(text):
+        score = BUDGET_EXCEEDED
+    else:
+        with METRICS.timer('fsm'):
+            rslt = reg_obj.findall(text)
     if rslt:
         # findall result is a list of tuples.
         # score if present will always be last, based on regex.
         # Throw in a lower() in case the 'i' is capitalized.
         scores = list(map(lambda x: x[2].lower(), rslt))
         score = _get_max_score(scores)
-    if TRC: print('find_score: ' + str(rslt))
-    # Rutgeerts score always starts with letter i; append if needed.
-    if score and score[0] != 'i':
-        score = 'i' + score
+        # Rutgeerts score always starts with letter i; append if needed.
+        if score and score[0] != 'i':
+            score = 'i' + score
+    if METRICS.on:
+        METRICS.observe('result.' + SCORE_COLUMN,
+                        outcome(score or 'NOT FOUND'))
+    if TRACE.on:
+        rec = TRACE.begin(SCORE_COLUMN, text)
+        if rec is not None:
+            rec.note(matches=rslt)
+            TRACE.end(rec, score if score else 'NOT FOUND')
     return score if score else 'NOT FOUND'
 
-def db_get_pertinent_reports(db_spec=p06):
-    qy = ("select empi, [Procedure Date] as proc_date, "
-          " [Procedure Code] as proc_code, order_proc_id,"
-          " notes as rpt"
-          " from dm_cadc.ibd.endoscopy_unfinished"
-          " where notes like '%rutgeert%' "
-          " or notes like '%rutgers%' ")
-    rslt = db_qy(db_spec, qy)
-    return rslt
+def find_score_batch(texts):
+    '''find_score over a whole column of reports at once: texts is any
+    iterable of str (a list, a pandas Series, a pyarrow string array).
+    Returns a list of scores, in order, exactly as find_score gives
+    them; a None (SQL NULL) report gets 'NOT FOUND'.
+    Skips find_score's per-call overhead: the max severity is just the
+    max of the matches' last characters (digits 0-4), which is
+    _get_max_score's result up to the 'i' prefix find_score adds. And
+    rather than scan each whole report with reg, only tries it at each
+    REG_ANCHOR (see _find_severities).'''
+    if TRACE.on:
+        return [find_score(t) if t is not None else 'NOT FOUND'
+                for t in _as_strs(texts)]
+    with METRICS.timer('fsm'):
+        out = []
+        for t in _as_strs(texts):
+            if over_char_budget(t):
+                out.append(BUDGET_EXCEEDED)
+                continue
+            sev = _find_severities(t) if t else None
+            out.append('i' + max(sev) if sev else 'NOT FOUND')
+    if METRICS.on:
+        for score in out:
+            METRICS.observe('result.' + SCORE_COLUMN, outcome(score))
+    return out
 
-def doall(db_spec=p06):
+def _find_severities(text):
+    '''The last character of the score group of each match of reg in
+    text, found just as findall would (leftmost, non-overlapping).'''
+    low = text.lower()
+    if len(low) != len(text):
+        # lower() changed offsets (U+0130); can't map positions back.
+        return [m[2][-1] for m in reg_obj.findall(text)]
     out = []
-    data = db_get_pertinent_reports(db_spec)
-    for row in data:
-        score = find_score(row['rpt'])
-        if TRC: print('Score was: ' + str(score))
-        row['rutgeerts'] = score
-        del row['rpt']
-        out.append(row)
-    make_tmp_table(db_spec)
-    db_insert_many(db_spec, DEST_TABLE, out)
-    return len(data)
+    match = reg_obj.match
+    find = low.find
+    pos = find(REG_ANCHOR)
+    while pos >= 0:
+        m = match(text, pos)
+        if m:
+            out.append(m.group(3)[-1])
+            pos = find(REG_ANCHOR, m.end())
+        else:
+            pos = find(REG_ANCHOR, pos + 1)
+    return out
+
+def _as_strs(texts):
+    '''texts as an iterable of str/None; pyarrow arrays yield scalars
+    otherwise.'''
+    if hasattr(texts, 'to_pylist'):
+        return texts.to_pylist()
+    return texts
+
+def score_rows(rows):
+    '''score_row over a list of rows, via find_score_batch. Returns the
+    (mutated) rows.'''
+    scores = find_score_batch([row.pop('rpt') for row in rows])
+    for row, score in zip(rows, scores):
+        row[SCORE_COLUMN] = score
+    return rows
+
+def score_report(report):
+    '''Like find_score, but takes a common.Report (for the combined
+    driver); the regex works on the raw text, so no tokens needed.'''
+    return find_score(report.text)
+
+PERTINENT_QY = ("select empi, [Procedure Date] as proc_date, "
+                " [Procedure Code] as proc_code, order_proc_id,"
+                " notes as rpt"
+                " from dm_cadc.ibd.endoscopy_unfinished"
+                " where " + like_any('notes', PREFILTERS))
+
+def db_get_pertinent_reports(db_spec=None):
+    rslt = db_qy(db_spec, PERTINENT_QY)
+    return rslt
+
+def rules_version():
+    '''Fingerprint of the rules find_score's result depends on; see
+    score_cache.'''
+    return fingerprint(reg, reg_obj.flags, work_budget())
+
+def score_row(row):
+    '''Score a single report row; replaces the report text with the score.
+    Returns the (mutated) row.'''
+    score = find_score(row.pop('rpt'))
+    row[SCORE_COLUMN] = score
+    return row
 
+def doall(db_spec=None, stream=False,
+          fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE, workers=1,
+          incremental=False, full_rebuild=False, cache=None,
+          bulk=False, metrics=None,
+          pipelined=False):
+    '''When stream is True, rows are read through a server-side cursor
+    fetch_size at a time and written chunk_size at a time.
+    Reports are scored etl.BATCH_CHUNK at a time, through score_rows
+    (row by row when cached; see etl.score_all).
+    When workers > 1, reports are scored in a pool of that many processes.
+    When incremental is True, only rows at or past the stored watermark
+    are scored (streamed) and upserted, unless full_rebuild is True or
+    there's no watermark yet; returns number of rows written.
+    When cache is given (True, or a path; see score_cache.open_cache),
+    reports already scored under the current rules aren't rescored.
+    When bulk is True, results are written through bulkload (batched,
+    staged, then swapped in), so DEST_TABLE is never seen empty.
+    When metrics is given (a path prefix), stage timings and counters
+    are collected and written there; see instrument.collecting.
+    When pipelined is True (with stream or incremental), fetching,
+    scoring and writing run concurrently; see pipeline.
+    All DB access goes through one dbio.ConnectionPool: db_spec, if it
+    is one (e.g. shared with other drivers), else one made for the run
+    -- if db_spec has connection details (see dbio.ODBC_KEYS). If not,
+    a plain run goes through db3, and any other fails up front.
+    Returns number of rows processed.'''
+    with collecting(metrics), \
+         pooled(db_spec, stream or incremental or bulk) as db_spec, \
+         open_cache(sys.modules[__name__], cache) as c:
+        if incremental:
+            return run_incremental(sys.modules[__name__], db_spec,
+                                   fetch_size, chunk_size, workers,
+                                   full_rebuild, c, pipelined)
+        if stream:
+            if not bulk:
+                reset_dest_table(db_spec)
+            return run_streaming(db_spec, PERTINENT_QY, score_row,
+                                 DEST_TABLE, fetch_size, chunk_size, workers,
+                                 find_score, c, bulk, reset_dest_table,
+                                 pipelined, score_rows)
+        with METRICS.timer('db_qy'):
+            data = db_get_pertinent_reports(db_spec)
+        out = RecordBatch(score_all(score_row, consume(data), workers,
+                                    find_score, c, score_rows))
+        if bulk:
+            bulk_replace(db_spec, DEST_TABLE, out, chunk_size,
+                         create=reset_dest_table)
+        else:
+            with METRICS.timer('db_insert'):
+                reset_dest_table(db_spec)
+                db_insert_chunked(db_spec, DEST_TABLE, out, chunk_size)
+        return len(out)
@@ -1,24 +1,29 @@
 import copy
+import itertools
 import json
 import re
 import sys
-from db3 import *
-from ks3 import *
 from common import *
-
-p06 = None
-try:
-    p06 = slurpj("enclave/p06.json")
-except:
-    pass
-
-# trace flag
-TRC = False
+from etl import *
+from instrument import *
+from fsmtrace import *
 
 #-----------------------------------------------------------------------------
 # db
 
 DEST_TABLE = 'dm_cadc.ibd.tmp_endoscopy_ses_cd'
+SCORE_COLUMN = 'ses_cd'
+
+# Section must mention one of these (SQL LIKE) to be considered at all.
+PREFILTERS = ['ses-cd', 'simple endo']
+
+# For incremental runs (see etl.run_incremental): source column whose
+# high-water mark we keep, and the columns identifying a row in
+# DEST_TABLE. The mark only moves as reports are added, so edited
+# reports aren't rescored; that would take a row-version/modified-date
+# column, which PERTINENT_QY doesn't select.
+WATERMARK_COLUMN = 'proc_date'
+KEY_COLUMNS = ['empi', 'proc_date', 'proc_code']
 
 def make_tmp_table(db_spec):
     schema = 'ibd'
@@ -27,170 +32,287 @@ def make_tmp_table(db_spec):
     ddl = slurp('sql/make-tmp-endoscopy-ses-cd-table.sql')
     db_stmt(db_spec, ddl)
 
+def reset_dest_table(db_spec):
+    make_tmp_table(db_spec)
+
 #------------------------------------------------------------------------------
 # anchors
 # These are points in report where we want to start looking for a score.
 
 ANCHORS = [r'ses-cd',
            r"simple endoscopic score for crohn's disease"]
+register_anchors(SCORE_COLUMN, ANCHORS)
 
 #------------------------------------------------------------------------------
 # fsm
 # implementation of ses-cd final score finite-state machine 
 
+# Tokens read after each anchor.
+WINDOW = 30
+
 SKIP_WORDS = ['scoring', 'score', 'was']
 PERTINENT_PRELUDES = ['total', 'aggregate']
 SUBSCORE_PRELUDES = ['ileum', 'right', 'colon', 'transverse', 'left', 'rectum']
 
-def is_skip_word(t):
-    return t in SKIP_WORDS
+# Token class bits; a token may have several (if it's in several lists).
+B_INT = 1
+B_PERTINENT = 2
+B_SUBSCORE = 4
+B_SKIP = 8
+
+def numeric_bits(t):
+    '''Class bits of a token in none of the word lists.'''
+    return 0 if token_int(t) is NOT_INT else B_INT
+
+def compile_classes():
+    '''Call after changing any of the word lists.'''
+    kw = {}
+    for words, bit in ((SKIP_WORDS, B_SKIP),
+                       (PERTINENT_PRELUDES, B_PERTINENT),
+                       (SUBSCORE_PRELUDES, B_SUBSCORE)):
+        for w in words:
+            kw[w] = kw.get(w, numeric_bits(w)) | bit
+    _classes.reset(kw)
 
-def is_pertinent_prelude(t):
-    return t in PERTINENT_PRELUDES
+# Token -> class bits (see common.TokenClasses), so each token costs the
+# states one dict lookup.
+_classes = TokenClasses(numeric_bits)
+compile_classes()
 
-def is_subscore_prelude(t):
-    return t in SUBSCORE_PRELUDES
+# The states take a token's class bits, and return the next state.
 
-def at_just_entered(token):
+def at_just_entered(c):
     '''
     Note: 'entered' state is different than 'ready' in one key aspect:
     if the next token is a number we consider it pertinent
     and take it. howver in the ready state, a pertinent number
     must be preceded by a pertinent prelude.
     '''
-    if TRC: print(funcname())
-    if is_integer(token):
+    if c & B_INT:
         return at_pertinent_score                
-    if is_pertinent_prelude(token):
+    if c & B_PERTINENT:
         return at_pertinent_prelude
-    if is_subscore_prelude(token):
-        return at_subscore_prelude(token)
+    if c & B_SUBSCORE:
+        return at_subscore_prelude(c)
     else:
         return at_just_entered
 
-def at_ready(token):
+def at_ready(c):
     '''
     in the ready state, a pertinent number
     must be preceded by a pertinent prelude
     '''
-    if TRC: print(funcname())
-    if is_pertinent_prelude(token):
+    if c & B_PERTINENT:
         return at_pertinent_prelude
-    if is_subscore_prelude(token):
-        return at_subscore_prelude(token)
+    if c & B_SUBSCORE:
+        return at_subscore_prelude(c)
     else:
         return at_ready
 
-def at_skip_number(token):
-    if TRC: print(funcname())
-    if is_pertinent_prelude(token):
+def at_skip_number(c):
+    if c & B_PERTINENT:
         return at_pertinent_prelude
-    if is_subscore_prelude(token):
+    if c & B_SUBSCORE:
         return at_subscore_prelude
     else:
         return at_skip_number
 
-def at_subscore_prelude(token):
-    if TRC: print(funcname())
-    if is_subscore_prelude(token):
+def at_subscore_prelude(c):
+    if c & B_SUBSCORE:
         return at_subscore_prelude
-    if is_integer(token): # subscore numeric value; discard.
+    if c & B_INT: # subscore numeric value; discard.
         return at_ready
     else:
          return at_subscore_prelude
 
-def at_pertinent_prelude(token):
-    if TRC: print(funcname())
-    if is_skip_word(token):
+def at_pertinent_prelude(c):
+    if c & B_SKIP:
         return at_pertinent_prelude 
-    if is_pertinent_prelude(token):
+    if c & B_PERTINENT:
         return at_pertinent_prelude
-    if is_subscore_prelude(token): # not sure if likely, but account for.
+    if c & B_SUBSCORE: # not sure if likely, but account for.
         return at_subscore_prelude
-    if is_integer(token): # this is value of interest.
-        if TRC: print('got it: ' + str(token))
+    if c & B_INT: # this is value of interest.
         return at_pertinent_score  
     else:
         return at_pertinent_prelude
 
-def at_pertinent_score(token):
-    if TRC: print(funcname())
+def at_pertinent_score(c):
     raise Exception('End state has no transition.')
 
-def at_unknown(token):
-    if TRC: print(funcname())
+def at_unknown(c):
     raise Exception('End state has no transition.')
 
-def fsm(tokens):
-    '''Returns token of interest; or None if can't find'''
+FSM_END = 'fsm_end.' + SCORE_COLUMN
+
+# fsm(tokens) returns token of interest; or None if can't find.
+# fsm_traced(tokens, w) is fsm, recording into trace window w (see
+# fsmtrace) the tokens read, each change of state and how it ended.
+# Both are made from this one loop (see fsmtrace.define_fsms).
+define_fsms('''
+def fsm(tokens):                                                        #P
+def fsm_traced(tokens, w):                                              #T
+    read = w['tokens']                                                  #T
+    memo = _classes.memo
     curr_state = at_just_entered
     for token in tokens:
+        read.append(token)                                              #T
+        c = memo.get(token)
+        if c is None:
+            c = _classes.miss(token)
         try:
-            if TRC: print('token: ' + str(token))
-            curr_state = curr_state(token)
+            prev = curr_state                                           #T
+            curr_state = curr_state(c)
+            if curr_state != prev:                                      #T
+                w['steps'].append((len(read) - 1, prev.__name__,        #T
+                                   curr_state.__name__))                #T
             if curr_state == at_pertinent_score:
+                if METRICS.on: METRICS.observe(FSM_END, 'AT_PERTINENT_SCORE') #P
+                w['end'] = 'AT_PERTINENT_SCORE'                         #T
                 return token
             if curr_state == at_unknown:
+                if METRICS.on: METRICS.observe(FSM_END, 'AT_UNKNOWN')   #P
+                w['end'] = 'AT_UNKNOWN'                                 #T
                 return 'NOT FOUND'
-            if TRC: print('afte transition, curr_state: ' + str(curr_state.__name__))
         except Exception as ex:
-            if TRC: print('fsm got ex: ' + str(ex))
+            if METRICS.on: METRICS.observe(FSM_END, 'ERROR')            #P
+            w['end'] = 'ERROR: ' + str(ex)                              #T
             return None
+    if METRICS.on: METRICS.observe(FSM_END, 'END_OF_WINDOW')            #P
+    w['end'] = 'END_OF_WINDOW'                                          #T
     return 'NOT FOUND'
-    if TRC: print('err: ' + str(token))
-    raise Exception('fsm: should never get here')
+''', globals())
 
 #------------------------------------------------------------------------------
 # drivers
 
 def find_score(text):
     '''
-    1 find anchor (if multiple anchors, how to proceed?)
-    2 just after anchor, tokenize the rest of the string.
-    3 take the first 25 tokens.
+    1 find anchors (every occurrence of each, in text order)
+    2 just after anchor, tokenize the rest of the string (lazily).
+    3 take the first WINDOW tokens.
     4 loop through tokens, feeding into "current_state"
         - need to decide if class will be needed for this. 
     5 if not found, return None
         if found, return as string
+    6 over the work budget (see common.Budget): BUDGET_EXCEEDED
     '''
     result = None
-    anchor_indices = get_anchor_indices(text, ANCHORS)
-    if TRC: print('anchors indices: ' + str(anchor_indices) )
-        
-    for idx in anchor_indices:
-        if TRC: print('start')
-        tokens = into_word_tokens(text[idx:])  
-        tokens = tokens[:30] # limit to 30 tokens.
-        if TRC: print('len tokens: ' + str(len(tokens)))
-        result = fsm(tokens)
-        if is_integer(result):
-            break
+    n_tokens = 0
+    rec = TRACE.begin(SCORE_COLUMN, text) if TRACE.on else None
+    try:
+        budget = Budget(text)
+        anchor_indices = [e for b, e in budget.anchors(
+            anchor_index(text).get(SCORE_COLUMN, []))]
+
+        for idx in anchor_indices:
+            # limit to WINDOW tokens; tokenized lazily, so (with the fast
+            # engine) we stop tokenizing as soon as the fsm is done.
+            tokens = budget.wrap(itertools.islice(iter_word_tokens(text, idx),
+                                                  WINDOW))
+            if METRICS.on:
+                tokens = Tally(tokens)
+            if rec is not None:
+                result = fsm_traced(tokens, rec.window(idx))
+            else:
+                with METRICS.timer('fsm'):
+                    result = fsm(tokens)
+            if METRICS.on:
+                n_tokens += tokens.n
+            if is_integer(result):
+                break
+    except BudgetExceeded:
+        result = BUDGET_EXCEEDED
+    if METRICS.on:
+        METRICS.report_tokens(SCORE_COLUMN, n_tokens)
+    if rec is not None:
+        TRACE.end(rec, result if result else 'NOT FOUND')
     return result if result else 'NOT FOUND'
 
+PERTINENT_QY = ("select empi, proc_date, proc_code, findings, impression"
+                " from dm_cadc.ibd.tmp_endoscopy_sections"
+                " where " + like_any('findings', PREFILTERS) +
+                " or " + like_any('impression', PREFILTERS))
+
 def get_pertinent_sections(db_spec):
-    qy = ("select empi, proc_date, proc_code, findings, impression"
-          " from dm_cadc.ibd.tmp_endoscopy_sections"
-          " where findings like '%ses-cd%'"
-          " or findings like '%simple endo%'"
-          " or impression like  '%ses-cd%'"
-          " or impression like '%simple endo%'")
-    rslt = db_qy(db_spec, qy)
+    rslt = db_qy(db_spec, PERTINENT_QY)
     return rslt
 
-def doall(db_spec=p06):    
-    out = []
-    dat = get_pertinent_sections(db_spec)
-    for row in dat:
-        score = find_score(row['impression'])
-        if score == 'NOT FOUND':
-            score = find_score(row['findings'])
-        if TRC: print('Score was: ' + str(score))
-        row['ses_cd'] = score
-        del row['findings']
-        del row['impression']
-        out.append(row)
-    t = DEST_TABLE
-    make_tmp_table(db_spec) 
-    db_insert_many(db_spec, t, out)
-    return dat
+# Columns score_row reads (and drops).
+TEXT_COLUMNS = ['impression', 'findings']
 
+def rules_version():
+    '''Fingerprint of the tunables find_score's result depends on; see
+    score_cache.'''
+    return fingerprint(ANCHORS, WINDOW, SKIP_WORDS, PERTINENT_PRELUDES,
+                       SUBSCORE_PRELUDES, tokenizer_engine(), work_budget())
+
+def score_row(row):
+    '''Score a single sections row (impression first, then findings);
+    replaces the section text with the score. Returns the (mutated) row.'''
+    impression = row.pop('impression')
+    findings = row.pop('findings')
+    score = find_score(impression)
+    if score == 'NOT FOUND':
+        score = find_score(findings)
+    if METRICS.on:
+        METRICS.observe('result.' + SCORE_COLUMN, outcome(score))
+    row[SCORE_COLUMN] = score
+    return row
+
+def doall(db_spec=None, stream=False,
+          fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE, workers=1,
+          incremental=False, full_rebuild=False, cache=None,
+          bulk=False, metrics=None,
+          pipelined=False):
+    '''When stream is True, rows are read through a server-side cursor
+    fetch_size at a time and written chunk_size at a time; returns the
+    number of rows written instead of the data.
+    When workers > 1, reports are scored in a pool of that many processes.
+    When incremental is True, only rows at or past the stored watermark
+    are scored (streamed) and upserted, unless full_rebuild is True or
+    there's no watermark yet; returns number of rows written.
+    When cache is given (True, or a path; see score_cache.open_cache),
+    sections already scored under the current rules aren't rescored.
+    When bulk is True, results are written through bulkload (batched,
+    staged, then swapped in), so DEST_TABLE is never seen empty.
+    When metrics is given (a path prefix), stage timings and counters
+    are collected and written there; see instrument.collecting.
+    When pipelined is True (with stream or incremental), fetching,
+    scoring and writing run concurrently; see pipeline.
+    All DB access goes through one dbio.ConnectionPool: db_spec, if it
+    is one (e.g. shared with other drivers), else one made for the run
+    -- if db_spec has connection details (see dbio.ODBC_KEYS). If not,
+    a plain run goes through db3, and any other fails up front.
+    Without stream or incremental, returns the scored rows as a
+    records.RecordBatch, not a list: iterating or indexing it gives the
+    rows as dicts (new ones each time, so changing one doesn't change
+    the batch), and list(out) gives a list of them. The fetched rows are
+    consumed (see records.consume) as they're scored.'''
+    t = DEST_TABLE
+    with collecting(metrics), \
+         pooled(db_spec, stream or incremental or bulk) as db_spec, \
+         open_cache(sys.modules[__name__], cache, TEXT_COLUMNS) as c:
+        if incremental:
+            return run_incremental(sys.modules[__name__], db_spec,
+                                   fetch_size, chunk_size, workers,
+                                   full_rebuild, c, pipelined)
+        if stream:
+            if not bulk:
+                reset_dest_table(db_spec)
+            return run_streaming(db_spec, PERTINENT_QY, score_row, t,
+                                 fetch_size, chunk_size, workers, find_score,
+                                 c, bulk, reset_dest_table,
+                                 pipelined)
+        with METRICS.timer('db_qy'):
+            dat = get_pertinent_sections(db_spec)
+        out = RecordBatch(score_all(score_row, consume(dat), workers,
+                                    find_score, c))
+        if bulk:
+            bulk_replace(db_spec, t, out, chunk_size,
+                         create=reset_dest_table)
+        else:
+            with METRICS.timer('db_insert'):
+                reset_dest_table(db_spec)
+                db_insert_chunked(db_spec, t, out, chunk_size)
+        return out
@@ -0,0 +1,130 @@
+'''Shared driver plumbing for the endoscopy_* extractor modules.'''
+from dbio import *
+from parallel import *
+from score_cache import *
+from bulkload import *
+from pipeline import *
+
+# Rows per call when an extractor's score_rows scores them (see
+# score_all); with workers, per task.
+BATCH_CHUNK = 1000
+
+def score_all(score_row, rows, workers=1, warmup=None, cache=None,
+              batch=None):
+    '''Map score_row over rows, preserving order: in-process when
+    workers is 1 (or less), otherwise in a pool of that many processes.
+    o cache: optional score_cache.BoundCache (see open_cache); rows it
+      has results for aren't rescored.
+    o batch: optional score_rows function of the extractor (list of
+      rows -> the same rows, scored, as score_row would), for one that
+      scores a chunk faster than row by row (endoscopy_rutgeerts); used
+      instead of score_row, BATCH_CHUNK rows at a time, unless there's
+      a cache (its lookups go row by row).
+    Returns an iterator.'''
+    if cache is not None:
+        out = cache.score_all(score_row, rows, workers, warmup)
+    elif batch is not None:
+        out = _score_batches(batch, rows, workers, warmup)
+    elif workers > 1:
+        out = pool_imap(score_row, rows, workers, warmup=warmup)
+    else:
+        out = map(score_row, rows)
+    if METRICS.on:
+        return _counted('rows.' + score_row.__module__,
+                        METRICS.timed('score', out))
+    return out
+
+def _score_batches(batch, rows, workers=1, warmup=None):
+    chunks = chunked(rows, BATCH_CHUNK)
+    if workers > 1:
+        done = pool_imap(batch, chunks, workers, chunk_size=1, warmup=warmup)
+    else:
+        done = map(batch, chunks)
+    for chunk in done:
+        yield from chunk
+
+def _counted(name, it):
+    for x in it:
+        METRICS.inc(name)
+        yield x
+
+def run_stages(source, score, sink, pipelined=False):
+    '''sink(score(source())), each being a stage of a streaming run;
+    if pipelined, with the stages overlapped (see
+    pipeline.run_pipelined).'''
+    if pipelined:
+        return run_pipelined(source, score, sink)
+    return sink(score(source()))
+
+def run_streaming(db_spec, qy, score_row, dest_table,
+                  fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE,
+                  workers=1, warmup=None, cache=None, bulk=False,
+                  create=None, pipelined=False, batch=None):
+    '''Stream rows for qy, score each one with score_row (which is
+    expected to drop the report text from the row), and write results
+    to dest_table in chunks. Peak memory is bounded by fetch_size and
+    chunk_size rather than by the size of the result set.
+    See score_all re: workers, warmup, cache and batch.
+    Caller is responsible for preparing dest_table beforehand, unless
+    bulk, in which case results are staged and swapped in to replace
+    its contents (see bulkload.bulk_replace; create makes dest_table if
+    it doesn't exist).
+    If pipelined, fetching, scoring and writing overlap (see run_stages).
+    Returns number of rows written.'''
+    def sink(scored):
+        if bulk:
+            return bulk_replace(db_spec, dest_table, scored, chunk_size,
+                                create=create)
+        return db_insert_chunked(db_spec, dest_table, scored, chunk_size)
+    return run_stages(lambda: db_qy_stream(db_spec, qy, fetch_size),
+                      lambda rows: score_all(score_row, rows, workers,
+                                             warmup, cache, batch),
+                      sink, pipelined)
+
+def incremental_qy(qy, watermark_col):
+    '''qy restricted to rows at or past a watermark (given as the one ?
+    parameter). At, not just past, since e.g. more rows may turn up
+    later with the same proc_date; they're re-scored, which is harmless
+    as results are upserted.'''
+    return ('select * from (' + qy + ') q where q.' + watermark_col
+            + ' >= ?')
+
+def run_incremental(x, db_spec, fetch_size=FETCH_SIZE, chunk_size=CHUNK_SIZE,
+                    workers=1, full_rebuild=False, cache=None,
+                    pipelined=False):
+    '''Incremental run of extractor module x (see its doall): scores
+    only source rows at or past x's watermark and upserts them into
+    x.DEST_TABLE by x.KEY_COLUMNS, then advances the watermark. Rebuilds
+    everything when x has no watermark yet, or when full_rebuild.
+    Rows are streamed (and pipelined) as in run_streaming.
+    Only new reports are picked up: the source queries select no
+    row-version or modified-date column, so a report edited in place
+    keeps its WATERMARK_COLUMN value and isn't rescored until a
+    full_rebuild.
+    Returns number of rows written.'''
+    col = x.WATERMARK_COLUMN
+    make_watermark_table(db_spec)
+    wm = None if full_rebuild else db_get_watermark(db_spec, x.SCORE_COLUMN)
+    high = [None]
+    def source():
+        if wm is None:
+            rows = db_qy_stream(db_spec, x.PERTINENT_QY, fetch_size)
+        else:
+            rows = db_qy_stream(db_spec, incremental_qy(x.PERTINENT_QY, col),
+                                fetch_size, (wm,))
+        return track_max(rows, col, high)
+    def sink(scored):
+        if wm is None:
+            return db_insert_chunked(db_spec, x.DEST_TABLE, scored,
+                                     chunk_size)
+        return db_upsert_chunked(db_spec, x.DEST_TABLE, x.KEY_COLUMNS,
+                                 scored, chunk_size)
+    if wm is None:
+        x.reset_dest_table(db_spec)
+    batch = getattr(x, 'score_rows', None)
+    n = run_stages(source, lambda rows: score_all(x.score_row, rows, workers,
+                                                  x.find_score, cache, batch),
+                   sink, pipelined)
+    if high[0] is not None:
+        db_set_watermark(db_spec, x.SCORE_COLUMN, high[0])
+    return n
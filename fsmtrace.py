@@ -0,0 +1,171 @@
+'''Sampled, structured tracing of extractor decisions (replaces the old
+per-module TRC print flags).
+
+    with tracing('trace.jsonl', every=100, only=['NOT FOUND']):
+        endoscopy_mayo.do_all(...)
+
+records, for 1 in every sampled report whose final result is in only
+(all results when only is None), each FSM window: the tokens it read,
+its state transitions and how it ended, plus the final decision. With
+no path the records go to a ring buffer of the last RING_SIZE (see
+TRACE.records()).
+
+Extractors check TRACE.on once per report; a report that isn't being
+traced runs the plain FSMs, which have no trace checks in them at all.
+Sampled reports run traced copies of the FSMs, made from the same
+source (see define_fsms), so they can't drift apart.
+
+Records are made in the scoring process: with workers > 1, use a path
+(each worker appends whole lines to it); a ring buffer would stay in
+the workers.
+'''
+import collections
+import contextlib
+import json
+import os
+import sys
+
+from instrument import outcome
+
+RING_SIZE = 1000
+
+class TraceRecord:
+    '''One traced report. windows: list of dicts with 'start' (where
+    the window begins), 'tokens' (as read), 'steps' (token index,
+    state before, state after, for each change of state) and 'end'.'''
+    __slots__ = ('extractor', 'seq', 'text_len', 'windows', 'notes',
+                 'result')
+
+    def __init__(self, extractor, seq, text_len):
+        self.extractor = extractor
+        self.seq = seq
+        self.text_len = text_len
+        self.windows = []
+        self.notes = {}
+        self.result = None
+
+    def window(self, start=None):
+        w = {'start': start, 'tokens': [], 'steps': [], 'end': None}
+        self.windows.append(w)
+        return w
+
+    def note(self, **kw):
+        self.notes.update(kw)
+
+    def to_dict(self):
+        d = {'extractor': self.extractor, 'seq': self.seq,
+             'text_len': self.text_len, 'windows': self.windows,
+             'result': self.result}
+        if self.notes:
+            d['notes'] = self.notes
+        return d
+
+class Tracer:
+
+    def __init__(self):
+        self.on = False
+        self.ring = collections.deque(maxlen=RING_SIZE)
+        self.path = None
+        self.file = None
+        self.every = 1
+        self.only = None
+        self._seen = 0
+        self._pid = None
+
+    def start(self, path=None, every=1, only=None, capacity=RING_SIZE):
+        '''Start tracing.
+        o path: JSONL file to append records to, or a file object;
+          None for the ring buffer.
+        o every: trace 1 report in every this many.
+        o only: final results to keep records for, e.g. ['NOT FOUND'];
+          'FOUND' stands for any score. None keeps every record.'''
+        self.stop()
+        self.ring = collections.deque(maxlen=capacity)
+        self.path = path
+        self.every = max(1, every)
+        self.only = None if only is None else set(map(str, only))
+        self._seen = 0
+        self.on = True
+
+    def stop(self):
+        self.on = False
+        if self.file is not None and self.path is not None \
+           and not hasattr(self.path, 'write'):
+            self.file.close()
+        self.file = None
+
+    def begin(self, extractor, text):
+        '''A TraceRecord if this report is sampled, else None.'''
+        self._seen += 1
+        if (self._seen - 1) % self.every:
+            return None
+        return TraceRecord(extractor, self._seen, len(text or ''))
+
+    def end(self, rec, result):
+        rec.result = result
+        if self.only is not None:
+            key = outcome(result)
+            if key not in self.only and str(result) not in self.only:
+                return
+        if self.path is None:
+            self.ring.append(rec.to_dict())
+        else:
+            self._write(json.dumps(rec.to_dict(), default=str) + '\n')
+
+    def _write(self, line):
+        if hasattr(self.path, 'write'):
+            self.path.write(line)
+            return
+        # Reopen after a fork, so each pool worker has its own handle.
+        if self.file is None or self._pid != os.getpid():
+            self.file = open(self.path, 'a', buffering=1)
+            self._pid = os.getpid()
+        self.file.write(line)
+
+    def records(self):
+        '''Ring buffer contents, oldest first.'''
+        return list(self.ring)
+
+TRACE = Tracer()
+
+@contextlib.contextmanager
+def tracing(path=None, every=1, only=None, capacity=RING_SIZE):
+    '''TRACE.start(...) for the duration; yields TRACE.'''
+    TRACE.start(path, every, only, capacity)
+    try:
+        yield TRACE
+    finally:
+        TRACE.stop()
+
+def define_fsms(source, namespace):
+    '''Defines, in namespace (a module's globals()), the functions in
+    source twice over: once with the lines tagged #T dropped (the plain
+    FSM), once with the lines tagged #P dropped (the traced FSM). So
+    source is one FSM loop with both def lines, each tagged, and the
+    trace recording on lines of its own.'''
+    for keep, drop in (('#P', '#T'), ('#T', '#P')):
+        lines = []
+        for line in source.splitlines():
+            code = line.rstrip()
+            if code.endswith(drop):
+                continue
+            if code.endswith(keep):
+                line = code[:-len(keep)].rstrip()
+            lines.append(line)
+        name = '<%s fsm %s>' % (namespace.get('__name__'), keep)
+        exec(compile('\n'.join(lines) + '\n', name, 'exec'), namespace)
+
+def print_records(records=None, out=sys.stdout):
+    '''Human-readable dump of records (default: the ring buffer), in
+    the spirit of the old TRC output.'''
+    for r in TRACE.records() if records is None else records:
+        print('---- %s #%d -> %s' % (r['extractor'], r['seq'], r['result']),
+              file=out)
+        for w in r['windows']:
+            print('  window at %s, end %s' % (w['start'], w['end']), file=out)
+            steps = dict((i, (a, b)) for i, a, b in w['steps'])
+            for i, t in enumerate(w['tokens']):
+                if i in steps:
+                    print('    %-16s %s -> %s' % ((t,) + steps[i]), file=out)
+                else:
+                    print('    %s' % t, file=out)
@@ -0,0 +1,284 @@
+'''Run instrumentation: per-stage wall/CPU time, counters, histograms.
+
+    with collecting('runs/mayo-20240101'):     # or METRICS.enable()
+        ...
+    --> runs/mayo-20240101.json (run summary) and .prom (Prometheus text)
+
+Stage times are exclusive ("self" time): entering a stage pauses the
+enclosing one, so e.g. time spent fetching rows while streaming counts
+as db_qy, not score, and the stages add up to the run's wall time.
+Each thread keeps its own stage stack and CPU clock, so with a
+pipelined run (see pipeline) stages overlap and add up to more.
+Stages used by the drivers:
+    db_qy      fetching source rows
+    tokenize   up-front tokenization (NLTK engine; with the fast engine
+               tokenizing is lazy and counted under fsm)
+    fsm        running the FSMs / regexes
+    score      the rest of scoring (anchors, prefilters, cache, ...)
+    db_insert  writing results
+    read/write reading input / writing results files (batch.py)
+    wait       blocked on a full or empty queue between pipeline stages
+Per-report stages, token counts and FSM end states are recorded in the
+process doing the scoring, so with workers > 1 only the driver-level
+stages (db_qy, score -- i.e. waiting on the pool -- and db_insert) show.
+
+When not collecting, METRICS.on is False; hot paths test that before
+doing anything else, and timer()/timed() hand back no-op wrappers.
+'''
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the per-report token count histogram buckets.
+TOKEN_BUCKETS = [16, 64, 256, 1024, 4096, 16384]
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        return False
+
+_NOOP_TIMER = _NoopTimer()
+
+class _Timer:
+    __slots__ = ('m', 'stage')
+
+    def __init__(self, m, stage):
+        self.m = m
+        self.stage = stage
+
+    def __enter__(self):
+        self.m.enter(self.stage)
+        return self
+
+    def __exit__(self, *a):
+        self.m.exit()
+        return False
+
+class Metrics:
+
+    def __init__(self):
+        self.on = False
+        self.reset()
+
+    def reset(self):
+        self.wall = collections.defaultdict(float)
+        self.cpu = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+        self.hists = collections.defaultdict(collections.Counter)
+        self.tokens = collections.defaultdict(
+            lambda: {'count': 0, 'sum': 0, 'max': 0,
+                     'buckets': [0] * (len(TOKEN_BUCKETS) + 1)})
+        self._lock = threading.Lock()
+        # Per-thread stage stack and last (wall, thread CPU) mark; the
+        # resetting thread's bottom stage is 'other', other threads'
+        # time outside any stage isn't counted.
+        self._local = threading.local()
+        self._local.stack = ['other']
+        self._local.mark = (time.perf_counter(), time.thread_time())
+        self.started = time.time()
+        self.elapsed = None
+
+    def enable(self):
+        self.reset()
+        self.on = True
+
+    def disable(self):
+        if self.on:
+            self._charge()
+            self.elapsed = time.time() - self.started
+        self.on = False
+
+    #-------------------------------------------------------------------------
+    # stage timing
+
+    def _charge(self):
+        t = self._local
+        w, c = time.perf_counter(), time.thread_time()
+        if not hasattr(t, 'stack'):
+            t.stack = []
+        elif t.stack:
+            stage = t.stack[-1]
+            with self._lock:
+                self.wall[stage] += w - t.mark[0]
+                self.cpu[stage] += c - t.mark[1]
+        t.mark = (w, c)
+        return t
+
+    def enter(self, stage):
+        self._charge().stack.append(stage)
+        with self._lock:
+            self.calls[stage] += 1
+
+    def exit(self):
+        self._charge().stack.pop()
+
+    def timer(self, stage):
+        '''Context manager timing its body as stage.'''
+        if not self.on:
+            return _NOOP_TIMER
+        return _Timer(self, stage)
+
+    def timed(self, stage, it):
+        '''Iterator over it, with the time spent producing each item
+        charged to stage.'''
+        if not self.on:
+            return it
+        return self._timed(stage, iter(it))
+
+    def _timed(self, stage, it):
+        while True:
+            self.enter(stage)
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield x
+
+    #-------------------------------------------------------------------------
+    # counts
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, key):
+        '''Count one occurrence of key in histogram name.'''
+        with self._lock:
+            self.hists[name][str(key)] += 1
+
+    def report_tokens(self, extractor, n):
+        with self._lock:
+            t = self.tokens[extractor]
+            t['count'] += 1
+            t['sum'] += n
+            t['max'] = max(t['max'], n)
+            for i, le in enumerate(TOKEN_BUCKETS):
+                if n <= le:
+                    t['buckets'][i] += 1
+                    break
+            else:
+                t['buckets'][-1] += 1
+
+    #-------------------------------------------------------------------------
+    # export
+
+    def summary(self):
+        if self.on:
+            self._charge()
+        elapsed = (self.elapsed if self.elapsed is not None
+                   else time.time() - self.started)
+        rows = dict((k[len('rows.'):], v) for k, v in self.counters.items()
+                    if k.startswith('rows.'))
+        return {
+            'started': self.started,
+            'elapsed_secs': elapsed,
+            'stages': dict((s, {'wall_secs': self.wall[s],
+                                'cpu_secs': self.cpu[s],
+                                'calls': self.calls[s]})
+                           for s in self.wall),
+            'counters': dict(self.counters),
+            'rows_per_sec': dict((k, v / elapsed if elapsed else None)
+                                 for k, v in rows.items()),
+            'histograms': dict((k, dict(v)) for k, v in self.hists.items()),
+            'report_tokens': dict(self.tokens),
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=1, sort_keys=True)
+
+    def to_prometheus(self, prefix='endoscopy'):
+        s = self.summary()
+        out = []
+        def metric(name, typ, samples):
+            out.append('# TYPE %s_%s %s' % (prefix, name, typ))
+            for labels, v in samples:
+                lbl = ','.join('%s="%s"' % kv for kv in labels)
+                out.append('%s_%s%s %s' % (prefix, name,
+                                           '{%s}' % lbl if lbl else '', v))
+        metric('stage_seconds_total', 'counter',
+               [((('stage', k), ('clock', clock)), v[clock + '_secs'])
+                for k, v in sorted(s['stages'].items())
+                for clock in ('wall', 'cpu')])
+        metric('stage_calls_total', 'counter',
+               [((('stage', k),), v['calls'])
+                for k, v in sorted(s['stages'].items())])
+        metric('events_total', 'counter',
+               [((('name', k),), v) for k, v in sorted(s['counters'].items())])
+        metric('rows_per_second', 'gauge',
+               [((('extractor', k),), v)
+                for k, v in sorted(s['rows_per_sec'].items())])
+        metric('outcomes_total', 'counter',
+               [((('histogram', h), ('key', k)), v)
+                for h, d in sorted(s['histograms'].items())
+                for k, v in sorted(d.items())])
+        name = 'report_tokens'
+        out.append('# TYPE %s_%s histogram' % (prefix, name))
+        for x, t in sorted(s['report_tokens'].items()):
+            cum = 0
+            for le, n in zip(TOKEN_BUCKETS + ['+Inf'], t['buckets']):
+                cum += n
+                out.append('%s_%s_bucket{extractor="%s",le="%s"} %d'
+                           % (prefix, name, x, le, cum))
+            out.append('%s_%s_sum{extractor="%s"} %d'
+                       % (prefix, name, x, t['sum']))
+            out.append('%s_%s_count{extractor="%s"} %d'
+                       % (prefix, name, x, t['count']))
+        out.append('%s_run_seconds %s' % (prefix, s['elapsed_secs']))
+        return '\n'.join(out) + '\n'
+
+    def write(self, prefix):
+        '''Write prefix.json and prefix.prom.'''
+        d = os.path.dirname(prefix)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with open(prefix + '.json', 'w') as f:
+            f.write(self.to_json())
+        with open(prefix + '.prom', 'w') as f:
+            f.write(self.to_prometheus())
+
+class Tally:
+    '''Wraps an iterable, counting (in n) the items taken from it.'''
+    __slots__ = ('it', 'n')
+
+    def __init__(self, it):
+        self.it = iter(it)
+        self.n = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        x = next(self.it)
+        self.n += 1
+        return x
+
+def outcome(score):
+    '''Histogram key for a final score.'''
+    if score in ('NOT FOUND', 'ERROR', 'BUDGET EXCEEDED', None):
+        return str(score)
+    return 'FOUND'
+
+METRICS = Metrics()
+
+@contextlib.contextmanager
+def collecting(prefix):
+    '''Collect METRICS for the duration, then write them out under
+    prefix (see Metrics.write). A no-op when prefix is None/False, or
+    when something further out is already collecting.'''
+    if not prefix or METRICS.on:
+        yield METRICS
+        return
+    METRICS.enable()
+    try:
+        yield METRICS
+    finally:
+        METRICS.disable()
+        METRICS.write(prefix)
@@ -0,0 +1,59 @@
+'''Process-pool scoring.
+
+Workers are started once per run; each one imports the extractor module
+and warms it up (NLTK models, compiled regexes) in the pool initializer,
+so that cost is paid once per process rather than once per task.
+'''
+import collections
+import os
+from common import *
+
+# Default number of worker processes when a caller asks for parallel
+# scoring but doesn't say how many.
+WORKERS = os.cpu_count() or 1
+
+# Reports handed to a worker per task.
+POOL_CHUNK = 64
+
+# How many chunks per worker may be in flight at once; bounds memory
+# when the input is a stream.
+IN_FLIGHT_PER_WORKER = 2
+
+WARMUP_TEXT = ('Mayo score 1. Rutgeerts i1. SES-CD total score was 1. '
+               'Patient tolerated the procedure well.')
+
+# Set in each worker by _init_worker.
+_fn = None
+
+def _init_worker(fn, warmup):
+    global _fn
+    _fn = fn
+    if warmup:
+        try:
+            warmup(WARMUP_TEXT)
+        except Exception:
+            # Warm-up is an optimization only; real errors will surface
+            # on real input.
+            pass
+
+def _apply_chunk(items):
+    return [_fn(x) for x in items]
+
+def pool_imap(fn, items, workers=WORKERS, chunk_size=POOL_CHUNK, warmup=None):
+    '''Generator; yields fn(x) for each x in items, in input order,
+    computed in a pool of worker processes.
+    o fn, warmup: must be picklable, i.e., module-level functions.
+    o warmup: optional callable run once per worker on a sample report.
+    Only workers * IN_FLIGHT_PER_WORKER chunks are outstanding at any
+    time, so items may be a (large) stream.'''
+    import multiprocessing
+    max_pending = max(1, workers * IN_FLIGHT_PER_WORKER)
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(fn, warmup)) as pool:
+        pending = collections.deque()
+        for chunk in chunked(items, chunk_size):
+            pending.append(pool.apply_async(_apply_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
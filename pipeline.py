@@ -0,0 +1,134 @@
+'''Overlapped fetch / score / write.
+
+A streaming run is three stages -- fetch rows, score them, write the
+results -- which otherwise take turns: the CPU idles while the cursor
+fetches or the inserts run, and the database idles while reports are
+scored. run_pipelined runs them at the same time instead:
+
+    reader thread   source() --> chunks --> queue
+    calling thread  queue --> score(rows) --> chunks --> queue
+    writer thread   queue --> sink(rows)
+
+(scoring stays on the calling thread, since it may drive the process
+pool; fetching and inserting are mostly waiting on the database, so
+they lose little to the GIL). The queues hold at most QUEUE_DEPTH
+chunks of PIPE_CHUNK rows, so a stage that gets ahead blocks until the
+next catches up, and memory stays bounded. Run time approaches that of
+the slowest stage rather than the sum of all three.
+
+If any stage fails, the others are stopped (a stage blocked on a queue
+notices within POLL_SECS), the writer's sink sees PipelineAborted raised
+from its input -- so e.g. a BulkLoader rolls back -- and the first
+error is re-raised to the caller.
+'''
+import queue
+import threading
+from common import *
+from instrument import *
+
+# Chunks buffered between stages.
+QUEUE_DEPTH = 8
+
+# Rows per chunk passed between stages.
+PIPE_CHUNK = 500
+
+# How often a stage blocked on a queue checks whether to give up.
+POLL_SECS = 0.1
+
+_DONE = object()
+
+class PipelineAborted(Exception):
+    '''Raised in a stage when another stage has failed.'''
+
+class _Pipe:
+
+    def __init__(self, depth):
+        self.q_in = queue.Queue(depth)
+        self.q_out = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.error = None
+
+    def fail(self, ex):
+        if self.error is None:
+            self.error = ex
+        self.stop.set()
+
+    def put(self, q, item):
+        with METRICS.timer('wait'):
+            while True:
+                if self.stop.is_set():
+                    raise PipelineAborted()
+                try:
+                    q.put(item, timeout=POLL_SECS)
+                    return
+                except queue.Full:
+                    pass
+
+    def drain(self, q):
+        '''Generator; rows from q's chunks, up to _DONE.'''
+        while True:
+            with METRICS.timer('wait'):
+                while True:
+                    if self.stop.is_set():
+                        raise PipelineAborted()
+                    try:
+                        chunk = q.get(timeout=POLL_SECS)
+                        break
+                    except queue.Empty:
+                        pass
+            if chunk is _DONE:
+                return
+            yield from chunk
+
+    def feed(self, q, rows, chunk_size):
+        for chunk in chunked(rows, chunk_size):
+            self.put(q, chunk)
+        self.put(q, _DONE)
+
+class _Stage(threading.Thread):
+
+    def __init__(self, pipe, name, fn):
+        super().__init__(name=name, daemon=True)
+        self.pipe = pipe
+        self.fn = fn
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = self.fn()
+        except BaseException as ex:
+            self.pipe.fail(ex)
+
+def run_pipelined(source, score, sink, depth=QUEUE_DEPTH,
+                  chunk_size=PIPE_CHUNK):
+    '''Run source, score and sink concurrently (see module doc).
+    o source: callable returning an iterable of rows; called in the
+      reader thread, so e.g. a DB cursor is opened (and closed) there.
+    o score: callable(iterable of rows) returning an iterable of scored
+      rows; run in the calling thread.
+    o sink: callable(iterable of scored rows); run in the writer thread.
+    Returns sink's result.'''
+    p = _Pipe(depth)
+
+    def read():
+        rows = iter(source())
+        try:
+            p.feed(p.q_in, rows, chunk_size)
+        finally:
+            close = getattr(rows, 'close', None)
+            if close:
+                close()
+
+    reader = _Stage(p, 'pipeline-read', read)
+    writer = _Stage(p, 'pipeline-write', lambda: sink(p.drain(p.q_out)))
+    reader.start()
+    writer.start()
+    try:
+        p.feed(p.q_out, score(p.drain(p.q_in)), chunk_size)
+    except BaseException as ex:
+        p.fail(ex)
+    reader.join()
+    writer.join()
+    if p.error is not None:
+        raise p.error
+    return writer.result
@@ -0,0 +1,93 @@
+'''Compact, columnar storage for scored rows.
+
+A scored row is a handful of ID fields plus a score or two, but as a
+dict it costs a couple of hundred bytes before any of its values; and
+the non-streaming drivers used to hold one per source row until the
+final insert. A RecordBatch keeps one list per column instead -- about
+8 bytes per field -- and the writers (dbio.db_insert_chunked,
+bulkload.BulkLoader) take one directly.
+
+    out = RecordBatch(score_all(score_row, consume(rows)))
+    db_insert_chunked(db_spec, DEST_TABLE, out)
+
+Rows needn't all have the same keys (the combined driver's don't):
+a column first seen part way through is back-filled as absent, and
+absent fields are left out of the dicts a batch hands back.
+'''
+
+# Marks a field a row didn't have.
+_ABSENT = object()
+
+class RecordBatch:
+    '''Rows (dicts) stored column by column. Iterating gives the rows
+    back as dicts; tuples() gives parameter tuples for executemany.'''
+    __slots__ = ('columns', '_data', '_index', '_n')
+
+    def __init__(self, rows=()):
+        '''rows: any iterable of dicts, consumed one at a time, so (if
+        nothing else holds them) each dict is freed once stored.'''
+        self.columns = []
+        self._data = []
+        self._index = {}
+        self._n = 0
+        for row in rows:
+            self.append(row)
+
+    def _add_column(self, c):
+        self._index[c] = len(self.columns)
+        self.columns.append(c)
+        self._data.append([_ABSENT] * self._n)
+
+    def append(self, row):
+        index = self._index
+        for c in row:
+            if c not in index:
+                self._add_column(c)
+        if len(row) == len(self.columns):
+            for c, col in zip(self.columns, self._data):
+                col.append(row[c])
+        else:
+            for c, col in zip(self.columns, self._data):
+                col.append(row.get(c, _ABSENT))
+        self._n += 1
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        return dict((c, col[i]) for c, col in zip(self.columns, self._data)
+                    if col[i] is not _ABSENT)
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self[i]
+
+    def tuples(self, columns=None, start=0, stop=None):
+        '''Iterator of one tuple of values per row (from start to stop),
+        for columns (default: all of them, in first-seen order); absent
+        fields are None.'''
+        cols = [self._data[self._index[c]] if c in self._index else None
+                for c in (columns or self.columns)]
+        stop = self._n if stop is None else min(stop, self._n)
+        for i in range(start, stop):
+            yield tuple(None if col is None or col[i] is _ABSENT else col[i]
+                        for col in cols)
+
+    def dicts(self, start=0, stop=None):
+        '''List of rows start..stop, as dicts.'''
+        stop = self._n if stop is None else min(stop, self._n)
+        return [self[i] for i in range(start, stop)]
+
+def consume(rows):
+    '''Generator over rows (a list), emptying it as it goes, so the
+    list doesn't keep rows (and their report text) alive after they've
+    been handed on. The list is the caller's: it's left empty (and in
+    reverse order, if not fully consumed), so pass a copy of any list
+    that's still needed.'''
+    rows.reverse()
+    while rows:
+        yield rows.pop()
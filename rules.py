@@ -0,0 +1,554 @@
+'''Declarative score rules, compiled into one extraction engine.
+
+Each score the endoscopy_* modules extract comes down to some anchors,
+some classes of keyword, which integers count, and a small state
+machine (or a regex). A Rule says just that, as data; e.g. (with made
+up word lists)
+
+    UCEIS = register(Rule(
+        'uceis', anchors=['uceis'],
+        keywords=[('vascular', ['vascular']), ('bleeding', ['bleeding']),
+                  ('erosions', ['erosions', 'ulcers'])],
+        values=[('subscore', 0, 3), ('total', 4, 8)],
+        states={'*': {'vascular': 'goto sub', 'bleeding': 'goto sub',
+                      'erosions': 'goto sub'},
+                'entry': {'subscore': 'accept', 'total': 'accept'},
+                'sub': {'subscore': 'goto entry'}},
+        max_skips=10))
+
+compile_rules(rules) turns a set of rules into one RuleEngine:
+o one AnchorMatcher over every rule's anchors, so each report is
+  scanned once for all of them;
+o one token-class memo (a common.TokenClasses), giving a token's class
+  under every rule in a single dict lookup;
+o one transition table holding every rule's states.
+Rules share one tokenization of a report (splitters are applied to its
+tokens afterwards), so adding a score adds neither a table scan nor a
+tokenizing pass -- just its own windows through the table.
+
+Rule fields:
+o name: the score (and its column).
+o anchors: where to look (case-insensitive). prefilters: words a text
+  must mention for the rule to apply (default: the anchors), as in the
+  extractors' SQL prefilters.
+o columns: text columns of a row to score, in order; the first with a
+  score wins (see RuleEngine.score_row).
+Token rules:
+o keywords: list of (class, words); a word's first class wins.
+o values: list of (class, lo, hi) for integers; the first range wins.
+  Other integers are class 'int', tokens is_integer accepts but int()
+  doesn't (e.g. '2.') 'bad_int', and anything else 'other'.
+o states: dict of state -> dict of class -> action, '*' giving actions
+  for every state. A value class or bad_int with no action takes int's,
+  and any class with none takes default. start: the first state
+  (default: the first listed). Actions:
+    'goto S'      move to state S
+    'capture S'   the token's value becomes the window's result; move to S
+    'accept'      the token itself is the window's result; stop
+    'stop'        stop, keeping the result so far
+    'error'       stop; the window has no result
+    'skip'        stay; stop after more than max_skips in a row (if set)
+o window: tokens per window (None: to the end of the text).
+o start_at: 'token' -- a window starts at each token that is an anchor
+  and reads on through the text (as Mayo); 'end' -- a window is the
+  tokens after each anchor's end (as SES-CD).
+Regex rules (pattern instead of states): pattern is tried at each
+anchor, non-overlapping; the trailing integer of each match's group is
+a result.
+For both, combine is 'max' (the highest integer result) or 'first' (the
+first integer result, as found), formatted with format if given.
+
+The built-in rules (mayo_rule etc.) are built from the extractor
+modules' own tunables and give the same scores as their find_score.
+'''
+import itertools
+import re
+from common import *
+from instrument import *
+from score_cache import *
+
+# Actions, in the compiled table; a non-negative action is the state to
+# move to, and A_CAPTURE - s is capture then move to state s.
+A_SKIP = -1
+A_STOP = -2
+A_ACCEPT = -3
+A_ERROR = -4
+A_CAPTURE = -5
+
+# Classes every token rule has, after its keyword and value classes.
+BASE_CLASSES = ('int', 'bad_int', 'other')
+
+_TRAILING_INT = re.compile(r'\d+$').search
+
+class Rule:
+    '''One score, declaratively; see module doc.'''
+
+    def __init__(self, name, anchors, prefilters=None, columns=('rpt',),
+                 keywords=(), values=(), states=None, start=None,
+                 default='skip', max_skips=None, window=None, splitters=(),
+                 start_at='token', pattern=None, group=0, combine='max',
+                 format=None):
+        self.name = name
+        self.anchors = list(anchors)
+        self.prefilters = list(anchors if prefilters is None else prefilters)
+        self.columns = list(columns)
+        self.keywords = [(c, list(words)) for c, words in keywords]
+        self.values = [tuple(v) for v in values]
+        self.states = dict((s, dict(a)) for s, a in (states or {}).items())
+        self.start = start or next((s for s in self.states if s != '*'),
+                                   None)
+        self.default = default
+        self.max_skips = max_skips
+        self.window = window
+        self.splitters = list(splitters)
+        self.start_at = start_at
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+        self.pattern = pattern
+        self.group = group
+        self.combine = combine
+        self.format = format
+        if (pattern is None) == (self.start is None):
+            raise ValueError('rule %s needs states or a pattern, not both'
+                             % name)
+        if combine not in ('max', 'first'):
+            raise ValueError('rule %s: combine must be max or first' % name)
+        if start_at not in ('token', 'end'):
+            raise ValueError('rule %s: start_at must be token or end' % name)
+
+    def classes(self):
+        '''Names of this rule's token classes, in compiled order.'''
+        out = [c for c, words in self.keywords]
+        for c in [v[0] for v in self.values] + list(BASE_CLASSES):
+            if c not in out:
+                out.append(c)
+        return out
+
+    def version(self):
+        '''Fingerprint of the rule (see score_cache.fingerprint).'''
+        return fingerprint(self.name, self.anchors, self.prefilters,
+                           self.columns, self.keywords, self.values,
+                           sorted(self.states.items()), self.start,
+                           self.default, self.max_skips, self.window,
+                           self.splitters, self.start_at,
+                           self.pattern and self.pattern.pattern,
+                           self.pattern and self.pattern.flags, self.group,
+                           self.combine, self.format, tokenizer_engine(),
+                           work_budget())
+
+    def variant(self, name=None, **changes):
+        '''A copy of this rule (named name), with changes to its fields
+        (any of RULE_FIELDS).'''
+        args = dict((f, getattr(self, f)) for f in RULE_FIELDS)
+        for f in changes:
+            if f not in args:
+                raise ValueError('rule %s has no field %r' % (self.name, f))
+        args.update(changes)
+        return Rule(name or self.name, **args)
+
+    def __repr__(self):
+        return 'Rule(%r)' % self.name
+
+# Rule's fields, besides name.
+RULE_FIELDS = ('anchors', 'prefilters', 'columns', 'keywords', 'values',
+               'states', 'start', 'default', 'max_skips', 'window',
+               'splitters', 'start_at', 'pattern', 'group', 'combine',
+               'format')
+
+#-----------------------------------------------------------------------------
+# registry
+
+RULES = {}
+
+def register(rule):
+    '''Add rule to RULES (replacing any of the same name). Returns it.'''
+    RULES[rule.name] = rule
+    return rule
+
+def mayo_rule():
+    '''endoscopy_mayo's fsm, as a Rule.'''
+    import endoscopy_mayo as m
+    go = {'stop': 'stop', 'sf': 'goto sf', 'rb': 'goto rb',
+          'ma': 'goto ma', 'md': 'goto md', 'total': 'goto total'}
+    prelude = {'subscore': 'goto ready', 'bad_int': 'error'}
+    return Rule(m.SCORE_COLUMN, [m.MAYO], m.PREFILTERS,
+                keywords=[('stop', m.STOP_WORDS), ('sf', m.SF_WORDS),
+                          ('rb', m.RB_WORDS), ('ma', m.MA_WORDS),
+                          ('md', m.MD_WORDS), ('total', [m.TOTAL])],
+                values=[('subscore', 0, 3), ('total_only', 4, 12)],
+                states={'*': go,
+                        'entry': {'subscore': 'accept', 'bad_int': 'error'},
+                        'ready': {},
+                        'sf': prelude, 'rb': prelude, 'md': prelude,
+                        'ma': dict(prelude, subscore='capture ready'),
+                        'total': dict(prelude, total_only='goto ready')},
+                max_skips=m.MAX_SKIPS, splitters=m.SPLITTERS)
+
+def ses_cd_rule():
+    '''endoscopy_ses_cd's fsm, as a Rule.'''
+    import endoscopy_ses_cd as s
+    return Rule(s.SCORE_COLUMN, s.ANCHORS, s.PREFILTERS, s.TEXT_COLUMNS,
+                keywords=[('skip', s.SKIP_WORDS),
+                          ('pertinent', s.PERTINENT_PRELUDES),
+                          ('subscore', s.SUBSCORE_PRELUDES)],
+                states={'entered': {'int': 'accept',
+                                    'pertinent': 'goto pertinent',
+                                    'subscore': 'goto subscore'},
+                        'ready': {'pertinent': 'goto pertinent',
+                                  'subscore': 'goto subscore'},
+                        'subscore': {'int': 'goto ready'},
+                        'pertinent': {'subscore': 'goto subscore',
+                                      'int': 'accept'}},
+                window=s.WINDOW, start_at='end', combine='first')
+
+def rutgeerts_rule():
+    '''endoscopy_rutgeerts's regex, as a Rule.'''
+    import endoscopy_rutgeerts as r
+    return Rule(r.SCORE_COLUMN, r.PREFILTERS, pattern=r.reg_obj, group=3,
+                format='i%d')
+
+BUILTIN_RULES = {'mayo': mayo_rule, 'ses_cd': ses_cd_rule,
+                 'rutgeerts': rutgeerts_rule}
+
+def rule_for(x):
+    '''The Rule for x: a Rule, an extractor module (or its
+    SCORE_COLUMN) with a built-in rule, or the name of one in RULES.'''
+    if isinstance(x, Rule):
+        return x
+    name = getattr(x, 'SCORE_COLUMN', x)
+    if name in RULES:
+        return RULES[name]
+    if name in BUILTIN_RULES:
+        return BUILTIN_RULES[name]()
+    raise KeyError('no rule for %s' % name)
+
+#-----------------------------------------------------------------------------
+# compiling
+
+class _Compiled:
+    '''A rule's place in a RuleEngine.'''
+    __slots__ = ('rule', 'tag', 'k', 'start', 'words', 'prefilters')
+
+class _Doc:
+    '''One text being scored: lowercased copy, anchor index and
+    tokenizations, each made at most once and shared by every rule.'''
+    __slots__ = ('text', '_low', '_index', '_tokens', '_after', '_mentions')
+
+    def __init__(self, text):
+        self.text = text or ''
+        self._low = None
+        self._index = None
+        self._tokens = {}
+        self._after = {}
+        self._mentions = {}
+
+    def low(self):
+        if self._low is None:
+            self._low = self.text.lower()
+        return self._low
+
+    def mentions(self, words):
+        '''As common.mentions_any; words a tuple.'''
+        m = self._mentions.get(words)
+        if m is None:
+            low = self.low()
+            m = self._mentions[words] = any(w in low for w in words)
+        return m
+
+    def spans(self, matcher, tag):
+        if self._index is None:
+            self._index = matcher.index(self.text)
+        return self._index.get(tag)
+
+    def tokens(self, splitters):
+        '''The text's tokens. With splitters, made by splitting the
+        plain tokens (just as into_word_tokens_with_splitters does), so
+        rules that differ only in splitters share the tokenizing.'''
+        key = tuple(splitters)
+        if key not in self._tokens:
+            if key:
+                self._tokens[key] = [
+                    p for t in self.tokens(())
+                    for p in (split_on_splitters(t, key)
+                              if any(sp in t for sp in key) else (t,))]
+            else:
+                self._tokens[key] = into_word_tokens(self.text)
+        return self._tokens[key]
+
+    def after(self, pos, splitters, n):
+        '''Generator; the first n (None: all) tokens after pos, made
+        (lazily) once however many windows of any length read them.'''
+        key = (pos, tuple(splitters))
+        ent = self._after.get(key)
+        if ent is None:
+            ent = self._after[key] = (
+                iter_word_tokens(self.text, pos, list(splitters) or None), [])
+        it, toks = ent
+        i = 0
+        while n is None or i < n:
+            if i == len(toks):
+                t = next(it, None)
+                if t is None:
+                    return
+                toks.append(t)
+            yield toks[i]
+            i += 1
+
+class RuleEngine:
+    '''A set of rules compiled together; see module doc. If eager,
+    windows that start at anchor tokens read one whole-text
+    tokenization, shared by all the rules, even where the tokenizer
+    could tokenize them lazily.'''
+
+    def __init__(self, rules, eager=False):
+        self.rules = []
+        self.eager = eager
+        seen = set()
+        for r in rules:
+            if r.name not in seen:
+                seen.add(r.name)
+                self.rules.append(r)
+        # Rules with the same anchors share a tag (and their spans).
+        tags = {}
+        for r in self.rules:
+            tags.setdefault(tuple(r.anchors), 'a%d' % len(tags))
+        self.matcher = AnchorMatcher(dict((t, list(a))
+                                          for a, t in tags.items()))
+        self.columns = []
+        for r in self.rules:
+            self.columns.extend(c for c in r.columns if c not in self.columns)
+        self.table = []
+        self._compiled = []
+        token_rules = []
+        for r in self.rules:
+            c = _Compiled()
+            c.rule = r
+            c.tag = tags[tuple(r.anchors)]
+            c.words = set(a.lower() for a in r.anchors)
+            c.prefilters = tuple(r.prefilters)
+            if r.pattern is None:
+                c.k = len(token_rules)
+                c.start = self._compile_states(r)
+                token_rules.append(r)
+            self._compiled.append(c)
+        self._token_rules = token_rules
+        self._ids = [dict((c, i) for i, c in enumerate(r.classes()))
+                     for r in token_rules]
+        keywords = {}
+        for k, r in enumerate(token_rules):
+            for cls, words in r.keywords:
+                for w in words:
+                    keywords.setdefault(w, {}).setdefault(k,
+                                                          self._ids[k][cls])
+        self._classes = TokenClasses(self._classify, dict(
+            (w, tuple(ks.get(k, self._value_class(k, w))
+                      for k in range(len(token_rules))))
+            for w, ks in keywords.items()))
+
+    def _compile_states(self, r):
+        '''Append r's states to the table; returns its start state.'''
+        classes = r.classes()
+        fallback = dict((v[0], 'int') for v in r.values)
+        fallback['bad_int'] = 'int'
+        names = [s for s in r.states if s != '*']
+        base = len(self.table)
+        states = dict((s, base + i) for i, s in enumerate(names))
+        if r.start not in states:
+            raise ValueError('rule %s: no state %r' % (r.name, r.start))
+        for s in names:
+            acts = dict(r.states.get('*', {}))
+            acts.update(r.states[s])
+            for cls in acts:
+                if cls not in classes:
+                    raise ValueError('rule %s: no class %r' % (r.name, cls))
+            row = []
+            for cls in classes:
+                act = acts.get(cls)
+                if act is None and cls in fallback:
+                    act = acts.get(fallback[cls])
+                row.append(self._action(r, act or r.default, states))
+            self.table.append(row)
+        return states[r.start]
+
+    def _action(self, r, act, states):
+        op, _, arg = act.partition(' ')
+        if op in ('goto', 'capture'):
+            if arg not in states:
+                raise ValueError('rule %s: no state %r' % (r.name, arg))
+            return states[arg] if op == 'goto' else A_CAPTURE - states[arg]
+        acts = {'skip': A_SKIP, 'stop': A_STOP, 'accept': A_ACCEPT,
+                'error': A_ERROR}
+        if op not in acts or arg:
+            raise ValueError('rule %s: bad action %r' % (r.name, act))
+        return acts[op]
+
+    def _value_class(self, k, t):
+        '''Class of non-keyword token t under the k'th token rule.'''
+        ids = self._ids[k]
+        v = token_int(t)
+        if v is NOT_INT:
+            return ids['other']
+        if v is BAD_INT:
+            return ids['bad_int']
+        for cls, lo, hi in self._token_rules[k].values:
+            if lo <= v <= hi:
+                return ids[cls]
+        return ids['int']
+
+    def _classify(self, t):
+        return tuple(self._value_class(k, t)
+                     for k in range(len(self._token_rules)))
+
+    #-------------------------------------------------------------------------
+    # running
+
+    def _run(self, c, tokens):
+        '''Run c's states over one window of tokens; returns its result,
+        or None.'''
+        memo = self._classes.memo
+        miss = self._classes.miss
+        table = self.table
+        k = c.k
+        state = c.start
+        max_skips = c.rule.max_skips
+        # As in the Mayo fsm, the very first skip is always allowed.
+        skips = 0 if max_skips is None else min(0, max_skips - 1)
+        result = None
+        for t in tokens:
+            cls = memo.get(t)
+            if cls is None:
+                cls = miss(t)
+            act = table[state][cls[k]]
+            if act >= 0:
+                state = act
+                skips = 0
+            elif act == A_SKIP:
+                if max_skips is not None:
+                    if skips >= max_skips:
+                        break
+                    skips += 1
+            elif act <= A_CAPTURE:
+                result = token_int(t)
+                state = A_CAPTURE - act
+                skips = 0
+            elif act == A_ACCEPT:
+                return t
+            elif act == A_STOP:
+                break
+            else:
+                return None
+        return result
+
+    def _windows(self, c, doc, spans):
+        r = c.rule
+        splitters = r.splitters or None
+        if r.start_at == 'end':
+            for b, e in spans:
+                yield doc.after(e, r.splitters, r.window)
+        elif is_lazy_engine() and not self.eager:
+            for w in anchor_token_windows(doc.text, spans, c.words,
+                                          splitters):
+                yield itertools.islice(w, r.window)
+        else:
+            tokens = doc.tokens(r.splitters)
+            for i, t in enumerate(tokens):
+                if t in c.words:
+                    yield token_tail(tokens, i, r.window)
+
+    def _matches(self, c, doc, spans):
+        '''Generator; the trailing integer of c's pattern's group, for
+        each match at an anchor (non-overlapping, as findall).'''
+        match = c.rule.pattern.match
+        end = 0
+        for b, e in spans:
+            if b < end:
+                continue
+            m = match(doc.text, b)
+            if m:
+                end = m.end()
+                v = _TRAILING_INT(m.group(c.rule.group) or '')
+                yield int(v.group()) if v else None
+
+    def _combine(self, c, results):
+        r = c.rule
+        best = None
+        for x in results:
+            if x is None:
+                continue
+            v = x if isinstance(x, int) else token_int(x)
+            if v is NOT_INT:
+                continue
+            if r.combine == 'first' and not (r.format and v is BAD_INT):
+                return r.format % v if r.format else x
+            if v is not BAD_INT and (best is None or v > best):
+                best = v
+        if best is None:
+            return 'NOT FOUND'
+        return r.format % best if r.format else best
+
+    def _score(self, c, doc):
+        '''c's score for doc; BUDGET_EXCEEDED if doc is over its work
+        budget (see common.Budget). As in the drivers, only the chars
+        budget applies to pattern rules.'''
+        try:
+            budget = Budget(doc.text)
+            spans = doc.spans(self.matcher, c.tag)
+            if not spans:
+                return 'NOT FOUND'
+            if c.rule.pattern is not None:
+                return self._combine(c, self._matches(c, doc, spans))
+            budget.anchors(spans)
+            return self._combine(c, (self._run(c, budget.wrap(w))
+                                     for w in self._windows(c, doc, spans)))
+        except BudgetExceeded:
+            return BUDGET_EXCEEDED
+
+    def _applies(self, c, doc):
+        return doc.mentions(c.prefilters)
+
+    def find_scores(self, text):
+        '''Every rule that applies to text (its prefilters), scored over
+        one shared scan and tokenization. Returns dict of rule name ->
+        score ('NOT FOUND' if none).'''
+        doc = _Doc(text)
+        out = {}
+        with METRICS.timer('fsm'):
+            for c in self._compiled:
+                if self._applies(c, doc):
+                    out[c.rule.name] = self._score(c, doc)
+        if METRICS.on:
+            for name, score in out.items():
+                METRICS.observe('result.' + name, outcome(score))
+        return out
+
+    def find_score(self, text, name):
+        '''Score of rule name for text, whether or not it applies.'''
+        c = next(c for c in self._compiled if c.rule.name == name)
+        return self._score(c, _Doc(text))
+
+    def score_row(self, row):
+        '''Replaces the text columns of row (self.columns; a missing or
+        NULL one counts as empty) with the score of each rule that
+        applies to any of its columns, trying them in order until one
+        gives a score. Returns the (mutated) row.'''
+        docs = dict((col, _Doc(row.pop(col, None))) for col in self.columns)
+        with METRICS.timer('fsm'):
+            for c in self._compiled:
+                score = None
+                for col in c.rule.columns:
+                    doc = docs[col]
+                    if not self._applies(c, doc):
+                        continue
+                    score = self._score(c, doc)
+                    if score != 'NOT FOUND':
+                        break
+                if score is not None:
+                    row[c.rule.name] = score
+                    if METRICS.on:
+                        METRICS.observe('result.' + c.rule.name,
+                                        outcome(score))
+        return row
+
+def compile_rules(rules, eager=False):
+    '''One RuleEngine for rules (Rules, or anything rule_for takes).'''
+    return RuleEngine([rule_for(x) for x in rules], eager)
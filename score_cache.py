@@ -0,0 +1,234 @@
+'''On-disk cache of extractor results.
+
+Keyed by (extractor, rules version, hash of normalized report text), so
+templated reports that repeat word for word -- and reports that haven't
+changed since the last run -- are only scored once. The rules version
+is a fingerprint of the extractor's tunables (see each module's
+rules_version) and of the extractor/common source, so changing
+MAX_SKIPS, SPLITTERS, a word list, a regex or the code just makes the
+old entries unreachable; they age out under the size bound.
+
+The cache is only ever touched from the driving process; pool workers
+get cache hits passed through rather than reading the cache themselves.
+'''
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+from common import *
+from parallel import *
+
+CACHE_PATH = 'cache/scores.sqlite'
+
+# Size bound, in entries; when exceeded, least recently used entries are
+# dropped down to CACHE_LOW_WATER of it.
+CACHE_MAX_ENTRIES = 2000000
+CACHE_LOW_WATER = 0.9
+
+# Pending writes (new entries and last-used touches) are flushed to disk
+# this many at a time.
+CACHE_FLUSH_EVERY = 5000
+
+def fingerprint(*parts):
+    '''Short stable hash of parts (anything with a stable repr).'''
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+def code_digest(*modules):
+    '''Fingerprint of the source of modules.'''
+    h = hashlib.sha1()
+    for m in modules:
+        with open(m.__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+def normalize_text(text):
+    '''Collapse whitespace runs, which no extractor's result depends on.
+    Case is kept: tokenization (sentence splitting) and some results
+    (e.g. Rutgeerts 'I2') depend on it.'''
+    return ' '.join(text.split())
+
+def text_key(*texts):
+    '''Cache key (bytes) for one or more texts, any of which may be None.'''
+    h = hashlib.sha1()
+    for t in texts:
+        h.update(b'\x01' if t is None else normalize_text(t).encode('utf-8'))
+        h.update(b'\x00')
+    return h.digest()
+
+class ScoreCache:
+    '''SQLite-backed map of (extractor, version, key) -> JSON value, with
+    LRU eviction beyond max_entries. Reads are immediate; writes are
+    batched (see CACHE_FLUSH_EVERY) -- call flush() or close() when done.'''
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        import sqlite3
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+        self.conn.execute(
+            'create table if not exists scores ('
+            ' extractor text not null, version text not null,'
+            ' key blob not null, value text not null,'
+            ' used real not null,'
+            ' primary key (extractor, version, key)) without rowid')
+        self.conn.execute(
+            'create index if not exists scores_used on scores (used)')
+        self.conn.commit()
+        self._puts = {}
+        self._touches = []
+
+    def get(self, extractor, version, key):
+        '''Cached value, or None.'''
+        v = self._puts.get((extractor, version, key))
+        if v is not None:
+            return json.loads(v[0])
+        r = self.conn.execute(
+            'select value from scores'
+            ' where extractor = ? and version = ? and key = ?',
+            (extractor, version, key)).fetchone()
+        if r is None:
+            return None
+        self._touches.append((time.time(), extractor, version, key))
+        if len(self._touches) >= CACHE_FLUSH_EVERY:
+            self.flush()
+        return json.loads(r[0])
+
+    def put(self, extractor, version, key, value):
+        '''value must be JSON-serializable (and not None).'''
+        self._puts[(extractor, version, key)] = (json.dumps(value),
+                                                 time.time())
+        if len(self._puts) >= CACHE_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany(
+                'insert or replace into scores'
+                ' (extractor, version, key, value, used)'
+                ' values (?, ?, ?, ?, ?)',
+                [k + v for k, v in self._puts.items()])
+            self.conn.executemany(
+                'update scores set used = ?'
+                ' where extractor = ? and version = ? and key = ?',
+                self._touches)
+        self._puts = {}
+        self._touches = []
+        self.evict()
+
+    def evict(self):
+        '''Drop least recently used entries if over max_entries.'''
+        n = self.conn.execute('select count(*) from scores').fetchone()[0]
+        if n <= self.max_entries:
+            return 0
+        drop = n - int(self.max_entries * CACHE_LOW_WATER)
+        with self.conn:
+            self.conn.execute(
+                'delete from scores where (extractor, version, key) in'
+                ' (select extractor, version, key from scores'
+                '  order by used limit ?)', (drop,))
+        return drop
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+#-----------------------------------------------------------------------------
+# scoring through the cache
+
+class BoundCache:
+    '''A ScoreCache as used by one extractor's driver: the extractor's
+    name and current rules version, and which row columns hold the text
+    its score_row consumes.'''
+
+    def __init__(self, cache, extractor, version, text_columns):
+        self.cache = cache
+        self.extractor = extractor
+        self.version = version
+        self.text_columns = text_columns
+        self.hits = 0
+        self.misses = 0
+
+    def score_all(self, score_row, rows, workers=1, warmup=None):
+        '''Like etl.score_all, but rows whose text is in the cache aren't
+        rescored: the text columns are dropped and the cached result
+        columns filled in, exactly as score_row would have. Rows that
+        are scored have their result columns cached.'''
+        pending = collections.deque()
+        fn = functools.partial(_score_unless_hit, score_row)
+
+        def lookups():
+            for row in rows:
+                key = text_key(*[row.get(c) for c in self.text_columns])
+                hit = self.cache.get(self.extractor, self.version, key)
+                if hit is None:
+                    self.misses += 1
+                    base = set(row).difference(self.text_columns)
+                    pending.append((key, base))
+                else:
+                    self.hits += 1
+                    for c in self.text_columns:
+                        row.pop(c, None)
+                    pending.append(None)
+                yield row, hit
+
+        if workers > 1:
+            out = pool_imap(fn, lookups(), workers, warmup=warmup)
+        else:
+            out = map(fn, lookups())
+        for row in out:
+            p = pending.popleft()
+            if p is not None:
+                key, base = p
+                self.cache.put(self.extractor, self.version, key,
+                               {k: v for k, v in row.items()
+                                if k not in base})
+            yield row
+
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+    def report(self, out=sys.stderr):
+        print('%s score cache: %d/%d hits (%.1f%%)'
+              % (self.extractor, self.hits, self.hits + self.misses,
+                 100 * self.hit_rate()), file=out)
+
+def _score_unless_hit(score_row, item):
+    row, hit = item
+    if hit is None:
+        return score_row(row)
+    row.update(hit)
+    return row
+
+@contextlib.contextmanager
+def open_cache(x, cache, text_columns=('rpt',)):
+    '''For extractor module x's driver. cache is as given to the driver:
+    None/False (no caching; yields None), True (cache at CACHE_PATH), a
+    path, or an open ScoreCache (left open). Yields a BoundCache, and on
+    exit flushes it and reports the hit rate.'''
+    if not cache:
+        yield None
+        return
+    own = not isinstance(cache, ScoreCache)
+    if own:
+        cache = ScoreCache(CACHE_PATH if cache is True else cache)
+    modules = [x, sys.modules['common']] + list(getattr(x, 'EXTRACTORS', []))
+    version = fingerprint(x.rules_version(), code_digest(*modules))
+    bound = BoundCache(cache, x.__name__, version, list(text_columns))
+    try:
+        yield bound
+    finally:
+        if own:
+            cache.close()
+        else:
+            cache.flush()
+        bound.report()
@@ -0,0 +1,255 @@
+'''Sharded, resumable runs, for large backfills.
+
+The source rows of an extractor are split into shards, and each shard
+is fetched, scored and written (upserted by the extractor's
+KEY_COLUMNS) on its own; as each finishes it's recorded in a
+checkpoint. Re-running with the same run_id skips the shards already
+done, so an interrupted run loses at most the shards in progress, and
+different nodes can each take some of the shards (see only).
+
+    python shards.py mayo --by range --width 500000 --run-id backfill-1
+    python shards.py ses_cd --by hash --shards 32 --only 0-15 \\
+                     --run-id backfill-1 --no-reset         # on node 2
+
+Shards are either
+o hash: abs(checksum(empi) % shards) -- a patient's reports all land
+  in the same shard. The only choice for SES-CD, whose sections have no
+  order_proc_id.
+o range: order_proc_id in [k * width, (k + 1) * width); shard k. Which
+  shard a row is in doesn't depend on how many there are, so shards
+  stay the same as the source grows.
+
+The checkpoint is the table CHECKPOINT_TABLE (shared by every node
+using the database), or a JSON file (for a single node, or a shared
+filesystem). A run that has no shards done yet starts by emptying the
+destination table, unless reset is False -- as it should be on all but
+one node when a run is spread across several.
+'''
+import argparse
+import importlib
+import json
+import os
+import sys
+from etl import *
+
+EXTRACTORS = {'mayo': 'endoscopy_mayo',
+              'rutgeerts': 'endoscopy_rutgeerts',
+              'ses_cd': 'endoscopy_ses_cd',
+              'combined': 'endoscopy_combined'}
+
+CHECKPOINT_TABLE = 'dm_cadc.ibd.endoscopy_extract_shards'
+
+# Defaults: number of hash shards; order_proc_ids per range shard.
+SHARDS = 16
+RANGE_WIDTH = 1000000
+
+HASH_COLUMN = 'empi'
+RANGE_COLUMN = 'order_proc_id'
+
+#-----------------------------------------------------------------------------
+# checkpoints
+
+class TableCheckpoint:
+    '''Completed shards, in CHECKPOINT_TABLE.'''
+
+    def __init__(self, db_spec, run_id):
+        self.db_spec = db_spec
+        self.run_id = run_id
+        db_stmt(db_spec, slurp_ddl(db_spec,
+                                   'sql/make-endoscopy-shards-table.sql'))
+
+    def done(self, extractor):
+        '''Set of shards of extractor already done in this run.'''
+        conn = db_connect(self.db_spec)
+        try:
+            cur = conn.cursor()
+            cur.execute('select shard from %s where run_id = ? and'
+                        ' extractor = ?' % CHECKPOINT_TABLE,
+                        (self.run_id, extractor))
+            return set(r[0] for r in cur.fetchall())
+        finally:
+            conn.close()
+
+    def mark(self, extractor, shard, rows):
+        conn = db_connect(self.db_spec)
+        try:
+            cur = conn.cursor()
+            cur.execute('delete from %s where run_id = ? and extractor = ?'
+                        ' and shard = ?' % CHECKPOINT_TABLE,
+                        (self.run_id, extractor, shard))
+            cur.execute('insert into %s (run_id, extractor, shard,'
+                        ' rows_written) values (?, ?, ?, ?)'
+                        % CHECKPOINT_TABLE,
+                        (self.run_id, extractor, shard, rows))
+            conn.commit()
+        finally:
+            conn.close()
+
+class FileCheckpoint:
+    '''Completed shards, in a JSON file:
+    {run_id: {extractor: {shard: rows written}}}. Rewritten (atomically)
+    on every mark.'''
+
+    def __init__(self, path, run_id):
+        self.path = path
+        self.run_id = run_id
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def done(self, extractor):
+        d = self._load().get(self.run_id, {}).get(extractor, {})
+        return set(int(k) for k in d)
+
+    def mark(self, extractor, shard, rows):
+        d = self._load()
+        d.setdefault(self.run_id, {}).setdefault(extractor, {})[
+            str(shard)] = rows
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(d, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+def open_checkpoint(db_spec, run_id, checkpoint=None):
+    '''checkpoint: None for the table, else a JSON file path.'''
+    if checkpoint:
+        return FileCheckpoint(checkpoint, run_id)
+    return TableCheckpoint(db_spec, run_id)
+
+#-----------------------------------------------------------------------------
+# shards
+
+def shard_qy(qy, by, shard, n_shards=SHARDS, width=RANGE_WIDTH):
+    '''(qy restricted to shard, params), as for db_qy_stream.'''
+    if by == 'hash':
+        # % before abs: abs(checksum()) overflows on the smallest int.
+        return ('select * from (' + qy + ') q where abs(checksum(q.'
+                + HASH_COLUMN + ') % ?) = ?', (n_shards, shard))
+    if by == 'range':
+        return ('select * from (' + qy + ') q where q.' + RANGE_COLUMN
+                + ' >= ? and q.' + RANGE_COLUMN + ' < ?',
+                (shard * width, (shard + 1) * width))
+    raise ValueError('by must be hash or range')
+
+def all_shards(db_spec, qy, by, n_shards=SHARDS, width=RANGE_WIDTH):
+    '''Every shard of qy's rows: range(n_shards) if by hash; if by
+    range, those from the lowest RANGE_COLUMN value's to the highest's.'''
+    if by == 'hash':
+        return list(range(n_shards))
+    r = db_qy(db_spec, 'select min(q.%s) lo, max(q.%s) hi from (%s) q'
+              % (RANGE_COLUMN, RANGE_COLUMN, qy))[0]
+    if r['lo'] is None:
+        return []
+    return list(range(int(r['lo']) // width, int(r['hi']) // width + 1))
+
+def parse_shards(spec):
+    '''e.g. '0-3,7' --> [0, 1, 2, 3, 7]'''
+    out = []
+    for part in spec.split(','):
+        lo, _, hi = part.partition('-')
+        out.extend(range(int(lo), int(hi or lo) + 1))
+    return out
+
+#-----------------------------------------------------------------------------
+# running
+
+def _source_qy(x):
+    return x.pertinent_qy() if hasattr(x, 'pertinent_qy') else x.PERTINENT_QY
+
+def _reset(x, db_spec):
+    if hasattr(x, 'reset_dest_tables'):
+        x.reset_dest_tables(db_spec)
+    else:
+        x.reset_dest_table(db_spec)
+
+def run_shard(x, db_spec, qy, params, fetch_size=FETCH_SIZE,
+              chunk_size=CHUNK_SIZE, workers=1, cache=None,
+              pipelined=False):
+    '''Fetch, score and upsert one shard's rows for extractor module x.
+    Returns number of rows written.'''
+    warmup = getattr(x, 'find_score', None) or x.find_scores
+    def sink(scored):
+        if hasattr(x, 'write_split'):
+            return sum(x.write_split(db_spec, scored, chunk_size,
+                                     upsert=True).values())
+        return db_upsert_chunked(db_spec, x.DEST_TABLE, x.KEY_COLUMNS,
+                                 scored, chunk_size)
+    batch = getattr(x, 'score_rows', None)
+    return run_stages(lambda: db_qy_stream(db_spec, qy, fetch_size, params),
+                      lambda rows: score_all(x.score_row, rows, workers,
+                                             warmup, cache, batch),
+                      sink, pipelined)
+
+def run_sharded(x, db_spec=None, by='hash', n_shards=SHARDS,
+                width=RANGE_WIDTH, only=None, run_id='default',
+                checkpoint=None, reset=True, fetch_size=FETCH_SIZE,
+                chunk_size=CHUNK_SIZE, workers=1, cache=None,
+                pipelined=False, metrics=None, progress=None):
+    '''Sharded run of extractor module x (see module doc), skipping the
+    shards already done under run_id.
+    o only: shards to run (default all); the rest are left to others.
+    o checkpoint: None (CHECKPOINT_TABLE) or a JSON file path.
+    o progress: optional callable(shard, rows) after each shard.
+    The other options are as for the drivers' doall.
+    Returns dict of shard -> rows written, for shards run this time.'''
+    name = x.__name__.replace('endoscopy_', '')
+    if by == 'range' and RANGE_COLUMN not in getattr(x, 'KEY_COLUMNS',
+                                                     [RANGE_COLUMN]):
+        raise ValueError('%s rows have no %s; shard by hash'
+                         % (name, RANGE_COLUMN))
+    text_columns = getattr(x, 'TEXT_COLUMNS', ['rpt'])
+    with collecting(metrics), pooled(db_spec, True) as db_spec, \
+         open_cache(x, cache, text_columns) as c:
+        ckpt = open_checkpoint(db_spec, run_id, checkpoint)
+        done = ckpt.done(name)
+        if reset and not done:
+            _reset(x, db_spec)
+        qy = _source_qy(x)
+        shards = only if only is not None else all_shards(
+            db_spec, qy, by, n_shards, width)
+        out = {}
+        for shard in shards:
+            if shard in done:
+                continue
+            sqy, params = shard_qy(qy, by, shard, n_shards, width)
+            n = run_shard(x, db_spec, sqy, params, fetch_size, chunk_size,
+                          workers, c, pipelined)
+            ckpt.mark(name, shard, n)
+            out[shard] = n
+            if progress:
+                progress(shard, n)
+        return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('extractor', choices=sorted(EXTRACTORS))
+    ap.add_argument('--by', choices=['hash', 'range'], default='hash')
+    ap.add_argument('--shards', type=int, default=SHARDS)
+    ap.add_argument('--width', type=int, default=RANGE_WIDTH)
+    ap.add_argument('--only', help="shards to run, e.g. '0-3,7'")
+    ap.add_argument('--run-id', default='default')
+    ap.add_argument('--checkpoint', help='JSON file instead of the table')
+    ap.add_argument('--no-reset', action='store_true')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--pipelined', action='store_true')
+    ap.add_argument('--metrics', help='path prefix for run metrics')
+    ap.add_argument('--db-spec', help='DB spec JSON file (default %s)'
+                    % DB_SPEC_PATH)
+    args = ap.parse_args(argv)
+    x = importlib.import_module(EXTRACTORS[args.extractor])
+    db_spec = slurpj(args.db_spec) if args.db_spec else None
+    def progress(shard, n):
+        print('shard %d: %d rows' % (shard, n), file=sys.stderr)
+    out = run_sharded(x, db_spec, by=args.by, n_shards=args.shards, width=args.width,
+                      only=parse_shards(args.only) if args.only else None,
+                      run_id=args.run_id, checkpoint=args.checkpoint,
+                      reset=not args.no_reset, workers=args.workers,
+                      pipelined=args.pipelined, metrics=args.metrics,
+                      progress=progress)
+    print('%d shards, %d rows' % (len(out), sum(out.values())))
+
+if __name__ == '__main__':
+    main()
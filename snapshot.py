@@ -0,0 +1,366 @@
+'''Local snapshots of an extractor's source rows, for re-scoring runs.
+
+Tuning MAX_SKIPS, SPLITTERS, a word list or a regex means re-scoring
+the same reports again and again; rather than query them over the
+network each time, export them once:
+
+    python snapshot.py export mayo -o snapshots/mayo.snap [--db-spec f]
+    python snapshot.py score mayo snapshots/mayo.snap -o scores.jsonl \\
+                       [--workers 4] [--tokenizer fast]
+    python snapshot.py info snapshots/mayo.snap
+
+(batch.py also takes .snap files as input). A snapshot holds the rows
+the extractor's PERTINENT_QY selects. It's read through mmap, so
+opening one costs nothing however big it is, each text is decoded
+straight from its slice of the mapping when its row is read, and pool
+workers each map the file themselves (see score_snapshot) -- so they
+share it through the page cache rather than have it pickled to them.
+
+Layout (int64s little-endian):
+
+    MAGIC
+    blob       every text value, UTF-8, back to back
+    ids        each row's other columns as a JSON array, back to back
+    (padding to a multiple of 8 bytes)
+    text_ends  int64 per text (row-major, text_columns order): where it
+               ends in blob
+    id_ends    int64 per row: where its JSON ends in ids
+    nulls      one byte per text: 1 if NULL
+    meta       JSON: columns, text_columns, rows, section offsets, ...
+    int64      length of meta
+    MAGIC
+
+Non-text values go through JSON: dates and times come back as ISO
+strings, and Decimals as ints (if whole) or strings.
+'''
+import argparse
+import array
+import datetime
+import decimal
+import functools
+import importlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from etl import *
+
+MAGIC = b'ENDOSNP1'
+
+EXTRACTORS = {'mayo': 'endoscopy_mayo',
+              'rutgeerts': 'endoscopy_rutgeerts',
+              'ses_cd': 'endoscopy_ses_cd',
+              'combined': 'endoscopy_combined'}
+
+# Rows per task handed to a pool worker by score_snapshot.
+SNAPSHOT_TASK = 2000
+
+_LITTLE = sys.byteorder == 'little'
+
+def _json_default(v):
+    if isinstance(v, (datetime.date, datetime.time)):
+        return v.isoformat()
+    if isinstance(v, decimal.Decimal):
+        return int(v) if v == v.to_integral_value() else str(v)
+    if isinstance(v, bytes):
+        return v.hex()
+    raise TypeError('%r is not JSON serializable' % (v,))
+
+def _int64s(a):
+    '''array('q') a as little-endian bytes.'''
+    if not _LITTLE:
+        a = array.array('q', a)
+        a.byteswap()
+    return a.tobytes()
+
+#-----------------------------------------------------------------------------
+# writing
+
+class SnapshotWriter:
+    '''Writes rows (dicts, all with the same columns) to a snapshot at
+    path, which appears (atomically) on close().'''
+
+    def __init__(self, path, text_columns, meta=None):
+        self.path = path
+        self.text_columns = list(text_columns)
+        self.columns = None
+        self.meta = dict(meta or {})
+        self.n = 0
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._tmp = path + '.tmp'
+        self._f = open(self._tmp, 'wb')
+        self._f.write(MAGIC)
+        self._ids = tempfile.TemporaryFile(dir=d)
+        self._blob_len = 0
+        self._ids_len = 0
+        self._text_ends = array.array('q')
+        self._id_ends = array.array('q')
+        self._nulls = bytearray()
+
+    def write(self, row):
+        if self.columns is None:
+            self.columns = list(row)
+            self._id_columns = [c for c in self.columns
+                                if c not in self.text_columns]
+        for c in self.text_columns:
+            v = row.get(c)
+            if v is None:
+                self._nulls.append(1)
+            else:
+                b = v.encode('utf-8')
+                self._f.write(b)
+                self._blob_len += len(b)
+                self._nulls.append(0)
+            self._text_ends.append(self._blob_len)
+        b = json.dumps([row.get(c) for c in self._id_columns],
+                       default=_json_default).encode('utf-8')
+        self._ids.write(b)
+        self._ids_len += len(b)
+        self._id_ends.append(self._ids_len)
+        self.n += 1
+
+    def write_all(self, rows):
+        for row in rows:
+            self.write(row)
+        return self.n
+
+    def close(self):
+        f = self._f
+        self._ids.seek(0)
+        shutil.copyfileobj(self._ids, f)
+        self._ids.close()
+        pos = len(MAGIC) + self._blob_len + self._ids_len
+        pad = -pos % 8
+        f.write(b'\0' * pad)
+        pos += pad
+        meta = dict(self.meta,
+                    columns=self.columns or list(self.text_columns),
+                    text_columns=self.text_columns, rows=self.n,
+                    blob=len(MAGIC), ids=len(MAGIC) + self._blob_len,
+                    text_ends=pos,
+                    id_ends=pos + 8 * len(self._text_ends),
+                    nulls=pos + 8 * (len(self._text_ends) + self.n))
+        f.write(_int64s(self._text_ends))
+        f.write(_int64s(self._id_ends))
+        f.write(bytes(self._nulls))
+        m = json.dumps(meta).encode('utf-8')
+        f.write(m)
+        f.write(struct.pack('<q', len(m)))
+        f.write(MAGIC)
+        f.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._f.close()
+        self._ids.close()
+        os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, ex, tb):
+        if typ is None:
+            self.close()
+        else:
+            self.abort()
+
+#-----------------------------------------------------------------------------
+# reading
+
+class Snapshot:
+    '''A snapshot file, memory-mapped. len() is its number of rows;
+    row(i) and rows(start, stop) give them back as dicts, decoding each
+    text from the mapping only then.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = self._mv = memoryview(self._mm)
+        k = len(MAGIC)
+        if mv[:k] != MAGIC or mv[-k:] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a snapshot' % path)
+        m_len, = struct.unpack('<q', mv[-k-8:-k])
+        self.meta = json.loads(str(mv[-k-8-m_len:-k-8], 'utf-8'))
+        self.columns = self.meta['columns']
+        self.text_columns = self.meta['text_columns']
+        self._id_columns = [c for c in self.columns
+                            if c not in self.text_columns]
+        self.n = self.meta['rows']
+        nt = len(self.text_columns)
+        self._text_ends = self._int64s(self.meta['text_ends'], self.n * nt)
+        self._id_ends = self._int64s(self.meta['id_ends'], self.n)
+        self._nulls = mv[self.meta['nulls']:self.meta['nulls'] + self.n * nt]
+        self._blob = self.meta['blob']
+        self._ids = self.meta['ids']
+
+    def _int64s(self, pos, n):
+        b = self._mv[pos:pos + 8 * n]
+        if _LITTLE:
+            return b.cast('q')
+        a = array.array('q', bytes(b))
+        a.byteswap()
+        return a
+
+    def __len__(self):
+        return self.n
+
+    def text(self, i, j):
+        '''Text column j (an index into text_columns) of row i.'''
+        k = i * len(self.text_columns) + j
+        if self._nulls[k]:
+            return None
+        b = self._text_ends[k - 1] if k else 0
+        return str(self._mv[self._blob + b:self._blob + self._text_ends[k]],
+                   'utf-8')
+
+    def row(self, i):
+        b = self._id_ends[i - 1] if i else 0
+        ids = json.loads(str(self._mv[self._ids + b:
+                                      self._ids + self._id_ends[i]], 'utf-8'))
+        vals = dict(zip(self._id_columns, ids))
+        for j, c in enumerate(self.text_columns):
+            vals[c] = self.text(i, j)
+        return dict((c, vals[c]) for c in self.columns)
+
+    def rows(self, start=0, stop=None):
+        stop = self.n if stop is None else min(stop, self.n)
+        for i in range(start, stop):
+            yield self.row(i)
+
+    def __iter__(self):
+        return self.rows()
+
+    def close(self):
+        # Views into the mapping must go before it can be closed.
+        for a in ('_text_ends', '_id_ends', '_nulls'):
+            v = self.__dict__.pop(a, None)
+            if isinstance(v, memoryview):
+                v.release()
+        self._mv.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_snapshot(path):
+    '''Generator; the rows of the snapshot at path.'''
+    with Snapshot(path) as snap:
+        yield from snap.rows()
+
+#-----------------------------------------------------------------------------
+# export and scoring
+
+def source_qy(x):
+    return x.pertinent_qy() if hasattr(x, 'pertinent_qy') else x.PERTINENT_QY
+
+def text_columns(x):
+    return getattr(x, 'TEXT_COLUMNS', ['rpt'])
+
+def export(x, path, db_spec=None, fetch_size=FETCH_SIZE):
+    '''Snapshot the rows extractor module x's driver would score.
+    Returns number of rows written.'''
+    qy = source_qy(x)
+    meta = {'extractor': x.__name__, 'query': qy,
+            'created': datetime.datetime.now().isoformat()}
+    with SnapshotWriter(path, text_columns(x), meta) as w:
+        return w.write_all(METRICS.timed('db_qy',
+                                         db_qy_stream(db_spec, qy,
+                                                      fetch_size)))
+
+# Each pool worker's open snapshots, by path.
+_open = {}
+
+def scoring_rows(snap, start=0, stop=None):
+    '''snap.rows(start, stop), with NULL texts as '': scored as empty, as
+    no score (as batch.score_file_row does).'''
+    for row in snap.rows(start, stop):
+        for c in snap.text_columns:
+            if row[c] is None:
+                row[c] = ''
+        yield row
+
+def _score_range(module, path, span):
+    x = importlib.import_module(module)
+    snap = _open.get(path)
+    if snap is None:
+        snap = _open[path] = Snapshot(path)
+    return [x.score_row(row) for row in scoring_rows(snap, *span)]
+
+def score_snapshot(x, path, workers=1):
+    '''Generator; x.score_row of each row of the snapshot at path, in
+    order. With workers > 1, each pool worker maps the snapshot itself
+    and scores SNAPSHOT_TASK rows at a time.'''
+    if workers <= 1:
+        with Snapshot(path) as snap:
+            yield from METRICS.timed('score', map(x.score_row,
+                                                  scoring_rows(snap)))
+        return
+    with Snapshot(path) as snap:
+        n = len(snap)
+    spans = ((i, i + SNAPSHOT_TASK) for i in range(0, n, SNAPSHOT_TASK))
+    fn = functools.partial(_score_range, x.__name__, path)
+    warmup = getattr(x, 'find_score', None) or x.find_scores
+    for rows in METRICS.timed('score', pool_imap(fn, spans, workers,
+                                                 chunk_size=1,
+                                                 warmup=warmup)):
+        yield from rows
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('export')
+    p.add_argument('extractor', choices=sorted(EXTRACTORS))
+    p.add_argument('-o', '--output', required=True)
+    p.add_argument('--db-spec', help='DB spec JSON file (default %s)'
+                   % DB_SPEC_PATH)
+    p.add_argument('--fetch-size', type=int, default=FETCH_SIZE)
+    p = sub.add_parser('score')
+    p.add_argument('extractor', choices=sorted(EXTRACTORS))
+    p.add_argument('snapshot')
+    p.add_argument('-o', '--output', default='-')
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--tokenizer', choices=['nltk', 'fast'])
+    p.add_argument('--metrics', help='path prefix for run metrics')
+    p = sub.add_parser('info')
+    p.add_argument('snapshot')
+    args = ap.parse_args(argv)
+    if args.cmd == 'info':
+        with Snapshot(args.snapshot) as snap:
+            meta = dict(snap.meta, bytes=os.path.getsize(args.snapshot))
+        print(json.dumps(meta, indent=1))
+        return
+    x = importlib.import_module(EXTRACTORS[args.extractor])
+    if args.cmd == 'export':
+        db_spec = slurpj(args.db_spec) if args.db_spec else None
+        n = export(x, args.output, db_spec, args.fetch_size)
+        print('%d rows' % n, file=sys.stderr)
+        return
+    if args.tokenizer:
+        import common
+        common.TOKENIZER = args.tokenizer
+    import batch
+    with collecting(args.metrics):
+        scored = score_snapshot(x, args.snapshot, args.workers)
+        f = (sys.stdout if args.output == '-'
+             else open(args.output, 'w', encoding='utf-8', newline=''))
+        try:
+            if args.output.endswith('.csv'):
+                n = batch.write_csv(scored, f, batch.score_columns(x))
+            else:
+                n = batch.write_jsonl(scored, f)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+    print('%d rows written' % n, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
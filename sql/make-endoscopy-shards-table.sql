@@ -0,0 +1,9 @@
+if object_id('dm_cadc.ibd.endoscopy_extract_shards', 'U') is null
+create table dm_cadc.ibd.endoscopy_extract_shards (
+    run_id varchar(64) not null,
+    extractor varchar(64) not null,
+    shard int not null,
+    rows_written int not null,
+    done_at datetime not null default getdate(),
+    primary key (run_id, extractor, shard)
+);
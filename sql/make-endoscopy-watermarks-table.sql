@@ -0,0 +1,6 @@
+if object_id('dm_cadc.ibd.endoscopy_extract_watermarks', 'U') is null
+create table dm_cadc.ibd.endoscopy_extract_watermarks (
+    extractor varchar(64) not null primary key,
+    watermark varchar(64) not null,
+    updated_at datetime not null default getdate()
+);
@@ -0,0 +1,8 @@
+create table if not exists dm_cadc.ibd.endoscopy_extract_shards (
+    run_id varchar(64) not null,
+    extractor varchar(64) not null,
+    shard int not null,
+    rows_written int not null,
+    done_at datetime not null default current_timestamp,
+    primary key (run_id, extractor, shard)
+);
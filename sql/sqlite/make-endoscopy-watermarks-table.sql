@@ -0,0 +1,5 @@
+create table if not exists dm_cadc.ibd.endoscopy_extract_watermarks (
+    extractor varchar(64) not null primary key,
+    watermark varchar(64) not null,
+    updated_at datetime not null default current_timestamp
+);
@@ -0,0 +1,152 @@
+'''Parameter sweeps: score a corpus under many settings of a score's
+tunables at once, and compare each setting with a reference.
+
+    python sweep.py mayo --grid '{"max_skips": [5, 10, 15, 19, 25],
+                                  "splitters": [[":", "-", "=", "/"],
+                                                [":", "="]]}'
+                    [--reference '{"max_skips": 19}'] [-o scores.csv]
+                    [--tokenizer fast] input ...
+
+Input is as for batch.py (.jsonl, .csv, .parquet or snapshot.py .snap
+files). A grid is a JSON object (or @file holding one) of rule field ->
+list of values (see rules.RULE_FIELDS; max_skips, splitters and window
+are the usual ones); every combination is a setting.
+
+Each setting becomes a variant of the extractor's built-in Rule, and
+all of them -- plus the reference: the rule as it stands, or with the
+--reference changes -- are compiled into one eager rules.RuleEngine.
+So each report is scanned for anchors and tokenized once; settings with
+other splitters re-split those same tokens, settings with other window
+sizes read the same token prefixes, and only the FSM runs themselves
+are repeated per setting. A 50-point sweep costs a few runs, not fifty.
+
+The output is a score table, one row per report: its non-text columns,
+then the reference's score and each setting's. Printed for each
+setting: reports scored, scores found, agreement with the reference,
+and how the rest differ -- gained (found where the reference found
+none), lost (the reverse) or changed (both found, but different).
+'''
+import argparse
+import itertools
+import json
+import sys
+import batch
+import rules
+from common import *
+from instrument import *
+
+REFERENCE = 'reference'
+
+def grid(space):
+    '''Every setting in space (dict of field -> list of values), as a
+    list of dicts, in order.'''
+    fields = list(space)
+    return [dict(zip(fields, values))
+            for values in itertools.product(*[space[f] for f in fields])]
+
+def label(setting):
+    '''e.g. {'max_skips': 5} --> 'max_skips=5' '''
+    return ';'.join('%s=%s' % (f, json.dumps(v, ensure_ascii=False))
+                    for f, v in setting.items())
+
+def _found(score):
+    return outcome(score) == 'FOUND'
+
+class Sweep:
+    '''rule (a rules.Rule) under each of settings (dicts of field ->
+    value), and the reference: rule with reference (changes) applied.'''
+
+    def __init__(self, rule, settings, reference=None):
+        self.reference = rule.variant(REFERENCE, **(reference or {}))
+        self.settings = [label(s) for s in settings]
+        variants = [rule.variant(l, **s)
+                    for l, s in zip(self.settings, settings)]
+        self.engine = rules.RuleEngine([self.reference] + variants,
+                                       eager=True)
+        self.stats = dict((l, dict(n=0, found=0, agree=0, gained=0, lost=0,
+                                   changed=0))
+                          for l in [REFERENCE] + self.settings)
+
+    def score_row(self, row):
+        '''Replaces row's text columns with the reference's and each
+        setting's score (where the rule applies), tallying the stats.
+        Returns the (mutated) row.'''
+        self.engine.score_row(row)
+        ref = row.get(REFERENCE, 'NOT FOUND')
+        for l in [REFERENCE] + self.settings:
+            if l not in row:
+                continue
+            score = row[l]
+            st = self.stats[l]
+            st['n'] += 1
+            if _found(score):
+                st['found'] += 1
+            if score == ref:
+                st['agree'] += 1
+            elif not _found(ref):
+                st['gained'] += 1
+            elif not _found(score):
+                st['lost'] += 1
+            else:
+                st['changed'] += 1
+        return row
+
+    def score_rows(self, rows):
+        '''Generator; score_row of each of rows.'''
+        for row in METRICS.timed('score', rows):
+            yield self.score_row(row)
+
+    def report(self, out=sys.stdout):
+        print('setting\tn\tfound\tagree\tgained\tlost\tchanged', file=out)
+        for l in [REFERENCE] + self.settings:
+            st = self.stats[l]
+            agree = 100.0 * st['agree'] / st['n'] if st['n'] else 0.0
+            print('%s\t%d\t%d\t%.2f%%\t%d\t%d\t%d'
+                  % (l, st['n'], st['found'], agree, st['gained'],
+                     st['lost'], st['changed']), file=out)
+
+def _json_arg(s):
+    if s.startswith('@'):
+        with open(s[1:]) as f:
+            return json.load(f)
+    return json.loads(s)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('extractor', choices=sorted(rules.BUILTIN_RULES))
+    ap.add_argument('input', nargs='+')
+    ap.add_argument('--grid', required=True, type=_json_arg,
+                    help='JSON object of field -> values, or @file')
+    ap.add_argument('--reference', type=_json_arg,
+                    help='JSON object of field -> value, or @file')
+    ap.add_argument('-o', '--output', help='score table (.jsonl or .csv)')
+    ap.add_argument('--format', choices=sorted(batch.READERS))
+    ap.add_argument('--rpt-column', default='rpt')
+    ap.add_argument('--tokenizer', choices=['nltk', 'fast'])
+    ap.add_argument('--metrics', help='path prefix for run metrics')
+    args = ap.parse_args(argv)
+    if args.tokenizer:
+        import common
+        common.TOKENIZER = args.tokenizer
+    try:
+        sweep = Sweep(rules.rule_for(args.extractor), grid(args.grid),
+                      args.reference)
+    except ValueError as ex:
+        ap.error(str(ex))
+    with collecting(args.metrics):
+        scored = sweep.score_rows(batch.read_rows(args.input, args.format,
+                                                  args.rpt_column))
+        if not args.output:
+            for row in scored:
+                pass
+        else:
+            with open(args.output, 'w', encoding='utf-8', newline='') as f:
+                if args.output.endswith('.csv'):
+                    batch.write_csv(scored, f,
+                                    [REFERENCE] + sweep.settings)
+                else:
+                    batch.write_jsonl(scored, f)
+    sweep.report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''Deterministic generator of synthetic endoscopy reports, for
+benchmarks (see bench.py) and tokenizer parity checks -- real notes
+can't leave the enclave.
+
+    python synth.py [-n 10000] [--seed 0] [--words 250] [--mayo 0.5]
+                    [--rutgeerts 0.2] [--ses-cd 0.2] [--noise 0.05] > corpus.jsonl
+
+Writes one JSON row per report, shaped like the rows the drivers read
+(empi, proc_date, proc_code, order_proc_id, rpt, findings,
+impression), so the output works with tokparity.py --field rpt too.
+Same arguments, same corpus.
+'''
+import argparse
+import datetime
+import json
+import random
+import sys
+
+# Filler, roughly the vocabulary of a colonoscopy report.
+FILLER = ('the patient was placed in the left lateral decubitus position '
+          'and the colonoscope was introduced through the anus and advanced '
+          'to the cecum identified by appendiceal orifice and ileocecal '
+          'valve the quality of the bowel preparation was good the terminal '
+          'ileum was intubated and examined mucosa appeared normal there '
+          'was patchy erythema with loss of vascular pattern in the rectum '
+          'and sigmoid colon biopsies were taken with cold forceps for '
+          'histology a few small aphthous ulcers were found no bleeding '
+          'the procedure was tolerated well with no complications findings '
+          'impression recommendation repeat colonoscopy in one year continue '
+          'current therapy follow up in clinic with gastroenterology '
+          'anastomosis neo-terminal ileum stricture friability 5 mm 10 cm '
+          'from the anal verge retroflexion performed hemorrhoids grade 1 '
+          'MAC sedation propofol 200 mg ASA class II').split()
+
+# Score layouts; {} fields are filled in by make_report.
+MAYO_LAYOUTS = [
+    'Mayo score: {ma}.',
+    'Mayo endoscopic subscore {ma}',
+    'Mayo endoscopic score of {ma}',
+    'Mayo {ma}',
+    'Mayo SF {sf} RB {rb} endoscopic {ma} physician {md} total {total}',
+    'Mayo: stool frequency {sf}, rectal bleeding {rb}, mucosal {ma}, '
+    'MD {md}. Total {total}',
+    'Mayo Score - SF={sf}/RB={rb}/MA={ma}/MD={md}',
+    'Partial Mayo score {total}. Harvey Bradshaw 4',
+    'mayo endoscopic subscore was {ma}-{ma2}',
+]
+RUTGEERTS_LAYOUTS = [
+    'Rutgeerts i{r}',
+    'Rutgeerts score i{r}.',
+    'Rutgeerts score of {r}',
+    'rutgeerts score was i{r}',
+    'Rutgers i{r}',
+    '(Rutgeerts {r})',
+]
+SES_CD_LAYOUTS = [
+    'SES-CD total score was {total}.',
+    'SES-CD: ileum {a} right colon {b} transverse {c} left {d} rectum {e}'
+    ' total {total}',
+    'SES-CD score {total}',
+    "Simple Endoscopic Score for Crohn's Disease: aggregate {total}",
+    'SES-CD {total}',
+]
+
+# Default density (chance a report contains each score) and noise.
+DENSITY = {'mayo': 0.5, 'rutgeerts': 0.2, 'ses_cd': 0.2}
+NOISE = 0.05
+WORDS = 250
+
+def _noisy(rng, word, noise):
+    '''word, perhaps upper-/title-cased, punctuated or line-broken.'''
+    if rng.random() >= noise:
+        return word
+    k = rng.randrange(6)
+    if k == 0:
+        return word.upper()
+    if k == 1:
+        return word.title()
+    if k == 2:
+        return word + rng.choice(['.', ',', ':', ';'])
+    if k == 3:
+        return word + '\n'
+    if k == 4:
+        return '"' + word + '"'
+    return word + ' ' + word
+
+def _fill(rng, layout):
+    sf, rb, ma, ma2, md = (rng.randint(0, 3) for _ in range(5))
+    subs = [rng.randint(0, 3) for _ in range(5)]
+    return layout.format(
+        sf=sf, rb=rb, ma=ma, ma2=ma2, md=md, total=sf + rb + ma + md,
+        r=rng.randint(0, 4),
+        a=subs[0], b=subs[1], c=subs[2], d=subs[3], e=subs[4])
+
+def make_report(rng, words=WORDS, density=DENSITY, noise=NOISE):
+    '''One synthetic report text of about words words (varied +-50%).'''
+    n = max(1, int(words * rng.uniform(0.5, 1.5)))
+    toks = [_noisy(rng, rng.choice(FILLER), noise) for _ in range(n)]
+    for key, layouts in (('mayo', MAYO_LAYOUTS),
+                         ('rutgeerts', RUTGEERTS_LAYOUTS),
+                         ('ses_cd', SES_CD_LAYOUTS)):
+        # Density above 1 means several mentions per report, on average.
+        d = density.get(key, 0)
+        k = int(d) + (rng.random() < d - int(d))
+        for _ in range(k):
+            toks.insert(rng.randrange(len(toks) + 1),
+                        _fill(rng, rng.choice(layouts)))
+    return ' '.join(toks)
+
+def corpus(n, seed=0, words=WORDS, density=DENSITY, noise=NOISE):
+    '''Generator; n report rows (dicts, see module doc). Deterministic
+    in all of its arguments.'''
+    rng = random.Random(seed)
+    day0 = datetime.date(2015, 1, 1)
+    for i in range(n):
+        text = make_report(rng, words, density, noise)
+        cut = rng.randrange(len(text) + 1)
+        yield {'empi': rng.randrange(n // 4 + 1),
+               'proc_date': str(day0 + datetime.timedelta(rng.randrange(3000))),
+               'proc_code': rng.choice(['45378', '45380', '45385', '44388']),
+               'order_proc_id': i,
+               'rpt': text,
+               'findings': text[:cut],
+               'impression': text[cut:]}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('-n', type=int, default=10000)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--words', type=int, default=WORDS)
+    ap.add_argument('--mayo', type=float, default=DENSITY['mayo'])
+    ap.add_argument('--rutgeerts', type=float, default=DENSITY['rutgeerts'])
+    ap.add_argument('--ses-cd', type=float, default=DENSITY['ses_cd'])
+    ap.add_argument('--noise', type=float, default=NOISE)
+    args = ap.parse_args(argv)
+    density = {'mayo': args.mayo, 'rutgeerts': args.rutgeerts,
+               'ses_cd': args.ses_cd}
+    for row in corpus(args.n, args.seed, args.words, density, args.noise):
+        sys.stdout.write(json.dumps(row) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+'''The modules are flat at the repo root and read their SQL from
+sql/, relative to the working directory; tests run from there.'''
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+@pytest.fixture
+def fast_tokenizer(monkeypatch):
+    '''The fast engine: needs no NLTK data.'''
+    import common
+    monkeypatch.setattr(common, 'TOKENIZER', 'fast')
+
+# Source and destination tables of the drivers, on a SQLite stand-in
+# (see dbio.db_connect).
+SCHEMA = \
+'''create table endoscopy_unfinished (empi, "Procedure Date",
+    "Procedure Code", order_proc_id, notes);
+create table tmp_endoscopy_sections (empi, proc_date, proc_code, findings,
+    impression);
+create table tmp_endoscopy_mayo (empi, proc_date, proc_code, order_proc_id,
+    mayo);
+create table tmp_endoscopy_rutgeerts (empi, proc_date, proc_code,
+    order_proc_id, rutgeerts);
+create table tmp_endoscopy_ses_cd (empi, proc_date, proc_code, ses_cd);
+'''
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch, fast_tokenizer):
+    '''A ConnectionPool on a fresh SQLite stand-in with SCHEMA. The
+    drivers' own DDL for their tables is SQL Server's, so resetting a
+    destination table just empties it here.'''
+    import dbio
+    import endoscopy_rutgeerts
+    import endoscopy_ses_cd
+    for x in (endoscopy_rutgeerts, endoscopy_ses_cd):
+        monkeypatch.setattr(x, 'reset_dest_table',
+                            lambda db, t=x.DEST_TABLE: dbio.db_trunc_table(db, t))
+    pool = dbio.ConnectionPool({'sqlite': str(tmp_path / 'stand-in.db')})
+    pool.stmt(SCHEMA)
+    yield pool
+    pool.close()
+
+def add_reports(db, start, n, seed=0):
+    '''Insert n synth.py reports, numbered from start, as both source
+    tables' rows: report i has empi i and proc_date 2020-01-01 + i days,
+    so keys are unique and later reports sort later.'''
+    import datetime
+    import dbio
+    import synth
+    day0 = datetime.date(2020, 1, 1)
+    rows = []
+    for i, r in enumerate(synth.corpus(n, seed + start), start):
+        r.update(empi=i, order_proc_id=i,
+                 proc_date=str(day0 + datetime.timedelta(i)))
+        rows.append(r)
+    dbio.db_insert_many(db, 'dm_cadc.ibd.endoscopy_unfinished',
+                        [{'empi': r['empi'], '"Procedure Date"': r['proc_date'],
+                          '"Procedure Code"': r['proc_code'],
+                          'order_proc_id': r['order_proc_id'],
+                          'notes': r['rpt']} for r in rows])
+    dbio.db_insert_many(db, 'dm_cadc.ibd.tmp_endoscopy_sections',
+                        [dict((k, r[k]) for k in ('empi', 'proc_date',
+                                                  'proc_code', 'findings',
+                                                  'impression'))
+                         for r in rows])
+    return rows
+
+def table_rows(db, table, key):
+    '''table's rows as dicts, sorted by key.'''
+    import dbio
+    return sorted(dbio.db_qy(db, 'select * from %s' % table),
+                  key=lambda r: r[key])
@@ -0,0 +1,37 @@
+'''With a work budget, the extractor modules and the rule engine must
+give each report the same score, whichever tokenizer is in use.'''
+import re
+import pytest
+import common
+import rules
+import synth
+import endoscopy_mayo as M
+import endoscopy_ses_cd as S
+import endoscopy_rutgeerts as R
+
+def eager_word_tokenize(s):
+    # Stands in for nltk's word_tokenize (no NLTK data here): it, too,
+    # tokenizes all of s before the FSM reads any of it.
+    return re.findall(r"\w+|[^\w\s]", s)
+
+@pytest.fixture(params=['fast', 'nltk'])
+def engine(request, monkeypatch):
+    monkeypatch.setattr(common, 'TOKENIZER', request.param)
+    monkeypatch.setattr(common, '_nltk_word_tokenize', eager_word_tokenize)
+    monkeypatch.setattr(common, 'MAX_REPORT_CHARS', 2000)
+    monkeypatch.setattr(common, 'MAX_REPORT_TOKENS', 30)
+    monkeypatch.setattr(common, 'MAX_ANCHOR_STARTS', 3)
+    return request.param
+
+def test_modules_match_rules(engine):
+    e = rules.compile_rules(['mayo', 'ses_cd', 'rutgeerts'])
+    hits = 0
+    for row in synth.corpus(400, 4, words=60,
+                            density={'mayo': 1.5, 'rutgeerts': 0.5,
+                                     'ses_cd': 1.2}):
+        text = row['rpt']
+        for name, x in [('mayo', M), ('ses_cd', S), ('rutgeerts', R)]:
+            score = x.find_score(text)
+            assert score == e.find_score(text, name), (name, text)
+            hits += score == common.BUDGET_EXCEEDED
+    assert hits
@@ -0,0 +1,57 @@
+'''BulkLoader on a SQLite stand-in: every staging mode replaces the
+table's contents, and an aborted load leaves them as they were.'''
+import pytest
+import dbio
+import bulkload
+from records import RecordBatch
+from conftest import table_rows
+
+TABLE = 'dm_cadc.ibd.tmp_endoscopy_mayo'
+
+def rows(n, score):
+    return [{'empi': i, 'proc_date': '2020-01-01', 'proc_code': 'C',
+             'order_proc_id': i, 'mayo': score} for i in range(n)]
+
+def scores(db):
+    return [(r['order_proc_id'], r['mayo'])
+            for r in table_rows(db, TABLE, 'order_proc_id')]
+
+@pytest.mark.parametrize('stage', ['table', 'file', None])
+@pytest.mark.parametrize('batch', [False, True])
+def test_replace(sqlite_db, stage, batch):
+    dbio.db_insert_many(sqlite_db, TABLE, rows(5, 'NOT FOUND'))
+    new = rows(23, 2)
+    n = bulkload.bulk_replace(sqlite_db, TABLE,
+                              RecordBatch(new) if batch else iter(new),
+                              batch_size=4, stage=stage)
+    assert n == 23
+    assert scores(sqlite_db) == [(i, 2) for i in range(23)]
+    assert not bulkload.db_table_exists(
+        sqlite_db, bulkload.stage_table_name(TABLE))
+
+@pytest.mark.parametrize('stage', ['table', 'file'])
+def test_abort_keeps_old_rows(sqlite_db, stage):
+    dbio.db_insert_many(sqlite_db, TABLE, rows(5, 1))
+    def failing():
+        yield from rows(10, 3)
+        raise RuntimeError('source failed')
+    with pytest.raises(RuntimeError):
+        bulkload.bulk_replace(sqlite_db, TABLE, failing(), batch_size=4,
+                              stage=stage)
+    assert scores(sqlite_db) == [(i, 1) for i in range(5)]
+    assert not bulkload.db_table_exists(
+        sqlite_db, bulkload.stage_table_name(TABLE))
+
+def test_progress_and_create(sqlite_db):
+    sqlite_db.stmt('drop table %s' % TABLE)
+    made = []
+    def create(db):
+        made.append(1)
+        db.stmt('create table %s (empi, proc_date, proc_code,'
+                ' order_proc_id, mayo)' % TABLE)
+    seen = []
+    bulkload.bulk_replace(sqlite_db, TABLE, rows(10, 0), batch_size=4,
+                          progress=seen.append, create=create)
+    assert made == [1]
+    assert seen == [4, 8, 10]
+    assert scores(sqlite_db) == [(i, 0) for i in range(10)]
@@ -0,0 +1,36 @@
+'''db_spec handling: which specs get a pool, and the error for one
+with no connection details.'''
+import pytest
+import dbio
+
+DB3_SPEC = {'server': 'x', 'database': 'y'}
+
+def test_can_connect(tmp_path):
+    assert dbio.can_connect({'sqlite': str(tmp_path / 'x.db')})
+    assert dbio.can_connect({'conn_str': 'DSN=x'})
+    assert dbio.can_connect({'host': 'h', 'db': 'd', 'user': 'u',
+                             'password': 'p'})
+    assert not dbio.can_connect(DB3_SPEC)
+
+def test_pooled(tmp_path):
+    spec = {'sqlite': str(tmp_path / 'x.db')}
+    with dbio.pooled(spec) as db:
+        assert isinstance(db, dbio.ConnectionPool)
+        assert db.qy('select 1 as one') == [{'one': 1}]
+    # Left to db3.
+    with dbio.pooled(DB3_SPEC) as db:
+        assert db is DB3_SPEC
+
+def test_no_connection_details():
+    with pytest.raises(ValueError, match='missing: host, db, user, password'):
+        with dbio.pooled(DB3_SPEC, connections=True):
+            pass
+    with pytest.raises(ValueError, match='conn_str'):
+        dbio.ConnectionPool(DB3_SPEC)
+    with pytest.raises(ValueError, match='conn_str'):
+        dbio.db_connect(DB3_SPEC)
+
+def test_driver_fails_up_front():
+    import endoscopy_mayo as M
+    with pytest.raises(ValueError, match='conn_str'):
+        M.do_all(DB3_SPEC, stream=True)
@@ -0,0 +1,64 @@
+'''fsm_table must return the same results as fsm.'''
+import random
+import pytest
+import common
+import synth
+import endoscopy_mayo as M
+
+# Keywords, scores in and out of range, and numbers int() rejects.
+VOCAB = (M.STOP_WORDS + M.SF_WORDS + M.RB_WORDS + M.MA_WORDS + M.MD_WORDS
+         + [M.TOTAL, M.MAYO, '0', '1', '2', '3', '4', '7', '12', '13', '99',
+            '2.', '-1', '1_0', 'score', 'was', 'of', 'the', 'colon'])
+
+def synth_windows(n, seed):
+    for row in synth.corpus(n, seed, density={'mayo': 1.5}):
+        tokens = common.into_word_tokens_with_splitters(
+            row['rpt'], M.SPLITTERS, engine='fast')
+        for i in common.indices_for(tokens, M.MAYO):
+            yield tokens[i:]
+
+def random_windows(n, seed):
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield [M.MAYO] + [rng.choice(VOCAB)
+                          for _ in range(rng.randrange(40))]
+
+def check(windows):
+    n = 0
+    for toks in windows:
+        a = M.fsm(toks)
+        b = M.fsm_table(toks)
+        assert (a, type(a)) == (b, type(b)), toks
+        n += 1
+    return n
+
+def test_synthetic_corpus():
+    assert check(synth_windows(1000, 7)) > 1000
+
+def test_random_token_soup():
+    assert check(random_windows(5000, 11)) == 5000
+
+@pytest.mark.parametrize('max_skips', [0, 1, 2, 5])
+def test_max_skips(monkeypatch, max_skips):
+    monkeypatch.setattr(M, 'MAX_SKIPS', max_skips)
+    check(random_windows(2000, max_skips))
+
+def test_changed_word_lists(monkeypatch):
+    monkeypatch.setattr(M, 'SF_WORDS', M.SF_WORDS + ['frequency'])
+    monkeypatch.setattr(M, 'STOP_WORDS', M.STOP_WORDS + ['total'])
+    M.compile_fsm()
+    try:
+        check(random_windows(2000, 3))
+        check([['mayo', 'frequency', '2', 'total', '3']])
+    finally:
+        monkeypatch.undo()
+        M.compile_fsm()
+
+def test_traced_matches_table():
+    import fsmtrace
+    for toks in random_windows(2000, 13):
+        w = fsmtrace.TraceRecord('mayo', 0, 0).window()
+        assert M.fsm_traced(toks, w) == M.fsm_table(toks)
+        assert w['tokens'] == toks[:len(w['tokens'])]
+        for i, before, after in w['steps']:
+            assert 0 <= i < len(w['tokens'])
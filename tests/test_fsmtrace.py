@@ -0,0 +1,48 @@
+'''Tracer's only filter uses the same result keys as the metrics.'''
+import pytest
+import fsmtrace
+
+@pytest.mark.parametrize('result, kept', [(2, True), ('2', True),
+                                          ('NOT FOUND', False),
+                                          ('ERROR', False),
+                                          ('BUDGET EXCEEDED', False),
+                                          (None, False)])
+def test_only_found(result, kept):
+    t = fsmtrace.Tracer()
+    t.start(only=['FOUND'])
+    t.end(t.begin('mayo', 'text'), result)
+    assert len(t.ring) == kept
+
+def test_only_budget_exceeded():
+    t = fsmtrace.Tracer()
+    t.start(only=['BUDGET EXCEEDED'])
+    for result in (1, 'NOT FOUND', 'BUDGET EXCEEDED'):
+        t.end(t.begin('mayo', 'text'), result)
+    assert [r['result'] for r in t.ring] == ['BUDGET EXCEEDED']
+
+def ses_cd_windows(n, seed):
+    import common
+    import synth
+    import endoscopy_ses_cd as S
+    for row in synth.corpus(n, seed, density={'ses_cd': 1.5}):
+        tokens = common.into_word_tokens(row['rpt'], engine='fast')
+        for i in common.indices_for(tokens, 'ses-cd'):
+            yield tokens[i + 1:i + 1 + S.WINDOW]
+
+def test_ses_cd_traced_matches_fsm():
+    import endoscopy_ses_cd as S
+    n = 0
+    for toks in ses_cd_windows(500, 8):
+        w = fsmtrace.TraceRecord('ses_cd', 0, 0).window()
+        assert S.fsm_traced(toks, w) == S.fsm(toks)
+        assert w['tokens'] == toks[:len(w['tokens'])]
+        assert w['end'] is not None
+        n += 1
+    assert n
+
+def test_plain_fsms_have_no_trace_checks():
+    import endoscopy_mayo as M
+    import endoscopy_ses_cd as S
+    for f in (M.run_table, S.fsm):
+        names = f.__code__.co_varnames + f.__code__.co_names
+        assert 'w' not in names and 'append' not in names, f.__name__
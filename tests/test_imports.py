@@ -0,0 +1,16 @@
+'''Importing an extractor stays cheap: each is imported in a fresh
+interpreter (see bench.import_cost), which must load none of
+bench.HEAVY_MODULES and stay within a generous time budget.'''
+import pytest
+import bench
+
+# Well over bench.IMPORT_BUDGET_MS, so a slow machine doesn't fail it;
+# an eager nltk or pyodbc import costs far more.
+BUDGET_MS = 5 * bench.IMPORT_BUDGET_MS
+
+@pytest.mark.parametrize('module', ['endoscopy_mayo', 'endoscopy_ses_cd',
+                                    'endoscopy_rutgeerts'])
+def test_import_cost(module):
+    ms, heavy = bench.import_cost(module)
+    assert heavy == []
+    assert ms < BUDGET_MS
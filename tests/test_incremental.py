@@ -0,0 +1,89 @@
+'''Incremental runs on a SQLite stand-in: each run scores only the
+reports at or past the watermark, upserting them, and the result is
+the same as scoring everything.'''
+import datetime
+import decimal
+import pytest
+import dbio
+import endoscopy_mayo as M
+import endoscopy_ses_cd as S
+from conftest import add_reports, table_rows
+
+def expected_mayo(rows):
+    return [(r['order_proc_id'], M.find_score(r['rpt'])) for r in rows
+            if 'mayo' in r['rpt'].lower()]
+
+def test_mayo(sqlite_db):
+    rows = add_reports(sqlite_db, 0, 120)
+    M.do_all(sqlite_db, incremental=True)
+    assert (dbio.db_get_watermark(sqlite_db, M.SCORE_COLUMN)
+            == expected_mayo(rows)[-1][0])
+    rows += add_reports(sqlite_db, 120, 80)
+    M.do_all(sqlite_db, incremental=True)
+    # Nothing new: the rows at the watermark are rescored, not duplicated.
+    M.do_all(sqlite_db, incremental=True)
+    want = expected_mayo(rows)
+    assert dbio.db_get_watermark(sqlite_db, M.SCORE_COLUMN) == want[-1][0]
+    got = [(r['order_proc_id'], r['mayo'])
+           for r in table_rows(sqlite_db, M.DEST_TABLE, 'order_proc_id')]
+    assert got == want
+
+def test_ses_cd_by_date(sqlite_db):
+    rows = add_reports(sqlite_db, 0, 100, seed=5)
+    S.doall(sqlite_db, incremental=True)
+    rows += add_reports(sqlite_db, 100, 50, seed=5)
+    S.doall(sqlite_db, incremental=True)
+    want = []
+    last = None
+    for r in rows:
+        if any(w in (r['impression'] + ' ' + r['findings']).lower()
+               for w in S.PREFILTERS):
+            want.append((r['empi'], S.score_row(dict(r))['ses_cd']))
+            last = r['proc_date']
+    assert dbio.db_get_watermark(sqlite_db, S.SCORE_COLUMN) == last
+    got = [(r['empi'], r['ses_cd'])
+           for r in table_rows(sqlite_db, S.DEST_TABLE, 'empi')]
+    assert got == want
+
+def test_watermark_types(sqlite_db):
+    dbio.make_watermark_table(sqlite_db)
+    for v in [7, 'x:y', datetime.date(2020, 1, 2),
+              datetime.datetime(2020, 1, 2, 3, 4, 5)]:
+        dbio.db_set_watermark(sqlite_db, 'x', v)
+        got = dbio.db_get_watermark(sqlite_db, 'x')
+        assert (got, type(got)) == (v, type(v))
+    # pyodbc's types for NUMERIC/DECIMAL and FLOAT columns.
+    for v, want in [(decimal.Decimal('12345'), 12345),
+                    (decimal.Decimal('12.50'), decimal.Decimal('12.50')),
+                    (decimal.Decimal('-3.000'), -3),
+                    (2.5, 2.5), (1e-7, 1e-7), (3.0, 3.0)]:
+        dbio.db_set_watermark(sqlite_db, 'x', v)
+        got = dbio.db_get_watermark(sqlite_db, 'x')
+        assert (got, type(got)) == (want, type(want))
+    # Untagged, as stored before watermarks had types.
+    assert dbio.decode_watermark('12') == 12
+    assert dbio.decode_watermark('2020-01-02') == '2020-01-02'
+
+def test_track_max_ignores_stored_watermark():
+    high = [None]
+    rows = [{'proc_date': datetime.date(2020, 1, 2)},
+            {'proc_date': None}, {'proc_date': datetime.date(2020, 1, 1)}]
+    assert list(dbio.track_max(iter(rows), 'proc_date', high)) == rows
+    assert high == [datetime.date(2020, 1, 2)]
+
+def test_upsert_failure_keeps_old_rows(sqlite_db):
+    t = M.DEST_TABLE
+    old = [{'order_proc_id': i, 'mayo': 1} for i in range(3)]
+    dbio.db_insert_many(sqlite_db, t, old)
+    bad = [{'order_proc_id': i, 'mayo': 2, 'no_such_column': 0}
+           for i in range(3)]
+    with pytest.raises(Exception):
+        dbio.db_upsert_many(sqlite_db, t, ['order_proc_id'], bad)
+    assert [(r['order_proc_id'], r['mayo'])
+            for r in table_rows(sqlite_db, t, 'order_proc_id')] == \
+        [(0, 1), (1, 1), (2, 1)]
+    dbio.db_upsert_chunked(sqlite_db, t, ['order_proc_id'],
+                           [{'order_proc_id': 1, 'mayo': 3}])
+    assert [(r['order_proc_id'], r['mayo'])
+            for r in table_rows(sqlite_db, t, 'order_proc_id')] == \
+        [(0, 1), (1, 3), (2, 1)]
@@ -0,0 +1,69 @@
+'''Pipelined runs write exactly what serial ones do.'''
+import pytest
+import endoscopy_mayo as M
+import endoscopy_rutgeerts as R
+import endoscopy_ses_cd as S
+import endoscopy_combined as CB
+import pipeline
+from conftest import add_reports, table_rows
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Many chunks through the queues, even for a small corpus.
+    monkeypatch.setattr(pipeline, 'PIPE_CHUNK', 7)
+    monkeypatch.setattr(pipeline, 'QUEUE_DEPTH', 2)
+
+def test_run_pipelined_order():
+    rows = [{'i': i} for i in range(1000)]
+    def score(rows):
+        for r in rows:
+            yield dict(r, s=r['i'] * 2)
+    out = pipeline.run_pipelined(lambda: iter(rows), score, list, depth=2,
+                                 chunk_size=7)
+    assert out == [dict(r, s=r['i'] * 2) for r in rows]
+
+@pytest.mark.parametrize('stage', ['source', 'score', 'sink'])
+def test_run_pipelined_error(stage):
+    def boom(rows):
+        for r in rows:
+            if r == 500:
+                raise ValueError(stage)
+            yield r
+    source = (lambda: boom(iter(range(1000)))) if stage == 'source' \
+        else (lambda: iter(range(1000)))
+    score = boom if stage == 'score' else iter
+    sink = (lambda rows: list(boom(rows))) if stage == 'sink' else list
+    with pytest.raises(ValueError, match=stage):
+        pipeline.run_pipelined(source, score, sink, depth=2, chunk_size=7)
+
+def run_both(db, run, tables):
+    '''tables' contents after run(pipelined) serially, then pipelined.'''
+    out = []
+    for pipelined in (False, True):
+        run(pipelined)
+        out.append([table_rows(db, t, k) for t, k in tables])
+    return out
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_streaming_drivers(sqlite_db, small_chunks, bulk):
+    add_reports(sqlite_db, 0, 300, seed=3)
+    for x, run in [
+            (M, lambda p: M.do_all(sqlite_db, stream=True, bulk=bulk,
+                                   chunk_size=11, pipelined=p)),
+            (R, lambda p: R.doall(sqlite_db, stream=True, bulk=bulk,
+                                  chunk_size=11, pipelined=p)),
+            (S, lambda p: S.doall(sqlite_db, stream=True, bulk=bulk,
+                                  chunk_size=11, pipelined=p))]:
+        serial, piped = run_both(sqlite_db, run, [(x.DEST_TABLE, 'empi')])
+        assert serial == piped
+        assert len(serial[0]) > 50
+
+def test_combined_incremental(sqlite_db, small_chunks):
+    add_reports(sqlite_db, 0, 200, seed=4)
+    tables = [(x.DEST_TABLE, 'empi') for x in CB.EXTRACTORS]
+    def run(pipelined):
+        CB.doall(sqlite_db, incremental=True, full_rebuild=True,
+                 chunk_size=11, pipelined=pipelined)
+    serial, piped = run_both(sqlite_db, run, tables)
+    assert serial == piped
+    assert all(len(t) > 20 for t in serial)
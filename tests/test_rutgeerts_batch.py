@@ -0,0 +1,37 @@
+'''Rutgeerts' batch path (find_score_batch / score_rows) gives exactly
+find_score's results, and the drivers use it.'''
+import pytest
+import etl
+import synth
+import endoscopy_rutgeerts as R
+from conftest import add_reports, table_rows
+
+EDGE = [None, '', 'rutgeerts', 'Rutgeerts i2 rutgers I3 RUTGEERTS was 4',
+        'rutgeerts score is of was score i1', 'RUTGERS  i0.', 'rutgeert 5']
+
+def test_batch_matches_find_score():
+    texts = [r['rpt'] for r in synth.corpus(2000, 9,
+                                            density={'rutgeerts': 1.0})]
+    texts += EDGE
+    want = [R.find_score(t) if t is not None else 'NOT FOUND' for t in texts]
+    assert R.find_score_batch(texts) == want
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_doall_uses_batches(sqlite_db, monkeypatch, workers):
+    rows = add_reports(sqlite_db, 0, 300, seed=8)
+    monkeypatch.setattr(etl, 'BATCH_CHUNK', 17)
+    calls = []
+    score_rows = R.score_rows
+    def counting(rows):
+        calls.append(len(rows))
+        return score_rows(rows)
+    monkeypatch.setattr(R, 'score_rows', counting)
+    R.doall(sqlite_db, stream=True, workers=workers)
+    want = [(r['order_proc_id'], R.find_score(r['rpt'])) for r in rows
+            if any(w in r['rpt'].lower() for w in R.PREFILTERS)]
+    got = [(r['order_proc_id'], r['rutgeerts'])
+           for r in table_rows(sqlite_db, R.DEST_TABLE, 'order_proc_id')]
+    assert got == want
+    if workers == 1:
+        # (in a pool, the calls are made in the workers)
+        assert calls and max(calls) == 17
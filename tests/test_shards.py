@@ -0,0 +1,51 @@
+'''Sharded runs on a SQLite stand-in, with either kind of checkpoint:
+the shards together write what one unsharded run does, and re-running
+skips the shards already done.'''
+import pytest
+import shards
+import endoscopy_mayo as M
+import endoscopy_ses_cd as S
+from conftest import add_reports, table_rows
+
+@pytest.fixture(params=['table', 'file'])
+def checkpoint(request, tmp_path):
+    return None if request.param == 'table' else str(tmp_path / 'ckpt.json')
+
+def unsharded(db, x, key):
+    x.doall(db) if hasattr(x, 'doall') else x.do_all(db)
+    return table_rows(db, x.DEST_TABLE, key)
+
+@pytest.mark.parametrize('x, by, key', [(M, 'range', 'order_proc_id'),
+                                        (M, 'hash', 'order_proc_id'),
+                                        (S, 'hash', 'empi')])
+def test_shards_match_unsharded(sqlite_db, checkpoint, x, by, key):
+    add_reports(sqlite_db, 0, 250, seed=6)
+    want = unsharded(sqlite_db, x, key)
+    out = shards.run_sharded(x, sqlite_db, by=by, n_shards=5, width=40,
+                             run_id='r1', checkpoint=checkpoint,
+                             chunk_size=13)
+    assert len(out) > 1
+    assert sum(out.values()) == len(want)
+    assert table_rows(sqlite_db, x.DEST_TABLE, key) == want
+
+def test_resume(sqlite_db, checkpoint):
+    add_reports(sqlite_db, 0, 200, seed=2)
+    want = unsharded(sqlite_db, M, 'order_proc_id')
+    first = shards.run_sharded(M, sqlite_db, by='hash', n_shards=4,
+                               only=[0, 2], run_id='r2',
+                               checkpoint=checkpoint)
+    assert sorted(first) == [0, 2]
+    # The rest, as another node would: no reset, done shards skipped.
+    rest = shards.run_sharded(M, sqlite_db, by='hash', n_shards=4,
+                              run_id='r2', checkpoint=checkpoint,
+                              reset=False)
+    assert sorted(rest) == [1, 3]
+    assert shards.run_sharded(M, sqlite_db, by='hash', n_shards=4,
+                              run_id='r2', checkpoint=checkpoint) == {}
+    assert table_rows(sqlite_db, M.DEST_TABLE, 'order_proc_id') == want
+    ckpt = shards.open_checkpoint(sqlite_db, 'r2', checkpoint)
+    assert ckpt.done('mayo') == {0, 1, 2, 3}
+
+def test_range_needs_order_proc_id(sqlite_db):
+    with pytest.raises(ValueError):
+        shards.run_sharded(S, sqlite_db, by='range')
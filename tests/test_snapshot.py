@@ -0,0 +1,45 @@
+'''Snapshots round-trip their rows, and re-scoring one gives what
+scoring the rows directly does, NULL reports included.'''
+import datetime
+import pytest
+import synth
+import snapshot
+import endoscopy_mayo as M
+import endoscopy_combined as C
+
+def source_rows(n, seed):
+    rows = []
+    for i, r in enumerate(synth.corpus(n, seed, density={'mayo': 1.5})):
+        rows.append({'order_proc_id': i,
+                     'proc_date': datetime.date(2020, 1, 1)
+                                  + datetime.timedelta(days=i),
+                     'rpt': r['rpt']})
+    rows[3]['rpt'] = None
+    rows[-1]['rpt'] = None
+    rows[5]['rpt'] = ''
+    return rows
+
+@pytest.fixture
+def snap_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_TASK', 9)
+    rows = source_rows(60, 5)
+    path = str(tmp_path / 'x.snap')
+    with snapshot.SnapshotWriter(path, ['rpt']) as w:
+        w.write_all(dict(r) for r in rows)
+    return path, rows
+
+def test_round_trip(snap_path):
+    path, rows = snap_path
+    want = [dict(r, proc_date=r['proc_date'].isoformat()) for r in rows]
+    assert list(snapshot.read_snapshot(path)) == want
+
+@pytest.mark.parametrize('x', [M, C])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_score_snapshot(fast_tokenizer, snap_path, x, workers):
+    path, rows = snap_path
+    want = [x.score_row(dict(r, proc_date=r['proc_date'].isoformat(),
+                             rpt=r['rpt'] or '')) for r in rows]
+    got = list(snapshot.score_snapshot(x, path, workers))
+    assert got == want
+    assert got[3] == x.score_row({'order_proc_id': 3,
+                                  'proc_date': '2020-01-04', 'rpt': ''})
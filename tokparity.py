@@ -0,0 +1,75 @@
+'''Token-level parity check between the tokenizer engines in common
+(NLTK word_tokenize vs. the fast regex engine), so we can tell whether
+common.TOKENIZER can safely be switched for a given corpus.
+
+    python tokparity.py [--splitters ':-=/'] [--field notes] corpus ...
+
+Each corpus file is read as JSONL (report text under --field) if it ends
+in .jsonl, else as plain text with one report per line. Every token-level
+difference is printed; exit status is 1 if there were any.
+'''
+import argparse
+import difflib
+import json
+import sys
+from common import *
+
+def token_diffs(text, splitters=None):
+    '''Returns list of (nltk_index, nltk_tokens, fast_tokens) for each
+    place the two engines disagree on text; empty list if they agree.'''
+    if splitters:
+        a = into_word_tokens_with_splitters(text, splitters, engine='nltk')
+        b = into_word_tokens_with_splitters(text, splitters, engine='fast')
+    else:
+        a = into_word_tokens(text, engine='nltk')
+        b = into_word_tokens(text, engine='fast')
+    if a == b:
+        return []
+    sm = difflib.SequenceMatcher(a=a, b=b, autojunk=False)
+    return [(i1, a[i1:i2], b[j1:j2])
+            for op, i1, i2, j1, j2 in sm.get_opcodes() if op != 'equal']
+
+def parity_report(texts, splitters=None):
+    '''Compare engines over texts (any iterable of strings).
+    Returns dict with counts, and 'diffs': list of
+    (doc_number, nltk_index, nltk_tokens, fast_tokens).'''
+    docs = 0
+    differing = 0
+    diffs = []
+    for n, text in enumerate(texts):
+        docs += 1
+        d = token_diffs(text, splitters)
+        if d:
+            differing += 1
+            diffs.extend((n,) + x for x in d)
+    return {'docs': docs, 'docs_differing': differing,
+            'n_diffs': len(diffs), 'diffs': diffs}
+
+def read_corpus(path, field='notes'):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if path.endswith('.jsonl'):
+                text = json.loads(line).get(field)
+                if text:
+                    yield text
+            else:
+                yield line.rstrip('\n')
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('corpus', nargs='+')
+    ap.add_argument('--splitters', default='',
+                    help="chars to split tokens on, e.g. ':-=/' for Mayo")
+    ap.add_argument('--field', default='notes',
+                    help='text field name for .jsonl input')
+    args = ap.parse_args(argv)
+    texts = (t for p in args.corpus for t in read_corpus(p, args.field))
+    rpt = parity_report(texts, list(args.splitters))
+    for n, i, a, b in rpt['diffs']:
+        print('doc %d token %d: nltk=%r fast=%r' % (n, i, a, b))
+    print('%d docs, %d differing, %d differences'
+          % (rpt['docs'], rpt['docs_differing'], rpt['n_diffs']))
+    return 1 if rpt['n_diffs'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())